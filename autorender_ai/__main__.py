@@ -0,0 +1,9 @@
+"""
+Allows running the command-line interface with ``python -m autorender_ai``
+"""
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
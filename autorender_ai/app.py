@@ -6,8 +6,9 @@ import os
 from flask import Flask
 
 from .config import config
-from .routes import background_bp, detection_bp, health_bp
-from .models.ai_models import model_manager
+from .routes import background_bp, detection_bp, health_bp, pipeline_bp
+from .models.ai_models import model_manager, use_model_store
+from .utils.thread_budget import thread_budget
 
 
 def create_app(config_name=None):
@@ -29,6 +30,16 @@ def create_app(config_name=None):
     # Load configuration
     app.config.from_object(config[config_name])
     
+    # Keep library downloads in the model store
+    use_model_store(config[config_name]())
+    
+    # Size library thread pools to this worker's share of the cores before
+    # any model creates its pools. Models load lazily on requests, and the
+    # app may be created in a gunicorn master before its workers are forked
+    @app.before_request
+    def apply_thread_budget():
+        thread_budget.ensure_applied()
+    
     # Initialize models (lazy loading)
     with app.app_context():
         # You can pre-load models here if needed
@@ -39,6 +50,7 @@ def create_app(config_name=None):
     app.register_blueprint(health_bp)
     app.register_blueprint(background_bp)
     app.register_blueprint(detection_bp)
+    app.register_blueprint(pipeline_bp)
     
     # Setup ngrok if enabled (for Colab)
     if app.config.get('ENABLE_NGROK'):
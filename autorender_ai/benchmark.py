@@ -0,0 +1,184 @@
+"""
+YOLO backend benchmark for AutoRender AI
+
+Compares latency and detections of exported YOLO backends against the
+PyTorch model on a folder of images.
+
+Usage:
+    python -m autorender_ai.benchmark --images samples/ --prompts person,shoe
+    python -m autorender_ai.benchmark --images samples/ --prompts person \\
+        --backends torch,onnx,openvino --runs 10 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from .config import Config
+from .models.ai_models import ModelManager
+from .services.detection_service import DetectionService
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+
+def _box_iou(box, boxes):
+    """IoU of one xyxy box against an (N, 4) array of boxes."""
+    x0 = np.maximum(box[0], boxes[:, 0])
+    y0 = np.maximum(box[1], boxes[:, 1])
+    x1 = np.minimum(box[2], boxes[:, 2])
+    y1 = np.minimum(box[3], boxes[:, 3])
+    intersection = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / (area + areas - intersection + 1e-9)
+
+
+def compare_detections(reference, candidate, iou_threshold=0.5):
+    """
+    Matches candidate boxes to reference boxes of the same class.
+
+    Args:
+        reference (tuple): (xyxy, conf, cls) arrays from the PyTorch model
+        candidate (tuple): (xyxy, conf, cls) arrays from another backend
+        iou_threshold (float): Minimum IoU for a match
+
+    Returns:
+        dict: Matched count, reference and candidate counts and the IoUs of
+            the matched pairs
+    """
+    ref_boxes, _, ref_classes = reference
+    cand_boxes, cand_scores, cand_classes = candidate
+    unmatched = np.ones(len(ref_boxes), dtype=bool)
+    ious = []
+
+    for index in np.argsort(-cand_scores):
+        candidates = unmatched & (ref_classes == cand_classes[index])
+        if not candidates.any():
+            continue
+        overlaps = np.where(candidates, _box_iou(cand_boxes[index], ref_boxes), 0)
+        best = int(np.argmax(overlaps))
+        if overlaps[best] >= iou_threshold:
+            unmatched[best] = False
+            ious.append(float(overlaps[best]))
+
+    return {
+        'matched': len(ious),
+        'reference': int(len(ref_boxes)),
+        'candidate': int(len(cand_boxes)),
+        'ious': ious
+    }
+
+
+def benchmark_backend(backend, images, classes, runs=5, warmup=1):
+    """
+    Times a YOLO backend on a set of images.
+
+    Args:
+        backend (str): 'torch', 'onnx' or 'openvino'
+        images (list): PIL Images
+        classes (list): Detection classes
+        runs (int): Timed predictions per image
+        warmup (int): Untimed predictions per image
+
+    Returns:
+        tuple: (latency stats dict, list of (xyxy, conf, cls) per image)
+    """
+    config = type('BenchmarkConfig', (Config,), {'YOLO_BACKEND': backend})()
+    manager = ModelManager(config)
+
+    start = time.perf_counter()
+    model = manager.get_yolo_predictor(classes)
+    load_seconds = time.perf_counter() - start
+
+    latencies, outputs = [], []
+    for image in images:
+        for _ in range(warmup):
+            model.predict(image, conf=config.YOLO_CONFIDENCE, verbose=False)
+        for _ in range(runs):
+            start = time.perf_counter()
+            results = model.predict(image, conf=config.YOLO_CONFIDENCE, verbose=False)
+            latencies.append((time.perf_counter() - start) * 1000)
+        outputs.append(DetectionService._result_arrays(results[0]))
+
+    stats = {
+        'load_seconds': round(load_seconds, 3),
+        'mean_ms': round(float(np.mean(latencies)), 2),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 2),
+    }
+    return stats, outputs
+
+
+def run_benchmark(image_dir, classes, backends, runs=5):
+    """
+    Benchmarks each backend and compares its detections to PyTorch.
+
+    Args:
+        image_dir (str): Folder of images
+        classes (list): Detection classes
+        backends (list): Backends to compare, PyTorch is always included
+        runs (int): Timed predictions per image
+
+    Returns:
+        dict: Per-backend latency and accuracy report
+    """
+    paths = sorted(
+        os.path.join(image_dir, name) for name in os.listdir(image_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not paths:
+        raise ValueError(f"No images found in {image_dir}")
+    images = [Image.open(path).convert("RGB") for path in paths]
+
+    backends = ['torch'] + [b for b in backends if b != 'torch']
+    report = {'images': len(images), 'classes': classes, 'backends': {}}
+    reference = None
+
+    for backend in backends:
+        print(f"Benchmarking {backend}...")
+        stats, outputs = benchmark_backend(backend, images, classes, runs=runs)
+        if reference is None:
+            reference = outputs
+        else:
+            comparisons = [compare_detections(r, c) for r, c in zip(reference, outputs)]
+            matched = sum(c['matched'] for c in comparisons)
+            ious = [iou for c in comparisons for iou in c['ious']]
+            stats['recall_vs_torch'] = round(matched / max(1, sum(c['reference'] for c in comparisons)), 4)
+            stats['precision_vs_torch'] = round(matched / max(1, sum(c['candidate'] for c in comparisons)), 4)
+            stats['mean_iou_vs_torch'] = round(float(np.mean(ious)), 4) if ious else None
+            stats['speedup_vs_torch'] = round(report['backends']['torch']['mean_ms'] / stats['mean_ms'], 2)
+        report['backends'][backend] = stats
+
+    return report
+
+
+def main(argv=None):
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(description="Benchmark YOLO inference backends")
+    parser.add_argument('--images', required=True, help="Folder of benchmark images")
+    parser.add_argument('--prompts', required=True, help="Comma-separated detection classes")
+    parser.add_argument('--backends', default='onnx', help="Comma-separated backends to compare with torch")
+    parser.add_argument('--runs', type=int, default=5, help="Timed predictions per image")
+    parser.add_argument('--output', help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(
+        args.images,
+        DetectionService.normalize_prompts(args.prompts),
+        [b.strip() for b in args.backends.split(',') if b.strip()],
+        runs=args.runs
+    )
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,496 @@
+"""
+Command-line interface for AutoRender AI
+
+Runs operations directly through the service classes, without HTTP, JSON or
+base64 overhead. Work is spread over a process pool, each process loading
+its own models, and a journal in the output directory lets an interrupted
+run resume where it stopped.
+
+Usage:
+    python -m autorender_ai batch remove-bg --input photos/ --output out/
+    python -m autorender_ai batch smart-crop --input photos/ --output out/ --width 1080 --height 1080
+    python -m autorender_ai batch detect --input manifest.jsonl --output out/ --prompts shoe,bag
+    python -m autorender_ai batch swap --input photos/ --output out/ --prompt "marble table" --workers 1
+    python -m autorender_ai video spin.mp4 --output spin.webp
+    python -m autorender_ai serve-models --socket /run/autorender/models.sock
+    python -m autorender_ai prefetch-models
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+OPERATIONS = ('remove-bg', 'smart-crop', 'detect', 'swap')
+ENDPOINTS = {'remove-bg': 'remove-bg', 'smart-crop': 'smart-crop', 'detect': 'detect', 'swap': 'swap-background'}
+EXTENSIONS = {'PNG': '.png', 'WEBP': '.webp', 'JPEG': '.jpg'}
+JOURNAL_NAME = ".autorender_journal.jsonl"
+SUMMARY_NAME = "batch_summary.json"
+
+# Options that are flags; CSV manifests give them as strings
+BOOLEAN_OPTIONS = ('crops', 'full_resolution')
+BOOLEAN_VALUES = {'true': True, '1': True, 'yes': True, 'false': False, '0': False, 'no': False}
+
+# Services of the current worker process, created by _init_worker
+_services = {}
+
+
+def load_items(source):
+    """
+    Lists the work items of a directory or manifest.
+
+    A directory yields every image below it. A manifest is a .jsonl file of
+    objects with a 'path' and optional per-item options, a .csv file with a
+    'path' column and optional option columns, or a text file of paths.
+
+    Args:
+        source (str): Directory or manifest path
+
+    Returns:
+        list: Items as dicts with 'id', 'path' and optional overrides
+
+    Raises:
+        ValueError: If a flag option is not a recognizable boolean
+    """
+    if os.path.isdir(source):
+        items = []
+        for root, _, names in os.walk(source):
+            for name in sorted(names):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    items.append({'id': os.path.relpath(path, source), 'path': path})
+        return sorted(items, key=lambda item: item['id'])
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, newline='') as f:
+        if source.endswith('.jsonl'):
+            rows = [json.loads(line) for line in f if line.strip()]
+        elif source.endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [{'path': line.strip()} for line in f if line.strip()]
+
+    items = []
+    for row in rows:
+        row = {k: v for k, v in row.items() if v not in (None, '')}
+        for name in BOOLEAN_OPTIONS:
+            if isinstance(row.get(name), str):
+                value = row[name].strip().lower()
+                if value not in BOOLEAN_VALUES:
+                    raise ValueError(
+                        f"Option '{name}' of '{row['path']}' must be true or false, not '{row[name]}'."
+                    )
+                row[name] = BOOLEAN_VALUES[value]
+        path = row['path'] if os.path.isabs(row['path']) else os.path.join(base, row['path'])
+        items.append({**row, 'id': row.get('id', row['path']), 'path': path})
+    return items
+
+
+def read_journal(output_dir):
+    """
+    Returns the ids of items completed by earlier runs.
+
+    Args:
+        output_dir (str): Output directory holding the journal
+
+    Returns:
+        set: Ids of items that finished successfully
+    """
+    done = set()
+    path = os.path.join(output_dir, JOURNAL_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A line cut short by an interrupted run
+                if record.get('status') == 'ok':
+                    done.add(record['id'])
+    return done
+
+
+def _init_worker(operation, workers=1):
+    """Creates the services once per worker process and warms up the model."""
+    from .utils.thread_budget import ThreadBudget
+
+    # Each worker loads its own models, so they share the cores between them
+    ThreadBudget(workers=workers).apply()
+
+    from .models.ai_models import model_manager
+    from .services.background_service import BackgroundService
+    from .services.detection_service import DetectionService
+
+    _services['background'] = BackgroundService()
+    _services['detection'] = DetectionService()
+
+    if operation == 'detect':
+        model_manager.load_yolo_model()
+    elif operation == 'swap':
+        model_manager.load_stable_diffusion_model()
+
+
+def _output_path(output_dir, item, suffix):
+    """
+    Mirrors the item's id below the output directory.
+
+    Raises:
+        ValueError: If the id resolves to a path outside the output directory
+    """
+    root = os.path.realpath(output_dir)
+    stem = os.path.splitext(item['id'])[0].lstrip(os.sep)
+    path = os.path.realpath(os.path.join(root, stem + suffix))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Item id '{item['id']}' points outside the output directory.")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def _open_journal(output_dir):
+    """
+    Opens the journal for appending.
+
+    A run cut off mid-record leaves a partial last line; it is ended first so
+    the next record starts on a line of its own.
+    """
+    path = os.path.join(output_dir, JOURNAL_NAME)
+    partial = False
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            partial = f.read(1) != b"\n"
+
+    journal = open(path, 'a')
+    if partial:
+        journal.write("\n")
+    return journal
+
+
+def process_item(operation, item, options, output_dir):
+    """
+    Runs one operation on one image and writes the results to disk.
+
+    Args:
+        operation (str): One of OPERATIONS
+        item (dict): Work item, its keys override options
+        options (dict): Operation options from the command line
+        output_dir (str): Output directory
+
+    Returns:
+        dict: Journal record with status, outputs and timing
+    """
+    from PIL import Image
+
+    from .config import Config
+    from .services.image_utils import ImageUtils
+    from .utils.output_encoder import OutputEncoder
+
+    options = {**options, **{k: v for k, v in item.items() if k not in ('id', 'path')}}
+    start = time.perf_counter()
+    record = {'id': item['id'], 'path': item['path']}
+
+    try:
+        encoder = OutputEncoder.from_request(options, ENDPOINTS[operation], Config)
+        extension = EXTENSIONS[encoder.format]
+        with Image.open(item['path']) as source:
+            image = source.convert("RGB")
+        outputs = []
+
+        if operation == 'remove-bg':
+            full_resolution = bool(options.get('full_resolution'))
+            max_size = Config.FULL_RES_MAX_SIZE if full_resolution else Config.MAX_IMAGE_SIZE
+            image = ImageUtils.compress_image(image, max_size=max_size)
+            result = _services['background'].remove_background(
+                image,
+                bg_color=options.get('bg_color'),
+                edge_blur_radius=int(options.get('edge_blur_radius', 0)),
+                full_resolution=full_resolution
+            )
+            outputs.append(_save(encoder, result, _output_path(output_dir, item, extension)))
+
+        elif operation == 'smart-crop':
+            result = _services['detection'].smart_crop(
+                image, int(options['width']), int(options['height'])
+            )
+            outputs.append(_save(encoder, result, _output_path(output_dir, item, extension)))
+
+        elif operation == 'detect':
+            detection = _services['detection']
+            classes = detection.normalize_prompts(options['prompts'])
+            info = detection.get_detection_info(
+                image, classes, options.get('confidence'), options.get('tiled')
+            )
+            if options.get('crops', True):
+                for index, found in enumerate(info['detections']):
+                    suffix = f"_{found['class'].replace(' ', '-')}_{index}{extension}"
+                    crop = image.crop(tuple(found['bbox']))
+                    outputs.append(_save(encoder, crop, _output_path(output_dir, item, suffix)))
+            info_path = _output_path(output_dir, item, '.json')
+            with open(info_path, 'w') as f:
+                json.dump(info, f)
+            outputs.append(info_path)
+
+        elif operation == 'swap':
+            image = ImageUtils.compress_image(image, max_size=Config.SD_MAX_SIZE)
+            result = _services['background'].swap_background(
+                image,
+                prompt=options['prompt'],
+                width=int(options['width']) if options.get('width') else None,
+                height=int(options['height']) if options.get('height') else None
+            )
+            outputs.append(_save(encoder, result, _output_path(output_dir, item, extension)))
+
+        record.update(status='ok', outputs=outputs, encoding=encoder.report())
+    except Exception as e:
+        record.update(status='error', error=str(e))
+
+    record['seconds'] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def _save(encoder, image, path):
+    """Writes an image with the run's encoder and returns its path."""
+    with open(path, 'wb') as f:
+        f.write(encoder.encode(image))
+    return path
+
+
+def run_batch(operation, items, options, output_dir, workers=1, resume=True, report_every=50):
+    """
+    Processes items in a process pool, journaling each result.
+
+    Args:
+        operation (str): One of OPERATIONS
+        items (list): Work items from ``load_items``
+        options (dict): Operation options
+        output_dir (str): Output directory
+        workers (int): Worker processes, each with its own models
+        resume (bool): Skip items already completed in the journal
+        report_every (int): Print throughput after this many items
+
+    Returns:
+        dict: Summary with counts, elapsed time and throughput
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    done = read_journal(output_dir) if resume else set()
+    pending = [item for item in items if item['id'] not in done]
+    print(f"{len(items)} items, {len(items) - len(pending)} already done, {len(pending)} to process "
+          f"with {workers} workers.")
+
+    counts = {'ok': 0, 'error': 0}
+    last_report = 0
+    start = time.perf_counter()
+    journal = _open_journal(output_dir)
+
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(operation, workers)
+        ) as executor:
+            queue = iter(pending)
+            in_flight = set()
+
+            while True:
+                # Keep a bounded number of items submitted at a time
+                for item in queue:
+                    in_flight.add(executor.submit(process_item, operation, item, options, output_dir))
+                    if len(in_flight) >= workers * 2:
+                        break
+                if not in_flight:
+                    break
+
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record = future.result()
+                    counts[record['status']] += 1
+                    journal.write(json.dumps(record) + "\n")
+                    journal.flush()
+                    if record['status'] == 'error':
+                        print(f"Failed {record['id']}: {record['error']}")
+
+                processed = counts['ok'] + counts['error']
+                if report_every and processed - last_report >= report_every:
+                    last_report = processed
+                    elapsed = time.perf_counter() - start
+                    print(f"{processed}/{len(pending)} processed, {processed / elapsed:.2f} images/s")
+    finally:
+        journal.close()
+
+    elapsed = time.perf_counter() - start
+    processed = counts['ok'] + counts['error']
+    summary = {
+        'operation': operation,
+        'total': len(items),
+        'skipped': len(items) - len(pending),
+        'processed': processed,
+        'succeeded': counts['ok'],
+        'failed': counts['error'],
+        'workers': workers,
+        'elapsed_seconds': round(elapsed, 2),
+        'images_per_second': round(processed / elapsed, 3) if elapsed > 0 else 0.0
+    }
+    with open(os.path.join(output_dir, SUMMARY_NAME), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def build_parser():
+    """Builds the argument parser."""
+    parser = argparse.ArgumentParser(prog="python -m autorender_ai", description="AutoRender AI tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    batch = commands.add_parser("batch", help="Process a directory or manifest of images offline")
+    batch.add_argument("operation", choices=OPERATIONS)
+    batch.add_argument("--input", required=True, help="Image directory or manifest (.jsonl, .csv or .txt)")
+    batch.add_argument("--output", required=True, help="Output directory")
+    batch.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1),
+                       help="Worker processes, each loads its own models")
+    batch.add_argument("--no-resume", action="store_true", help="Reprocess items already in the journal")
+    batch.add_argument("--prompt", help="Generation prompt (swap)")
+    batch.add_argument("--prompts", help="Comma-separated detection classes (detect)")
+    batch.add_argument("--confidence", type=float, help="Detection confidence (detect)")
+    batch.add_argument("--tiled", choices=("on", "off", "auto"), help="Tiled detection (detect)")
+    batch.add_argument("--no-crops", action="store_true", help="Only write detection JSON (detect)")
+    batch.add_argument("--width", type=int, help="Target width (smart-crop, swap)")
+    batch.add_argument("--height", type=int, help="Target height (smart-crop, swap)")
+    batch.add_argument("--bg-color", help="Background color hex (remove-bg)")
+    batch.add_argument("--edge-blur-radius", type=int, default=0, help="Edge blur radius (remove-bg)")
+    batch.add_argument("--full-resolution", action="store_true",
+                       help="Keep the input resolution, upsampling the mask (remove-bg)")
+    batch.add_argument("--encoding", help="Output encoding preset, e.g. png-fast, webp-lossless or jpeg-high")
+    batch.add_argument("--quality", type=int, help="Encoder quality (webp, jpeg)")
+
+    video = commands.add_parser("video", help="Remove the background of a video or frame directory")
+    video.add_argument("input", help="Video file or directory of frame images")
+    video.add_argument("--output", required=True,
+                       help="Output file; .webp, .png (APNG), .zip (PNG frames) or .mp4")
+    video.add_argument("--change-threshold", type=float,
+                       help="Mean pixel change (0-1) from the last keyframe above which a frame is segmented")
+    video.add_argument("--bg-color", help="Background color hex (required for .mp4)")
+
+    serve = commands.add_parser("serve-models", help="Run the model server shared by all workers")
+    serve.add_argument("--socket", help="Unix socket path (default: MODEL_SERVER_SOCKET)")
+
+    prefetch = commands.add_parser("prefetch-models", help="Download models into the model store")
+    prefetch.add_argument("--models", default="yolo,rembg,stable_diffusion",
+                          help="Comma-separated models to fetch")
+    prefetch.add_argument("--no-preserialize", action="store_true",
+                          help="Don't save a pre-serialized Stable Diffusion pipeline")
+    return parser
+
+
+def prefetch_models(models, preserialize=True):
+    """
+    Downloads models into ``Config.MODEL_STORE_DIR`` so workers can start
+    with ``MODEL_OFFLINE`` set, e.g. while building a container image.
+
+    Args:
+        models (list): Any of 'yolo', 'rembg' and 'stable_diffusion'
+        preserialize (bool): Also save the Stable Diffusion pipeline in
+            ``Config.SD_TORCH_DTYPE``
+
+    Returns:
+        dict: Load time and source of each model
+    """
+    from .config import Config
+    from .models.ai_models import ModelManager
+
+    config = Config()
+    config.MODEL_OFFLINE = False
+    config.SD_PRESERIALIZE = preserialize
+    manager = ModelManager(config, use_server=False)
+
+    if 'yolo' in models:
+        # YOLO-World fetches its text encoder the first time classes are set
+        manager.load_yolo_model().set_classes(["object"])
+    if 'rembg' in models:
+        manager.load_rembg_session()
+    if 'stable_diffusion' in models and manager.load_stable_diffusion_model() is None:
+        raise RuntimeError("Stable Diffusion could not be loaded.")
+    return manager.load_times
+
+
+def main(argv=None):
+    """Command-line entry point."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    from .config import Config
+    from .models.ai_models import use_model_store
+
+    # Keep library downloads in the model store, prefetching must download
+    store_config = Config()
+    store_config.MODEL_OFFLINE = store_config.MODEL_OFFLINE and args.command != "prefetch-models"
+    use_model_store(store_config)
+
+    if args.command == "batch":
+        if args.operation == 'swap' and not args.prompt:
+            parser.error("swap requires --prompt")
+        if args.operation == 'detect' and not args.prompts:
+            parser.error("detect requires --prompts")
+        if args.operation == 'smart-crop' and not (args.width and args.height):
+            parser.error("smart-crop requires --width and --height")
+
+        options = {
+            'prompt': args.prompt,
+            'prompts': args.prompts,
+            'confidence': args.confidence,
+            'tiled': args.tiled,
+            'crops': not args.no_crops,
+            'width': args.width,
+            'height': args.height,
+            'bg_color': args.bg_color,
+            'edge_blur_radius': args.edge_blur_radius,
+            'full_resolution': args.full_resolution,
+            'encoding': args.encoding,
+            'quality': args.quality,
+        }
+        items = load_items(args.input)
+        summary = run_batch(
+            args.operation, items, options, args.output,
+            workers=max(1, args.workers), resume=not args.no_resume
+        )
+        print(json.dumps(summary, indent=2))
+        return 0 if summary['failed'] == 0 else 1
+
+    if args.command == "video":
+        from .services.video_service import VIDEO_EXTENSIONS, VideoService
+
+        extension = os.path.splitext(args.output)[1].lower()
+        formats = {ext: name for name, ext in VIDEO_EXTENSIONS.items()}
+        if extension not in formats:
+            parser.error(f"--output must end in one of: {', '.join(formats)}")
+
+        stats = VideoService().process_video(
+            args.input, args.output, formats[extension], args.change_threshold, args.bg_color
+        )
+        print(json.dumps(stats, indent=2))
+        return 0
+
+    if args.command == "serve-models":
+        from .config import Config
+        from .models.model_server import serve
+
+        config = Config()
+        if args.socket:
+            config.MODEL_SERVER_SOCKET = args.socket
+        if not config.MODEL_SERVER_SOCKET:
+            parser.error("serve-models requires --socket or MODEL_SERVER_SOCKET")
+        serve(config)
+
+    if args.command == "prefetch-models":
+        models = [m.strip() for m in args.models.split(',') if m.strip()]
+        print(json.dumps(prefetch_models(models, not args.no_preserialize), indent=2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,6 +6,22 @@ import os
 import torch
 
 
+def default_model_store():
+    """
+    Returns the model store used when MODEL_STORE_DIR is not set.
+    
+    A source checkout keeps it next to the package. An installed package
+    sits in site-packages, which is usually not writable, so the store goes
+    to the user's data directory instead.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    installed = os.path.basename(root) in ('site-packages', 'dist-packages')
+    if not installed and os.access(root, os.W_OK):
+        return os.path.join(root, 'model_store')
+    data_home = os.environ.get('XDG_DATA_HOME') or os.path.expanduser(os.path.join('~', '.local', 'share'))
+    return os.path.join(data_home, 'autorender_ai', 'model_store')
+
+
 class Config:
     """Base configuration class"""
     
@@ -20,23 +36,122 @@ class Config:
     # AI Model settings
     DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     
+    # Local model store: relative model paths, the Hugging Face cache, rembg
+    # weights and pre-serialized pipelines live here instead of the working
+    # directory. See default_model_store for the default. With
+    # MODEL_OFFLINE nothing is downloaded at startup
+    MODEL_STORE_DIR = os.path.abspath(os.environ.get('MODEL_STORE_DIR') or default_model_store())
+    MODEL_OFFLINE = os.environ.get('MODEL_OFFLINE', 'False').lower() == 'true'
+    
     # YOLO settings
-    YOLO_MODEL_PATH = "yolov8l-world.pt"
+    YOLO_MODEL_PATH = os.environ.get('YOLO_MODEL_PATH', "yolov8l-world.pt")  # Relative to MODEL_STORE_DIR
     YOLO_CONFIDENCE = 0.5
+    YOLO_CLASS_CONFIDENCE = {}  # Per-class overrides, e.g. {"person": 0.6}
+    
+    # YOLO inference backend: 'torch', or an exported 'onnx' / 'openvino' model
+    YOLO_BACKEND = os.environ.get('YOLO_BACKEND', 'torch')
+    YOLO_EXPORT_DIR = os.environ.get('YOLO_EXPORT_DIR', 'exports')  # Relative to MODEL_STORE_DIR
+    YOLO_EXPORT_IMGSZ = 640
+    YOLO_EXPORT_DYNAMIC = os.environ.get('YOLO_EXPORT_DYNAMIC', 'False').lower() == 'true'
+    YOLO_EXPORT_INT8 = os.environ.get('YOLO_EXPORT_INT8', 'False').lower() == 'true'
+    YOLO_EXPORT_INT8_DATA = 'coco8.yaml'  # Calibration dataset for int8 OpenVINO exports
+    YOLO_EXPORT_CACHE_SIZE = 8  # Exported class lists kept in memory
+    
+    # Tiled detection settings (for high-resolution images)
+    DETECTION_TILING = 'off'  # 'off', 'on' or 'auto'
+    DETECTION_TILE_MIN_SIZE = 2048  # 'auto' tiles images larger than this
+    DETECTION_TILE_SIZE = 1280
+    DETECTION_TILE_OVERLAP = 0.2
+    DETECTION_TILE_BATCH = 4
+    DETECTION_TILE_FULL_IMAGE = True  # Also run a downscaled full-image pass
+    DETECTION_NMS_IOU = 0.5
     
     # Stable Diffusion settings
     SD_MODEL_ID = "runwayml/stable-diffusion-v1-5"
     SD_TORCH_DTYPE = torch.float16 if torch.cuda.is_available() else torch.float32
+    SD_PREVIEW_EVERY = 5  # Steps between latent previews when streaming
+    SD_OFFLOAD = os.environ.get('SD_OFFLOAD', 'none')  # 'none', 'model' or 'sequential'
+    SD_LOW_CPU_MEM_USAGE = True  # Memory-map safetensors weights instead of loading copies
+    # Save the loaded pipeline, converted to SD_TORCH_DTYPE, in the model store
+    # and load that copy on later starts
+    SD_PRESERIALIZE = os.environ.get('SD_PRESERIALIZE', 'False').lower() == 'true'
+    
+    # Model residency: unload least recently used models over budget, and idle ones
+    MODEL_MEMORY_BUDGET_MB = int(os.environ.get('MODEL_MEMORY_BUDGET_MB', 0))  # 0 = unlimited
+    MODEL_IDLE_TTL = int(os.environ.get('MODEL_IDLE_TTL', 0))  # Seconds, 0 = never unload
+    
+    # Background removal model
+    REMBG_MODEL = os.environ.get('REMBG_MODEL', 'u2net')
+    
+    # Host-local model server shared by all workers (unset = models in each worker)
+    MODEL_SERVER_SOCKET = os.environ.get('MODEL_SERVER_SOCKET', '')
+    MODEL_SERVER_AUTHKEY = os.environ.get('MODEL_SERVER_AUTHKEY')  # Unset = random key in <socket>.key
+    MODEL_SERVER_MAX_BATCH = int(os.environ.get('MODEL_SERVER_MAX_BATCH', 8))  # Images per YOLO batch
+    MODEL_SERVER_BATCH_WAIT_MS = float(os.environ.get('MODEL_SERVER_BATCH_WAIT_MS', 10))
     
     # Image processing settings
     MAX_IMAGE_SIZE = 1024
     SD_MAX_SIZE = 768  # Stable Diffusion works best with smaller images
     DEFAULT_EDGE_BLUR = 0
     
+    # Full-resolution background removal: segment at MAX_IMAGE_SIZE, then
+    # upsample the mask with a guided filter against the original image
+    FULL_RES_MAX_SIZE = 8192  # Larger inputs are downscaled to this first
+    MASK_GUIDED_RADIUS = 4  # In working-size pixels
+    MASK_GUIDED_EPS = 1e-3
+    
+    # Video background removal: frames changed less than this (mean absolute
+    # pixel change, 0-1) since the last keyframe reuse its mask
+    VIDEO_CHANGE_THRESHOLD = 0.02
+    VIDEO_MAX_FRAMES = 900
+    VIDEO_MAX_APNG_FRAMES = 120  # APNG output is assembled in memory
+    VIDEO_SEQUENCE_FPS = 24  # For frame sequences, which carry no frame rate
+    VIDEO_FORMAT = 'webp'  # 'webp', 'apng', 'png' (zip of frames) or 'mp4'
+    
+    # Output encoding presets, chosen per request with 'encoding'. PNG and WebP keep alpha
+    OUTPUT_PRESETS = {
+        'png': {'format': 'PNG', 'compress_level': 6},
+        'png-fast': {'format': 'PNG', 'compress_level': 1},
+        'webp': {'format': 'WEBP', 'quality': 90, 'method': 4},
+        'webp-fast': {'format': 'WEBP', 'quality': 80, 'method': 0},
+        'webp-lossless': {'format': 'WEBP', 'lossless': True, 'quality': 25, 'method': 0},
+        'jpeg': {'format': 'JPEG', 'quality': 75, 'subsampling': 2},
+        'jpeg-high': {'format': 'JPEG', 'quality': 92, 'subsampling': 0},
+    }
+    OUTPUT_PRESET = os.environ.get('OUTPUT_PRESET', 'png')  # Default for all endpoints
+    OUTPUT_ENDPOINT_PRESETS = {
+        'remove-bg': os.environ.get('OUTPUT_PRESET_REMOVE_BG', OUTPUT_PRESET),
+        'swap-background': os.environ.get('OUTPUT_PRESET_SWAP', 'jpeg'),
+    }
+    
+    # Default request deadline in seconds, 0 for none. Clients can set their
+    # own with the X-Request-Timeout header
+    REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 0))
+    
+    # CPU process pool for decode/resize/encode/composite of large images
+    CPU_POOL_WORKERS = int(os.environ.get('CPU_POOL_WORKERS', 0))  # 0 disables the pool
+    CPU_POOL_MIN_PIXELS = int(os.environ.get('CPU_POOL_MIN_PIXELS', 1_000_000))
+    CPU_POOL_START_METHOD = 'forkserver'
+    
+    # CPU thread budget: divide the host's cores among worker processes and cap
+    # the torch, ONNX Runtime and OpenCV pools of each to its share
+    THREAD_BUDGET = os.environ.get('THREAD_BUDGET', 'auto')  # 'auto' or 'off'
+    THREAD_BUDGET_WORKERS = int(os.environ.get('THREAD_BUDGET_WORKERS', os.environ.get('WEB_CONCURRENCY', 1)))
+    THREAD_BUDGET_CORES = int(os.environ.get('THREAD_BUDGET_CORES', 0))  # 0 = all available cores
+    THREAD_BUDGET_THREADS = int(os.environ.get('THREAD_BUDGET_THREADS', 0))  # 0 = cores / workers
+    THREAD_BUDGET_AFFINITY = os.environ.get('THREAD_BUDGET_AFFINITY', 'False').lower() == 'true'
+    
     # Caching settings
     LRU_CACHE_SIZE = 32
     SD_CACHE_SIZE = 16
     
+    # Near-duplicate cache: re-saved, resized or recompressed uploads reuse the
+    # segmentation mask and detections of an earlier upload of the same photo
+    PERCEPTUAL_CACHE = os.environ.get('PERCEPTUAL_CACHE', 'False').lower() == 'true'
+    PERCEPTUAL_CACHE_SIZE = int(os.environ.get('PERCEPTUAL_CACHE_SIZE', 256))  # Entries per cache
+    PERCEPTUAL_HASH_DISTANCE = int(os.environ.get('PERCEPTUAL_HASH_DISTANCE', 4))  # Of 64 dHash bits
+    PERCEPTUAL_MAX_DIFFERENCE = 0.04  # Mean color difference (0-1) of 16x16 thumbnails
+    
     # Ngrok settings (for Colab)
     ENABLE_NGROK = os.environ.get('ENABLE_NGROK', 'False').lower() == 'true'
     NGROK_AUTH_TOKEN = os.environ.get('NGROK_AUTH_TOKEN')
@@ -0,0 +1,633 @@
+"""
+Load testing for AutoRender AI
+
+Replays a mix of /remove-bg, /detect and /smart-crop requests at a target
+rate against the app and reports latency percentiles, throughput and error
+rates. A list of rates is run as a ramp, stopping at the first rate the
+server cannot sustain. The target is either an app started in this process
+(optionally with stub models, to measure everything but inference) or a
+running server.
+
+Requests arrive on an open-loop Poisson schedule, and latency is measured
+from each request's scheduled arrival. Time spent waiting for a free client
+connection therefore counts, and an overloaded server shows up as growing
+latency instead of a lower request rate.
+
+Usage:
+    python -m autorender_ai.loadtest --stub-models --rates 2,4,8,16 --duration 30 --output load.json
+    python -m autorender_ai.loadtest --url http://localhost:5000 --mix remove-bg=2,detect=1 \\
+        --sizes 1920x1080,4032x3024 --repeat 0.3 --rates 1,2,4 --output load.json
+    python -m autorender_ai.loadtest --compare load-1.4.json --report load.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from io import BytesIO
+
+import numpy as np
+import requests
+from PIL import Image, ImageDraw, ImageFilter
+
+from . import __version__
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+# Brightness change of the grid cells that tell variants apart, enough to
+# put them outside the perceptual caches' default thresholds
+VARIANT_SHADE = 24
+
+# Endpoint name -> (path, form fields)
+ENDPOINTS = {
+    'remove-bg': ("/remove-bg", {}),
+    'detect': ("/detect", {'prompts': "person,bottle"}),
+    'smart-crop': ("/smart-crop", {'width': "512", 'height': "512"}),
+    'face-crop': ("/face-crop", {}),
+}
+DEFAULT_MIX = "remove-bg=0.5,detect=0.3,smart-crop=0.2"
+DEFAULT_SIZES = "800x600,1920x1080,4032x3024"
+
+
+def parse_mix(text):
+    """
+    Parses a traffic mix such as 'remove-bg=2,detect=1'.
+
+    Args:
+        text (str): Comma-separated endpoint=weight pairs
+
+    Returns:
+        dict: Endpoint name to share of requests, summing to 1
+
+    Raises:
+        ValueError: If an endpoint is unknown or no weight is positive
+    """
+    weights = {}
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint '{name}'. Use one of: {', '.join(ENDPOINTS)}.")
+        weights[name] = float(weight) if weight.strip() else 1.0
+
+    total = sum(w for w in weights.values() if w > 0)
+    if total <= 0:
+        raise ValueError("The traffic mix needs at least one endpoint with a positive weight.")
+    return {name: w / total for name, w in weights.items() if w > 0}
+
+
+def parse_sizes(text):
+    """Parses image sizes such as '800x600,1920x1080' into (width, height) tuples."""
+    sizes = []
+    for part in text.split(','):
+        if part.strip():
+            width, _, height = part.lower().partition('x')
+            sizes.append((int(width), int(height)))
+    if not sizes:
+        raise ValueError("At least one image size is required.")
+    return sizes
+
+
+def synthetic_image(size, seed=0):
+    """
+    Draws a product-like photo: a soft gradient backdrop with a few objects.
+
+    Args:
+        size (tuple): (width, height)
+        seed (int): Seed for the layout
+
+    Returns:
+        PIL.Image: RGB image
+    """
+    rng = random.Random(seed)
+    width, height = size
+    gradient = np.linspace(170, 235, height, dtype=np.float32)[:, None, None]
+    tint = np.array([rng.uniform(0.9, 1.0) for _ in range(3)], dtype=np.float32)
+    image = Image.fromarray(np.broadcast_to(gradient * tint, (height, width, 3)).astype(np.uint8))
+
+    draw = ImageDraw.Draw(image)
+    for _ in range(3):
+        w, h = rng.uniform(0.15, 0.4) * width, rng.uniform(0.2, 0.6) * height
+        x, y = rng.uniform(0, width - w), rng.uniform(0, height - h)
+        color = tuple(rng.randrange(20, 200) for _ in range(3))
+        draw.ellipse((x, y, x + w, y + h), fill=color)
+    return image.filter(ImageFilter.GaussianBlur(1))
+
+
+def encode_variant(image, index):
+    """
+    Encodes a copy of an image made unique by a shading pattern and a stamp.
+
+    The stamp along the top edge survives downscaling, so every variant
+    misses the server's coalescing and exact caches. The coarse pattern
+    changes the perceptual hash and colors enough that variants also miss
+    the perceptual caches at their default thresholds. Reports record
+    whether the server had those caches enabled.
+
+    Args:
+        image (PIL.Image): Base image
+        index (int): Variant number
+
+    Returns:
+        bytes: JPEG encoded variant
+    """
+    variant = image.copy()
+    # Lighten or darken each cell of a coarse grid, a pattern per variant
+    rng = random.Random(index)
+    cells = [rng.choice((-VARIANT_SHADE, VARIANT_SHADE)) for _ in range(64)]
+    shade = Image.fromarray(np.array(cells, dtype=np.float32).reshape(8, 8))
+    shade = np.asarray(shade.resize(variant.size, Image.Resampling.NEAREST))
+    pixels = np.asarray(variant, dtype=np.float32) + shade[:, :, None]
+    variant = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    # One block per base-8 digit, with levels far enough apart to survive JPEG
+    side = max(16, min(variant.size) // 32)
+    for position in range(6):
+        level = (index >> (3 * position) & 7) * 32 + 16
+        variant.paste((level, level, level), (position * side, 0, (position + 1) * side, side))
+    buffer = BytesIO()
+    variant.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+class TrafficMix:
+    """Draws the endpoint and payload of each request"""
+
+    def __init__(self, mix, images, repeat=0.0, seed=0):
+        """
+        Args:
+            mix (dict): Endpoint name to share of requests, see ``parse_mix``
+            images (list): Base PIL Images, sent in rotation
+            repeat (float): Share of requests that resend an image already
+                sent, exercising request coalescing and caches
+            seed (int): Seed for the request sequence
+        """
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.images = images
+        self.repeat = repeat
+        self.rng = random.Random(seed)
+        self.sent = []
+        self.count = 0
+
+    def prepare(self, requests_count):
+        """
+        Draws a step's requests up front, so encoding stays off the clock.
+
+        Args:
+            requests_count (int): Number of requests
+
+        Returns:
+            list: (endpoint name, payload bytes, whether it is a repeat) tuples
+        """
+        planned = []
+        for _ in range(requests_count):
+            name = self.rng.choices(self.names, self.weights)[0]
+            if self.sent and self.rng.random() < self.repeat:
+                planned.append((name, self.rng.choice(self.sent), True))
+                continue
+            payload = encode_variant(self.images[self.count % len(self.images)], self.count)
+            self.count += 1
+            self.sent.append(payload)
+            planned.append((name, payload, False))
+        return planned
+
+
+def install_stub_models(latency_ms=50):
+    """
+    Replaces segmentation and YOLO in this process with fast fakes.
+
+    Everything else (decoding, resizing, SmartCrop, compositing, encoding,
+    coalescing) runs for real, so a stub run measures the app's own overhead.
+
+    Args:
+        latency_ms (float): Time each fake inference sleeps
+
+    Returns:
+        callable: Restores the real models
+    """
+    import torch
+    from .models.ai_models import model_manager
+
+    def segment(image, only_mask=False, **options):
+        time.sleep(latency_ms / 1000)
+        mask = Image.new("L", image.size, 0)
+        w, h = image.size
+        ImageDraw.Draw(mask).ellipse((w // 4, h // 4, w * 3 // 4, h * 3 // 4), fill=255)
+        if only_mask:
+            return mask
+        cutout = image.convert("RGBA")
+        cutout.putalpha(mask)
+        return cutout
+
+    class StubBoxes:
+        def __init__(self, width, height, classes):
+            boxes = [[width * 0.2, height * 0.2, width * 0.6, height * 0.7]] * classes
+            self.xyxy = torch.tensor(boxes, dtype=torch.float32).reshape(-1, 4)
+            self.conf = torch.full((classes,), 0.9)
+            self.cls = torch.arange(classes, dtype=torch.float32)
+
+    class StubResult:
+        def __init__(self, boxes):
+            self.boxes = boxes
+
+    class StubYOLO:
+        def __init__(self, classes):
+            self.classes = classes
+
+        def predict(self, source, conf=None, verbose=False, **kwargs):
+            time.sleep(latency_ms / 1000)
+            images = source if isinstance(source, list) else [source]
+            return [StubResult(StubBoxes(*image.size, len(self.classes))) for image in images]
+
+    # Instance attributes shadow the methods until they are deleted again
+    model_manager.segment = segment
+    model_manager.get_yolo_predictor = StubYOLO
+
+    def restore():
+        for name in ('segment', 'get_yolo_predictor'):
+            model_manager.__dict__.pop(name, None)
+    return restore
+
+
+def start_local_server(stub_models=False, stub_latency_ms=50):
+    """
+    Serves an app from ``create_app`` on a free local port in a background thread.
+
+    Args:
+        stub_models (bool): Replace models with ``install_stub_models``
+        stub_latency_ms (float): Latency of the stub models
+
+    Returns:
+        tuple: (base URL, server with a ``shutdown`` method, which also
+            restores the real models)
+    """
+    from werkzeug.serving import make_server
+    from . import create_app
+
+    # One access log line per request would slow the server being measured
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, create_app('production'), threaded=True)
+    if stub_models:
+        restore = install_stub_models(stub_latency_ms)
+        stop = server.shutdown
+
+        def shutdown():
+            stop()
+            restore()
+        server.shutdown = shutdown
+    threading.Thread(target=server.serve_forever, name="loadtest-server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+def percentiles(latencies):
+    """Returns p50, p95, p99 and max of a list of millisecond latencies."""
+    if not latencies:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'max_ms': None}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        'p50_ms': round(float(p50), 2),
+        'p95_ms': round(float(p95), 2),
+        'p99_ms': round(float(p99), 2),
+        'max_ms': round(float(max(latencies)), 2)
+    }
+
+
+def summarize(records, duration, elapsed):
+    """
+    Aggregates request records into a report.
+
+    Throughput is the rate of successful responses between the first
+    response and the end of the traffic. Responses only start once the first
+    requests are through, so the wait for them doesn't count against the
+    server at any latency, and responses after the traffic ends are the
+    backlog the step left behind. When no response arrives before the end,
+    throughput falls back to all successes over the time to the last one.
+
+    Args:
+        records (list): Dicts with 'endpoint', 'status', 'latency_ms',
+            'finished_s' (seconds from the start of traffic) and 'repeat'
+        duration (float): Seconds of traffic
+        elapsed (float): Seconds from the start of traffic to the last response
+
+    Returns:
+        dict: Counts, offered rate, throughput, backlog, error rate and
+            latency percentiles of successful requests
+    """
+    ok = [r for r in records if r['status'] == 200]
+    statuses = {}
+    for record in records:
+        statuses[str(record['status'])] = statuses.get(str(record['status']), 0) + 1
+
+    first = min((r['finished_s'] for r in records), default=None)
+    if first is not None and first < duration:
+        served = sum(1 for r in ok if r['finished_s'] <= duration)
+        throughput = served / (duration - first)
+    else:
+        throughput = len(ok) / elapsed if elapsed > 0 else 0.0
+
+    return {
+        'requests': len(records),
+        'succeeded': len(ok),
+        'offered_rps': round(len(records) / duration, 3) if duration > 0 else 0.0,
+        'throughput_rps': round(throughput, 3),
+        'backlog': sum(1 for r in records if r['finished_s'] > duration),
+        'error_rate': round(1 - len(ok) / len(records), 4) if records else 0.0,
+        'statuses': statuses,
+        'repeats': sum(1 for r in records if r['repeat']),
+        **percentiles([r['latency_ms'] for r in ok])
+    }
+
+
+def send(session_factory, url, name, payload, timeout):
+    """Sends one request and returns its status code and an error message if any."""
+    path, fields = ENDPOINTS[name]
+    try:
+        response = session_factory().post(
+            url + path, data=fields, files={'image': ("image.jpg", payload, "image/jpeg")}, timeout=timeout
+        )
+    except requests.RequestException as e:
+        return 'error', type(e).__name__
+    if response.status_code != 200:
+        try:
+            return response.status_code, response.json().get('error')
+        except ValueError:
+            return response.status_code, response.text[:200]
+    return 200, None
+
+
+def run_step(url, traffic, rate, duration, concurrency=32, timeout=60, seed=0):
+    """
+    Sends requests at a target rate for a fixed time.
+
+    Args:
+        url (str): Base URL of the server
+        traffic (TrafficMix): Source of requests
+        rate (float): Target requests per second
+        duration (float): Seconds of traffic
+        concurrency (int): Client connections; requests beyond them wait
+            and their wait counts towards latency
+        timeout (float): Seconds before a request counts as failed
+        seed (int): Seed for the arrival schedule
+
+    Returns:
+        dict: Summary for the whole step and per endpoint, see ``summarize``
+    """
+    rng = random.Random(seed)
+    arrivals, t = [], rng.expovariate(rate)
+    while t < duration:
+        arrivals.append(t)
+        t += rng.expovariate(rate)
+    planned = traffic.prepare(len(arrivals))
+
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session
+
+    records, errors = [], {}
+    lock = threading.Lock()
+
+    def fire(scheduled, name, payload, repeat):
+        status, error = send(session, url, name, payload, timeout)
+        finished = time.perf_counter()
+        with lock:
+            records.append({
+                'endpoint': name, 'status': status, 'latency_ms': (finished - scheduled) * 1000,
+                'finished_s': finished - start, 'repeat': repeat
+            })
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for arrival, (name, payload, repeat) in zip(arrivals, planned):
+            delay = start + arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(fire, start + arrival, name, payload, repeat))
+        wait(futures)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'target_rps': rate,
+        'duration_seconds': duration,
+        'elapsed_seconds': round(elapsed, 3),
+        **summarize(records, duration, elapsed),
+        'endpoints': {
+            name: summarize([r for r in records if r['endpoint'] == name], duration, elapsed)
+            for name in sorted({r['endpoint'] for r in records})
+        },
+        'errors': dict(sorted(errors.items(), key=lambda item: -item[1])[:10])
+    }
+
+
+def saturation_reason(step, min_throughput=0.9, max_error_rate=0.01, slo_ms=None):
+    """
+    Tells whether a step shows the server past its capacity.
+
+    Args:
+        step (dict): Result of ``run_step``
+        min_throughput (float): Share of the offered rate that must be served
+        max_error_rate (float): Highest acceptable error rate
+        slo_ms (float): Optional p99 latency objective
+
+    Returns:
+        str: Why the step is saturated, or None if it is sustained
+    """
+    if step['error_rate'] > max_error_rate:
+        return f"error rate {step['error_rate']:.2%} above {max_error_rate:.2%}"
+    # Compared with the offered rate, as Poisson arrivals only approach the target
+    if step['throughput_rps'] < min_throughput * step['offered_rps']:
+        return f"served {step['throughput_rps']} of {step['offered_rps']} requests/s"
+    if slo_ms and step['p99_ms'] is not None and step['p99_ms'] > slo_ms:
+        return f"p99 {step['p99_ms']} ms above {slo_ms} ms"
+    return None
+
+
+def run_load_test(url, mix, images, rates, duration=30, repeat=0.0, concurrency=32,
+                  timeout=60, slo_ms=None, max_error_rate=0.01, seed=0):
+    """
+    Runs a ramp of rates and finds where the server saturates.
+
+    Args:
+        url (str): Base URL of the server
+        mix (dict): Traffic mix, see ``parse_mix``
+        images (list): Base PIL Images
+        rates (list): Target requests per second, in increasing order
+        duration (float): Seconds per rate
+        repeat (float): Share of requests resending an earlier image
+        concurrency (int): Client connections
+        timeout (float): Request timeout in seconds
+        slo_ms (float): Optional p99 latency objective for saturation
+        max_error_rate (float): Error rate above which a rate is saturated
+        seed (int): Seed for traffic and arrivals
+
+    Returns:
+        dict: Steps and the saturation point
+    """
+    traffic = TrafficMix(mix, images, repeat, seed)
+    steps, saturation = [], {'max_sustained_rps': None, 'saturated_at_rps': None, 'reason': None}
+
+    for index, rate in enumerate(rates):
+        print(f"Running {rate} requests/s for {duration}s...")
+        step = run_step(url, traffic, rate, duration, concurrency, timeout, seed + index)
+        reason = saturation_reason(step, max_error_rate=max_error_rate, slo_ms=slo_ms)
+        step['saturated'] = reason is not None
+        steps.append(step)
+        print(f"  {step['throughput_rps']} requests/s, p50 {step['p50_ms']} ms, p99 {step['p99_ms']} ms, "
+              f"errors {step['error_rate']:.2%}")
+
+        if reason:
+            saturation.update(saturated_at_rps=rate, reason=reason)
+            break
+        saturation['max_sustained_rps'] = rate
+
+    return {'steps': steps, 'saturation': saturation}
+
+
+def compare_reports(baseline, current):
+    """
+    Compares two reports rate by rate.
+
+    Args:
+        baseline (dict): Earlier report, e.g. of the last release
+        current (dict): New report
+
+    Returns:
+        dict: Per-rate relative change of throughput and latency, and both
+            saturation points
+    """
+    def change(old, new):
+        if old is None or new is None or old == 0:
+            return None
+        return round((new - old) / old, 4)
+
+    old_steps = {step['target_rps']: step for step in baseline['steps']}
+    rates = {}
+    for step in current['steps']:
+        old = old_steps.get(step['target_rps'])
+        if old is None:
+            continue
+        rates[str(step['target_rps'])] = {
+            key: change(old[key], step[key])
+            for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms')
+        }
+        rates[str(step['target_rps'])]['error_rate'] = round(step['error_rate'] - old['error_rate'], 4)
+
+    return {
+        'baseline_version': baseline.get('meta', {}).get('version'),
+        'version': current.get('meta', {}).get('version'),
+        'rates': rates,
+        'max_sustained_rps': {
+            'baseline': baseline['saturation']['max_sustained_rps'],
+            'current': current['saturation']['max_sustained_rps']
+        }
+    }
+
+
+def load_images(image_dir, sizes, seed=0):
+    """Returns base images from a folder, or synthetic ones of each size."""
+    if image_dir:
+        paths = sorted(
+            os.path.join(image_dir, name) for name in os.listdir(image_dir)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        if not paths:
+            raise ValueError(f"No images found in {image_dir}")
+        return [Image.open(path).convert("RGB") for path in paths]
+    return [synthetic_image(size, seed + index) for index, size in enumerate(sizes)]
+
+
+def main(argv=None):
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(description="Load test the AutoRender AI API")
+    parser.add_argument('--url', help="Base URL of a running server (default: start one in this process)")
+    parser.add_argument('--stub-models', action='store_true', help="Use fake models in the in-process server")
+    parser.add_argument('--stub-latency-ms', type=float, default=50, help="Latency of each fake inference")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="Endpoint weights, e.g. remove-bg=2,detect=1")
+    parser.add_argument('--images', help="Folder of images to send (default: synthetic images)")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="Sizes of synthetic images")
+    parser.add_argument('--repeat', type=float, default=0.2, help="Share of requests resending an earlier image")
+    parser.add_argument('--rates', default="1,2,4,8", help="Comma-separated target requests per second")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds per rate")
+    parser.add_argument('--concurrency', type=int, default=32, help="Client connections")
+    parser.add_argument('--timeout', type=float, default=60, help="Request timeout in seconds")
+    parser.add_argument('--slo-ms', type=float, help="p99 latency above which a rate counts as saturated")
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help="Error rate that counts as saturated")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the JSON report to this file")
+    parser.add_argument('--compare', help="Baseline report to compare the results with")
+    parser.add_argument('--report', help="With --compare, compare this saved report instead of running")
+    args = parser.parse_args(argv)
+
+    if args.report:
+        if not args.compare:
+            parser.error("--report needs --compare")
+        with open(args.compare) as f, open(args.report) as g:
+            print(json.dumps(compare_reports(json.load(f), json.load(g)), indent=2))
+        return
+
+    mix = parse_mix(args.mix)
+    sizes = parse_sizes(args.sizes)
+    rates = sorted(float(r) for r in args.rates.split(',') if r.strip())
+    images = load_images(args.images, sizes, args.seed)
+
+    server = None
+    url = args.url
+    if url is None:
+        url, server = start_local_server(args.stub_models, args.stub_latency_ms)
+    url = url.rstrip('/')
+
+    try:
+        status = requests.get(url + "/status", timeout=args.timeout).json()
+        report = run_load_test(
+            url, mix, images, rates, duration=args.duration, repeat=args.repeat,
+            concurrency=args.concurrency, timeout=args.timeout, slo_ms=args.slo_ms,
+            max_error_rate=args.max_error_rate, seed=args.seed
+        )
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    report['meta'] = {
+        'version': status.get('version', __version__),
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'target': args.url or "in-process",
+        'stub_models': bool(args.stub_models and not args.url),
+        'mix': mix,
+        'image_sizes': [list(image.size) for image in images],
+        'repeat': args.repeat,
+        'duration_seconds': args.duration,
+        'concurrency': args.concurrency,
+        'slo_ms': args.slo_ms,
+        'host': {'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'server': {
+            'threads': status.get('threads'),
+            'device': status.get('models', {}).get('device'),
+            'perceptual_cache': status.get('perceptual_cache'),
+        }
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            report['comparison'] = compare_reports(json.load(f), report)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
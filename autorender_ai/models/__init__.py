@@ -8,5 +8,7 @@ Contains model initialization and management for:
 """
 
 from .ai_models import ModelManager
+from .model_server import ModelServer
+from .residency import ModelResidency
 
-__all__ = ["ModelManager"]
+__all__ = ["ModelManager", "ModelResidency", "ModelServer"]
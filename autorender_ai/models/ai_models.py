@@ -2,18 +2,64 @@
 AI Models initialization and management
 """
 
+import glob
+import hashlib
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
 import torch
 from diffusers import StableDiffusionPipeline
+from rembg import new_session, remove
 from ultralytics import YOLO
 import smartcrop
 
+from .model_server import ModelServerClient, RemoteDiffusionPipe, RemoteYOLO
+from .residency import ModelResidency, estimate_model_size
 from ..config import Config
+from ..utils.metrics import metrics
+
+
+def use_model_store(config=None):
+    """
+    Points the model libraries' own downloads at the model store.
+    
+    Call once at process start, from ``create_app`` and the CLI. rembg
+    reads ``U2NET_HOME`` when it creates a session. Hugging Face reads
+    ``HF_HOME`` and ``HF_HUB_OFFLINE`` when first imported, so in this
+    process only the offline flag is also set on the already imported
+    library; processes started from here inherit both. Stable Diffusion is
+    loaded with an explicit cache directory and offline flag either way.
+    Variables that are already set are kept.
+    
+    Args:
+        config: Configuration object
+    """
+    config = config or Config()
+    os.environ.setdefault('U2NET_HOME', os.path.join(config.MODEL_STORE_DIR, 'rembg'))
+    os.environ.setdefault('HF_HOME', os.path.join(config.MODEL_STORE_DIR, 'huggingface'))
+    if config.MODEL_OFFLINE:
+        os.environ['HF_HUB_OFFLINE'] = '1'
+        try:
+            import huggingface_hub.constants
+            huggingface_hub.constants.HF_HUB_OFFLINE = True
+        except ImportError:
+            pass
 
 
 class ModelManager:
     """Manages AI model loading and initialization"""
     
-    def __init__(self, config=None):
+    def __init__(self, config=None, use_server=True):
+        """
+        Args:
+            config: Configuration object
+            use_server (bool): Use the model server at
+                ``Config.MODEL_SERVER_SOCKET`` when one is configured. The
+                server itself runs with False.
+        """
         self.config = config or Config()
         self.device = self.config.DEVICE
         
@@ -21,47 +67,506 @@ class ModelManager:
         self.yolo_model = None
         self.sd_pipe = None
         self.smart_crop = None
+        self.rembg_session = None
+        
+        # Models live in the shared model server instead of this process
+        self.server = None
+        if use_server and self.config.MODEL_SERVER_SOCKET:
+            self.server = ModelServerClient(self.config)
+        
+        # Exported YOLO models keyed by their class list, most recent last
+        self.yolo_exports = OrderedDict()
+        self._export_lock = threading.Lock()  # Serializes exports
+        self._exports_cache_lock = threading.Lock()  # Guards yolo_exports only
+        self._load_lock = threading.RLock()
+        
+        # Memory footprint and last use of every loaded model
+        self.residency = ModelResidency(
+            budget_mb=self.config.MODEL_MEMORY_BUDGET_MB,
+            idle_ttl=self.config.MODEL_IDLE_TTL
+        )
+        
+        # Seconds and source of the last load of each model
+        self.load_times = {}
         
         print(f"Using device: {self.device}")
+    
+    def _record_load(self, name, start, source):
+        """Records how long a model took to load, for /status and /metrics."""
+        seconds = time.perf_counter() - start
+        self.load_times[name] = {'seconds': round(seconds, 3), 'source': source}
+        metrics.observe(f"models.{name}.load_seconds", seconds)
+        print(f"{name} loaded from {source} in {seconds:.1f}s.")
+    
+    def resolve_yolo_path(self):
+        """
+        Finds the YOLO weights.
+        
+        Relative paths are looked up in ``Config.MODEL_STORE_DIR`` first and
+        the working directory second. Weights found in neither are
+        downloaded into the store, unless ``Config.MODEL_OFFLINE`` is set.
+        
+        Returns:
+            str: Path to pass to ``YOLO``
+            
+        Raises:
+            FileNotFoundError: If the weights are missing in offline mode
+        """
+        path = self.config.YOLO_MODEL_PATH
+        if os.path.isabs(path):
+            candidates = [path]
+        else:
+            candidates = [os.path.join(self.config.MODEL_STORE_DIR, path), os.path.abspath(path)]
+        for candidate in candidates:
+            if os.path.exists(candidate):
+                return candidate
+        
+        if self.config.MODEL_OFFLINE:
+            raise FileNotFoundError(
+                f"YOLO weights '{path}' not found in {self.config.MODEL_STORE_DIR} and MODEL_OFFLINE is set. "
+                "Run 'python -m autorender_ai prefetch-models' first."
+            )
+        # Ultralytics downloads known weights to the path it is given
+        os.makedirs(os.path.dirname(candidates[0]), exist_ok=True)
+        return candidates[0]
+    
+    def get_sd_pipeline_path(self):
+        """
+        Returns where the pre-serialized Stable Diffusion pipeline is stored.
+        
+        The copy is saved in ``Config.SD_TORCH_DTYPE``, so each dtype gets its
+        own directory.
+        
+        Returns:
+            str: Directory below ``Config.MODEL_STORE_DIR``
+        """
+        name = self.config.SD_MODEL_ID.replace('/', '--')
+        dtype = str(self.config.SD_TORCH_DTYPE).replace('torch.', '')
+        return os.path.join(self.config.MODEL_STORE_DIR, 'pipelines', f"{name}-{dtype}")
         
     def load_yolo_model(self):
         """Load YOLO model for object detection"""
-        if self.yolo_model is None:
-            print("Loading YOLO model...")
-            try:
-                self.yolo_model = YOLO(self.config.YOLO_MODEL_PATH)
-                print("YOLO model loaded successfully.")
-            except Exception as e:
-                print(f"Failed to load YOLO model: {e}")
-                raise
-        return self.yolo_model
+        if self.server:
+            self.server.call('load', model='yolo')
+            return RemoteYOLO(self.server, None)
+        
+        with self._load_lock:
+            if self.yolo_model is None:
+                print("Loading YOLO model...")
+                start = time.perf_counter()
+                try:
+                    path = self.resolve_yolo_path()
+                    self.yolo_model = YOLO(path)
+                    self._store_text_encoder()
+                    self._record_load('yolo', start, path)
+                except Exception as e:
+                    print(f"Failed to load YOLO model: {e}")
+                    raise
+                self.residency.register(
+                    'yolo', estimate_model_size(self.yolo_model), self.unload_yolo_model
+                )
+            else:
+                self.residency.touch('yolo')
+            return self.yolo_model
+    
+    def _store_text_encoder(self):
+        """
+        Keeps YOLO-World's CLIP text encoder in the model store.
+        
+        YOLO-World loads the encoder with ``clip.load`` the first time
+        classes are set, which downloads to ~/.cache/clip. Loads are pointed
+        at the store's 'clip' directory instead, and fail in offline mode
+        when the weights are not there.
+        """
+        try:
+            import clip
+        except ImportError:
+            return  # Installed by ultralytics when first needed
+        if getattr(clip.load, 'model_store', None):
+            return
+        
+        load = clip.load
+        root = os.path.join(self.config.MODEL_STORE_DIR, 'clip')
+        
+        def load_from_store(name, *args, download_root=None, **kwargs):
+            download_root = download_root or root
+            url = clip.clip._MODELS.get(name)
+            if self.config.MODEL_OFFLINE and url and not os.path.exists(os.path.join(download_root, os.path.basename(url))):
+                raise FileNotFoundError(
+                    f"CLIP text encoder '{name}' not found in {download_root} and MODEL_OFFLINE is set. "
+                    "Run 'python -m autorender_ai prefetch-models' first."
+                )
+            return load(name, *args, download_root=download_root, **kwargs)
+        
+        load_from_store.model_store = root
+        clip.load = load_from_store
+    
+    def unload_yolo_model(self):
+        """Release the PyTorch YOLO model"""
+        with self._load_lock:
+            self.yolo_model = None
+    
+    def get_yolo_export_path(self, classes):
+        """
+        Returns where the exported YOLO model for a class list is stored.
+        
+        YOLO-World bakes its text-derived classes into exported graphs, so
+        each class list gets its own export, named after a digest of the
+        classes and the export settings.
+        
+        Args:
+            classes (list): Detection classes
+            
+        Returns:
+            str: Path to the .onnx file or OpenVINO model directory
+        """
+        config = self.config
+        digest = hashlib.sha1("\n".join(classes).encode("utf-8")).hexdigest()[:12]
+        stem = os.path.splitext(os.path.basename(config.YOLO_MODEL_PATH))[0]
+        
+        name = f"{stem}-{digest}-{config.YOLO_EXPORT_IMGSZ}"
+        if config.YOLO_EXPORT_DYNAMIC:
+            name += "-dynamic"
+        if config.YOLO_EXPORT_INT8:
+            name += "-int8"
+        
+        if config.YOLO_BACKEND == 'openvino':
+            return os.path.join(self.get_yolo_export_dir(), f"{name}_openvino_model")
+        return os.path.join(self.get_yolo_export_dir(), f"{name}.onnx")
+    
+    def get_yolo_export_dir(self):
+        """Returns ``Config.YOLO_EXPORT_DIR``, relative paths resolved in the model store."""
+        return os.path.join(self.config.MODEL_STORE_DIR, self.config.YOLO_EXPORT_DIR)
+    
+    def export_yolo_model(self, classes):
+        """
+        Exports the PyTorch YOLO model for a class list, reusing earlier exports.
+        
+        Args:
+            classes (list): Detection classes to bake into the export
+            
+        Returns:
+            str: Path to the exported model
+        """
+        path = self.get_yolo_export_path(classes)
+        if os.path.exists(path):
+            return path
+        
+        with self._export_lock:
+            if os.path.exists(path):
+                return path
+            
+            print(f"Exporting YOLO model to {self.config.YOLO_BACKEND} for {classes}...")
+            yolo_model = self.load_yolo_model()
+            yolo_model.set_classes(classes)
+            
+            # Ultralytics only quantizes OpenVINO exports, ONNX ones are
+            # quantized with ONNX Runtime after exporting
+            int8 = self.config.YOLO_EXPORT_INT8
+            quantize_onnx = int8 and self.config.YOLO_BACKEND == 'onnx'
+            export_args = {
+                'format': self.config.YOLO_BACKEND,
+                'imgsz': self.config.YOLO_EXPORT_IMGSZ,
+                'dynamic': self.config.YOLO_EXPORT_DYNAMIC,
+                'int8': int8 and not quantize_onnx,
+            }
+            if export_args['int8']:
+                export_args['data'] = self.config.YOLO_EXPORT_INT8_DATA
+            exported = str(yolo_model.export(**export_args)).rstrip(os.sep)
+            
+            # Exports are written next to the weights, move them into the store
+            os.makedirs(self.get_yolo_export_dir(), exist_ok=True)
+            if quantize_onnx:
+                self.quantize_onnx_model(exported, path)
+                os.remove(exported)
+            else:
+                shutil.move(exported, path)
+            print(f"YOLO model exported to {path}.")
+        return path
+    
+    def quantize_onnx_model(self, source, path):
+        """
+        Quantizes an exported ONNX model to int8 with ONNX Runtime.
+        
+        Weights are quantized ahead of time and activations per batch at run
+        time (dynamic quantization), so no calibration data is needed.
+        
+        Args:
+            source (str): fp32 .onnx file
+            path (str): Where to write the int8 model
+        """
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        
+        partial = f"{path}.partial-{os.getpid()}"
+        quantize_dynamic(source, partial, weight_type=QuantType.QUInt8)
+        os.replace(partial, path)
+    
+    def get_yolo_predictor(self, classes):
+        """
+        Returns a YOLO model ready to predict the given classes.
+        
+        With ``Config.YOLO_BACKEND`` set to 'torch' this is the shared PyTorch
+        model with its classes set. With 'onnx' or 'openvino' it is the
+        exported model for this class list, exported on first use. Both
+        return the same ultralytics Results from ``predict``.
+        
+        Args:
+            classes (list): Detection classes
+            
+        Returns:
+            ultralytics.YOLO: Model to call ``predict`` on, or a RemoteYOLO
+                with the same ``predict`` when using the model server
+        """
+        if self.server:
+            return RemoteYOLO(self.server, classes)
+        
+        if self.config.YOLO_BACKEND == 'torch':
+            yolo_model = self.load_yolo_model()
+            if yolo_model:
+                yolo_model.set_classes(classes)
+            return yolo_model
+        
+        key = tuple(classes)
+        name = f"yolo:{','.join(classes)}"
+        # Residency calls stay outside the cache lock: evicting a model runs
+        # its unload function, which takes that lock
+        with self._exports_cache_lock:
+            predictor = self.yolo_exports.get(key)
+            if predictor is not None:
+                self.yolo_exports.move_to_end(key)
+        if predictor is not None:
+            self.residency.touch(name)
+            return predictor
+        
+        path = self.export_yolo_model(list(classes))
+        predictor = YOLO(path, task='detect')
+        
+        dropped = []
+        with self._exports_cache_lock:
+            self.yolo_exports[key] = predictor
+            while len(self.yolo_exports) > self.config.YOLO_EXPORT_CACHE_SIZE:
+                old_key, _ = self.yolo_exports.popitem(last=False)
+                dropped.append(f"yolo:{','.join(old_key)}")
+        for old_name in dropped:
+            self.residency.forget(old_name)
+        
+        def unload():
+            with self._exports_cache_lock:
+                self.yolo_exports.pop(key, None)
+        
+        self.residency.register(name, estimate_model_size(path), unload)
+        return predictor
+    
+    def get_yolo_imgsz(self, imgsz=None):
+        """
+        Returns the inference size to use for a requested size.
+        
+        Static exports only accept the size they were exported at.
+        
+        Args:
+            imgsz (int): Requested inference size, None for the model's default
+            
+        Returns:
+            int: Size to pass to ``predict``, None to leave it unset
+        """
+        if self.config.YOLO_BACKEND != 'torch' and not self.config.YOLO_EXPORT_DYNAMIC:
+            return self.config.YOLO_EXPORT_IMGSZ
+        return imgsz
+    
+    def get_yolo_batch_size(self):
+        """
+        Returns the most images one ``predict`` call may take.
+        
+        Static exports have a fixed input shape of one image.
+        
+        Returns:
+            int: Largest batch, None for no limit
+        """
+        if self.config.YOLO_BACKEND != 'torch' and not self.config.YOLO_EXPORT_DYNAMIC:
+            return 1
+        return None
+    
+    def _place_sd_pipe(self, sd_pipe):
+        """
+        Moves the Stable Diffusion pipeline to the device or enables offload.
+        
+        ``Config.SD_OFFLOAD`` 'model' keeps whole submodels on the CPU until
+        they run, 'sequential' streams individual layers to the GPU. Both trade
+        speed for accelerator memory and need CUDA.
+        """
+        offload = self.config.SD_OFFLOAD
+        if offload in ('model', 'sequential') and self.device.type != 'cuda':
+            print(f"SD_OFFLOAD '{offload}' needs CUDA, loading on {self.device} instead.")
+            offload = 'none'
+        
+        if offload == 'model':
+            sd_pipe.enable_model_cpu_offload()
+        elif offload == 'sequential':
+            sd_pipe.enable_sequential_cpu_offload()
+        else:
+            sd_pipe = sd_pipe.to(self.device)
+        return sd_pipe
+    
+    def _load_sd_pipe(self):
+        """
+        Loads the Stable Diffusion pipeline on the CPU.
+        
+        A pre-serialized copy in the model store is preferred: it is already
+        in ``Config.SD_TORCH_DTYPE`` and stored as safetensors, which are
+        memory-mapped rather than read into fresh copies. Otherwise the
+        pipeline comes from the Hugging Face cache in the store, downloading
+        it unless ``Config.MODEL_OFFLINE`` is set, and with
+        ``Config.SD_PRESERIALIZE`` a copy is saved for the next start.
+        
+        Returns:
+            tuple: (pipeline, source path or model id)
+        """
+        options = {
+            'torch_dtype': self.config.SD_TORCH_DTYPE,
+            'low_cpu_mem_usage': self.config.SD_LOW_CPU_MEM_USAGE,
+        }
+        path = self.get_sd_pipeline_path()
+        if os.path.isdir(path):
+            pipe = StableDiffusionPipeline.from_pretrained(
+                path, local_files_only=True, use_safetensors=True, **options
+            )
+            return pipe, path
+        
+        pipe = StableDiffusionPipeline.from_pretrained(
+            self.config.SD_MODEL_ID,
+            cache_dir=os.path.join(self.config.MODEL_STORE_DIR, 'hub'),
+            local_files_only=self.config.MODEL_OFFLINE,
+            **options
+        )
+        if self.config.SD_PRESERIALIZE:
+            self.serialize_stable_diffusion(pipe)
+        return pipe, self.config.SD_MODEL_ID
+    
+    def serialize_stable_diffusion(self, pipe):
+        """
+        Saves a pipeline to the model store for faster later starts.
+        
+        The copy is written to a temporary directory first, so an interrupted
+        save is never picked up.
+        
+        Args:
+            pipe: Stable Diffusion pipeline, before it is moved or offloaded
+            
+        Returns:
+            str: Directory of the saved pipeline
+        """
+        path = self.get_sd_pipeline_path()
+        partial = f"{path}.partial-{os.getpid()}"
+        print(f"Saving Stable Diffusion pipeline to {path}...")
+        pipe.save_pretrained(partial, safe_serialization=True)
+        try:
+            os.rename(partial, path)
+        except OSError:
+            shutil.rmtree(partial, ignore_errors=True)  # Another worker saved it first
+        return path
     
     def load_stable_diffusion_model(self):
         """Load Stable Diffusion model for background generation"""
-        if self.sd_pipe is None:
-            print("Loading Stable Diffusion model (this may take a while)...")
-            try:
-                self.sd_pipe = StableDiffusionPipeline.from_pretrained(
-                    self.config.SD_MODEL_ID,
-                    torch_dtype=self.config.SD_TORCH_DTYPE
+        if self.server:
+            return RemoteDiffusionPipe(self.server) if self.server.call('load', model='stable_diffusion') else None
+        
+        with self._load_lock:
+            if self.sd_pipe is None:
+                print("Loading Stable Diffusion model (this may take a while)...")
+                start = time.perf_counter()
+                try:
+                    self.sd_pipe, source = self._load_sd_pipe()
+                    self.sd_pipe = self._place_sd_pipe(self.sd_pipe)
+                    self._record_load('stable_diffusion', start, source)
+                except Exception as e:
+                    print(f"Could not load Stable Diffusion model. /swap-background will not work. Error: {e}")
+                    self.sd_pipe = None
+                    return None
+                self.residency.register(
+                    'stable_diffusion', estimate_model_size(self.sd_pipe),
+                    self.unload_stable_diffusion_model
                 )
-                self.sd_pipe = self.sd_pipe.to(self.device)
-                print("Stable Diffusion model loaded successfully.")
-            except Exception as e:
-                print(f"Could not load Stable Diffusion model. /swap-background will not work. Error: {e}")
-                self.sd_pipe = None
-        return self.sd_pipe
+            else:
+                self.residency.touch('stable_diffusion')
+            return self.sd_pipe
+    
+    def unload_stable_diffusion_model(self):
+        """Release the Stable Diffusion pipeline"""
+        with self._load_lock:
+            if self.sd_pipe is not None and hasattr(self.sd_pipe, 'remove_all_hooks'):
+                # Drop any offload hooks so the weights can be collected
+                self.sd_pipe.remove_all_hooks()
+            self.sd_pipe = None
+    
+    def get_rembg_home(self):
+        """Returns the directory rembg keeps its weights in."""
+        data_home = os.environ.get('XDG_DATA_HOME', '~')
+        return os.environ.get('U2NET_HOME') or os.path.expanduser(os.path.join(data_home, '.u2net'))
+    
+    def load_rembg_session(self):
+        """Load the rembg segmentation session, reused across calls"""
+        with self._load_lock:
+            if self.rembg_session is None:
+                print(f"Loading rembg model {self.config.REMBG_MODEL}...")
+                start = time.perf_counter()
+                home = self.get_rembg_home()
+                if self.config.MODEL_OFFLINE and not glob.glob(
+                    os.path.join(home, f"{glob.escape(self.config.REMBG_MODEL)}*.onnx")
+                ):
+                    # rembg would download the missing weights
+                    raise FileNotFoundError(
+                        f"rembg model '{self.config.REMBG_MODEL}' not found in {home} and MODEL_OFFLINE is set. "
+                        "Run 'python -m autorender_ai prefetch-models' first."
+                    )
+                self.rembg_session = new_session(self.config.REMBG_MODEL)
+                self._record_load('rembg', start, self.config.REMBG_MODEL)
+                self.residency.register('rembg', 0, self.unload_rembg_session)
+            else:
+                self.residency.touch('rembg')
+            return self.rembg_session
+    
+    def unload_rembg_session(self):
+        """Release the rembg session"""
+        with self._load_lock:
+            self.rembg_session = None
+    
+    def segment(self, image, **options):
+        """
+        Removes an image's background with rembg.
+        
+        Args:
+            image (PIL.Image): Input image
+            **options: rembg ``remove`` options, e.g. only_mask=True
+            
+        Returns:
+            PIL.Image: RGBA cutout, or an L mask with only_mask
+        """
+        if self.server:
+            return self.server.segment(image, **options)
+        return remove(image, session=self.load_rembg_session(), **options)
     
     def load_smart_crop(self):
         """Load SmartCrop for intelligent image cropping"""
-        if self.smart_crop is None:
-            print("Initializing SmartCrop...")
-            self.smart_crop = smartcrop.SmartCrop()
-            print("SmartCrop initialized successfully.")
-        return self.smart_crop
+        with self._load_lock:
+            if self.smart_crop is None:
+                print("Initializing SmartCrop...")
+                self.smart_crop = smartcrop.SmartCrop()
+                print("SmartCrop initialized successfully.")
+                self.residency.register('smart_crop', 0, self.unload_smart_crop)
+            else:
+                self.residency.touch('smart_crop')
+            return self.smart_crop
+    
+    def unload_smart_crop(self):
+        """Release SmartCrop"""
+        with self._load_lock:
+            self.smart_crop = None
     
     def load_all_models(self):
         """Load all available models"""
+        if self.server:
+            return {**self.server.call('load', model='all'), 'smart_crop': self.load_smart_crop()}
+        
         models = {}
         
         try:
@@ -86,11 +591,27 @@ class ModelManager:
     
     def get_model_status(self):
         """Get the status of all models"""
+        if self.server:
+            try:
+                status = self.server.call('status')
+            except RuntimeError as e:
+                status = {'error': str(e)}
+            return {**status, 'smart_crop': self.smart_crop is not None, 'backend': 'server'}
+        
         return {
             'yolo': self.yolo_model is not None,
             'stable_diffusion': self.sd_pipe is not None,
             'smart_crop': self.smart_crop is not None,
-            'device': str(self.device)
+            'rembg': self.rembg_session is not None,
+            'backend': 'local',
+            'yolo_backend': self.config.YOLO_BACKEND,
+            'yolo_exports': len(self.yolo_exports),
+            'sd_offload': self.config.SD_OFFLOAD,
+            'device': str(self.device),
+            'model_store': self.config.MODEL_STORE_DIR,
+            'offline': self.config.MODEL_OFFLINE,
+            'load_times': dict(self.load_times),
+            'residency': self.residency.get_status()
         }
 
 
@@ -0,0 +1,570 @@
+"""
+Host-local model server shared by all gunicorn workers
+
+Without it every worker process loads its own YOLO, Stable Diffusion and
+rembg models, and their inference calls contend for the same cores. The
+model server is one process that owns the models and serves inference to
+the workers over a Unix socket. Image pixels travel through shared memory;
+only small messages go over the socket. Detection requests from all workers
+are grouped into batched YOLO predictions.
+
+Workers reach the server through ``ModelManager`` when
+``Config.MODEL_SERVER_SOCKET`` is set: its YOLO predictor, diffusion pipeline
+and segmentation calls are then proxies with the same interface as the
+local models, so the services do not change.
+
+Start the server with ``python -m autorender_ai serve-models``.
+"""
+
+import os
+import queue
+import secrets
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from multiprocessing.connection import AuthenticationError, Client, Listener
+from types import SimpleNamespace
+
+import torch
+
+from ..config import Config
+from ..utils.cancellation import OperationCancelled, check_cancelled, current_token
+from ..utils.cpu_pool import _from_shared, _return_shared, _to_shared, _unlink_shared
+from ..utils.metrics import metrics
+
+# Exceptions re-raised in the worker under their own type
+REMOTE_ERRORS = {'ValueError': ValueError, 'RuntimeError': RuntimeError}
+
+# Handlers whose result is a shared memory descriptor the worker unlinks
+SHARED_RESULTS = ('segment', 'generate')
+
+
+def get_authkey_path(config):
+    """Returns the file holding the generated key, next to the socket."""
+    return f"{config.MODEL_SERVER_SOCKET}.key"
+
+
+def get_authkey(config):
+    """
+    Returns the key the server and its clients authenticate with.
+
+    Connections unpickle what they receive, so the key must not be
+    guessable: it is ``Config.MODEL_SERVER_AUTHKEY``, or the random key the
+    server wrote next to its socket.
+
+    Raises:
+        RuntimeError: If no key is configured and the server has not written one
+    """
+    if config.MODEL_SERVER_AUTHKEY:
+        return config.MODEL_SERVER_AUTHKEY.encode("utf-8")
+    try:
+        with open(get_authkey_path(config), 'rb') as handle:
+            return handle.read()
+    except FileNotFoundError:
+        raise RuntimeError(
+            f"Model server key {get_authkey_path(config)} not found. Start the model server "
+            "first or set MODEL_SERVER_AUTHKEY."
+        )
+
+
+def create_authkey(config):
+    """
+    Returns the server's key, generating a random one when none is configured.
+
+    The generated key is written next to the socket, readable only by the
+    user running the server and its workers.
+    """
+    if config.MODEL_SERVER_AUTHKEY:
+        return config.MODEL_SERVER_AUTHKEY.encode("utf-8")
+    key = secrets.token_hex(32).encode("utf-8")
+    path = get_authkey_path(config)
+    if os.path.exists(path):
+        os.unlink(path)  # Left over from a previous run
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(descriptor, 'wb') as handle:
+        handle.write(key)
+    return key
+
+
+def _release_result(descriptor):
+    """Unlinks a result block the worker did not read, if it still exists."""
+    try:
+        _unlink_shared(descriptor)
+    except FileNotFoundError:
+        pass  # The worker read and unlinked it
+
+
+def _share_image(image):
+    """Copies an image into shared memory, converting modes arrays can't hold."""
+    if image.mode not in ("L", "RGB", "RGBA"):
+        image = image.convert("RGB")
+    return _to_shared(image)
+
+
+class _DetectionRequest:
+    """Images from one worker waiting to be predicted with one class list"""
+
+    def __init__(self, classes, images, conf, imgsz):
+        self.key = (tuple(classes), imgsz)
+        self.images = images
+        self.conf = conf
+        self.future = Future()
+
+
+class DetectionBatcher:
+    """Groups detection requests from all workers into batched predictions"""
+
+    def __init__(self, manager, max_batch=8, wait_ms=10):
+        """
+        Args:
+            manager (ModelManager): Local model manager owning YOLO
+            max_batch (int): Images per prediction
+            wait_ms (float): How long the first request of a batch waits for more
+        """
+        self.manager = manager
+        self.max_batch = max(1, max_batch)
+        self.wait = wait_ms / 1000
+        self.batches = 0
+        self.images = 0
+
+        self._queue = queue.Queue()
+        self._deferred = []  # Requests taken while batching another class list
+        self._thread = threading.Thread(target=self._run, name="detection-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, classes, images, conf, imgsz=None):
+        """
+        Queues images for prediction.
+
+        Args:
+            classes (list): Detection classes
+            images (list): PIL Images
+            conf (float): Minimum confidence for this request
+            imgsz (int): Inference size, None for the model's default
+
+        Returns:
+            Future: Resolves to one (xyxy, conf, cls) tuple of numpy arrays per image
+        """
+        request = _DetectionRequest(classes, images, conf, imgsz)
+        self._queue.put(request)
+        return request.future
+
+    def _next_batch(self):
+        """Takes the oldest request and whatever shares its key within the wait."""
+        first = self._deferred.pop(0) if self._deferred else self._queue.get()
+        batch = [first]
+        count = len(first.images)
+
+        # Deferred requests with the same key join without waiting
+        for request in list(self._deferred):
+            if count >= self.max_batch:
+                break
+            if request.key == first.key:
+                self._deferred.remove(request)
+                batch.append(request)
+                count += len(request.images)
+
+        deadline = time.monotonic() + self.wait
+        while count < self.max_batch:
+            try:
+                request = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if request.key == first.key:
+                batch.append(request)
+                count += len(request.images)
+            else:
+                self._deferred.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            self._predict(self._next_batch())
+
+    def _predict(self, batch):
+        """
+        Runs one prediction for a batch and resolves its requests.
+
+        Static exports take one image per call, so their batch is predicted
+        image by image.
+        """
+        classes, imgsz = batch[0].key
+        images = [image for request in batch for image in request.images]
+        try:
+            predictor = self.manager.get_yolo_predictor(list(classes))
+            if not predictor:
+                raise RuntimeError("YOLO model is not available.")
+
+            options = {'imgsz': imgsz} if imgsz else {}
+            conf = min(request.conf for request in batch)
+            step = self.manager.get_yolo_batch_size() or len(images)
+            results = []
+            for start in range(0, len(images), step):
+                results.extend(predictor.predict(
+                    images[start:start + step], conf=conf, verbose=False, **options
+                ))
+            self.batches += 1
+            self.images += len(images)
+            metrics.observe('model_server.batch_images', len(images))
+
+            offset = 0
+            for request in batch:
+                arrays = []
+                for result in results[offset:offset + len(request.images)]:
+                    boxes = result.boxes
+                    xyxy = boxes.xyxy.cpu().numpy()
+                    conf = boxes.conf.cpu().numpy()
+                    cls = boxes.cls.cpu().numpy()
+                    # The batch ran at the lowest threshold, apply this request's
+                    keep = conf >= request.conf
+                    arrays.append((xyxy[keep], conf[keep], cls[keep]))
+                offset += len(request.images)
+                request.future.set_result(arrays)
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+
+
+class ModelServer:
+    """Owns the models and serves inference to worker processes"""
+
+    def __init__(self, manager, config=None):
+        """
+        Args:
+            manager (ModelManager): Local model manager, created with
+                ``use_server=False``
+            config: Configuration object
+        """
+        self.manager = manager
+        self.config = config or manager.config
+        self.address = self.config.MODEL_SERVER_SOCKET
+        self.batcher = DetectionBatcher(
+            manager, self.config.MODEL_SERVER_MAX_BATCH, self.config.MODEL_SERVER_BATCH_WAIT_MS
+        )
+
+        # Segmentation and diffusion run one at a time instead of contending
+        self._segment_lock = threading.Lock()
+        self._generate_lock = threading.Lock()
+        self._connections_lock = threading.Lock()
+        self.connections = 0
+
+        self.handlers = {
+            'detect': self._detect,
+            'segment': self._segment,
+            'generate': self._generate,
+            'load': self._load,
+            'status': self._status,
+        }
+
+    def serve_forever(self):
+        """Accepts worker connections until the process is stopped."""
+        if os.path.exists(self.address):
+            os.unlink(self.address)  # Left over from a previous run
+
+        # The socket and key file are created accessible to this user only
+        umask = os.umask(0o077)
+        try:
+            authkey = create_authkey(self.config)
+            listener = Listener(self.address, family='AF_UNIX', authkey=authkey)
+        finally:
+            os.umask(umask)
+
+        with listener:
+            print(f"Model server listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError) as e:
+                    print(f"Rejected model server connection: {e}")
+                    continue
+                threading.Thread(
+                    target=self._serve_connection, args=(conn,), name="model-server-conn", daemon=True
+                ).start()
+
+    def _serve_connection(self, conn):
+        """
+        Answers one worker connection's requests in order.
+
+        A shared-memory result stays pending until the worker sends its next
+        request, by which time it has read and unlinked it. If the worker
+        gave up on the request and closed the connection instead, the server
+        unlinks the block.
+        """
+        with self._connections_lock:
+            self.connections += 1
+        pending = None
+        try:
+            with conn:
+                while True:
+                    op, kwargs = conn.recv()
+                    if pending is not None:
+                        _release_result(pending)
+                        pending = None
+                    try:
+                        result = self.handlers[op](conn, **kwargs)
+                        reply = ('ok', result)
+                        if op in SHARED_RESULTS:
+                            pending = result
+                    except OperationCancelled as e:
+                        reply = ('cancelled', str(e))
+                    except Exception as e:
+                        reply = ('error', type(e).__name__, str(e))
+                    conn.send(reply)
+        except (EOFError, OSError):
+            pass  # The worker closed the connection, possibly mid-request
+        finally:
+            if pending is not None:
+                _release_result(pending)
+            with self._connections_lock:
+                self.connections -= 1
+
+    def _detect(self, conn, classes, images, conf, imgsz=None):
+        """Predicts shared-memory images as part of a cross-worker batch."""
+        images = [_from_shared(descriptor) for descriptor in images]
+        return self.batcher.submit(classes, images, conf, imgsz).result()
+
+    def _segment(self, conn, image, options):
+        """Runs rembg on a shared-memory image."""
+        with self._segment_lock:
+            result = self.manager.segment(_from_shared(image), **options)
+        return _return_shared(result)
+
+    def _generate(self, conn, prompt, width, height, callback, tensor_inputs, options):
+        """
+        Runs Stable Diffusion, reporting every step to the worker when it
+        passed a callback and waiting for its go-ahead. A worker that goes
+        away or whose callback fails closes the connection, which stops
+        generation at that step.
+        """
+        sd_pipe = self.manager.load_stable_diffusion_model()
+        if not sd_pipe:
+            raise RuntimeError("Stable Diffusion model is not available.")
+
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            conn.send(('step', {
+                'step': step,
+                'timestep': float(timestep),
+                'num_timesteps': pipe.num_timesteps,
+                'tensors': {name: callback_kwargs[name].float().cpu().numpy() for name in tensor_inputs}
+            }))
+            conn.recv()  # Raises EOFError if the worker stopped
+            return callback_kwargs
+
+        if callback:
+            options = {
+                **options,
+                'callback_on_step_end': on_step_end,
+                'callback_on_step_end_tensor_inputs': tensor_inputs or ['latents']
+            }
+        with self._generate_lock:
+            image = sd_pipe(prompt, width=width, height=height, **options).images[0]
+        return _return_shared(image.convert("RGB"))
+
+    def _load(self, conn, model):
+        """Loads a model and reports whether it is available."""
+        if model == 'yolo':
+            return self.manager.load_yolo_model() is not None
+        if model == 'stable_diffusion':
+            return self.manager.load_stable_diffusion_model() is not None
+        if model == 'all':
+            return {name: loaded is not None for name, loaded in self.manager.load_all_models().items()}
+        raise ValueError(f"Unknown model '{model}'.")
+
+    def _status(self, conn):
+        """Reports the server's models and batching."""
+        return {
+            **self.manager.get_model_status(),
+            'server': {
+                'pid': os.getpid(),
+                'connections': self.connections,
+                'detection_batches': self.batcher.batches,
+                'detection_images': self.batcher.images,
+            }
+        }
+
+
+class ModelServerClient:
+    """Sends inference requests from a worker to the model server"""
+
+    def __init__(self, config):
+        """
+        Args:
+            config: Configuration object with ``MODEL_SERVER_SOCKET``
+        """
+        self.config = config
+        self.address = config.MODEL_SERVER_SOCKET
+        self.authkey = None  # Read on first connect, the server may start later
+
+        # Connections are not thread-safe, each request borrows an idle one
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection for one request.
+
+        A connection left mid-request by an exception, e.g. a cancellation,
+        is closed rather than reused, which also tells the server to stop.
+        """
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            if self.authkey is None:
+                self.authkey = get_authkey(self.config)
+            conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        with self._lock:
+            self._idle.append(conn)
+
+    @staticmethod
+    def receive(conn):
+        """Waits for the next message, giving up when the active cancel token does."""
+        if current_token() is None:
+            return conn.recv()
+        while not conn.poll(0.05):
+            check_cancelled()
+        return conn.recv()
+
+    @staticmethod
+    def unwrap(message):
+        """Returns a reply's value or raises the server's error."""
+        status = message[0]
+        if status == 'ok':
+            return message[1]
+        if status == 'cancelled':
+            raise OperationCancelled(message[1])
+        _, kind, text = message
+        raise REMOTE_ERRORS.get(kind, RuntimeError)(text)
+
+    def call(self, op, read_result=None, **kwargs):
+        """
+        Runs one request on the server.
+
+        Args:
+            op (str): Handler name, see ``ModelServer.handlers``
+            read_result (callable): Applied to the result before the
+                connection is released. Shared-memory results must be read
+                here: the server unlinks them on the connection's next request
+            **kwargs: Handler arguments
+
+        Returns:
+            The handler's result
+
+        Raises:
+            OperationCancelled: If the active cancel token fires first
+            RuntimeError: If the server failed or cannot be reached
+        """
+        try:
+            with self.connection() as conn:
+                conn.send((op, kwargs))
+                result = self.unwrap(self.receive(conn))
+                return read_result(result) if read_result else result
+        except (ConnectionError, FileNotFoundError, EOFError) as e:
+            raise RuntimeError(f"Model server at {self.address} is not reachable: {e}")
+
+    def segment(self, image, **options):
+        """Runs rembg in the server, see ``ModelManager.segment``."""
+        shm, descriptor = _share_image(image)
+        try:
+            return self.call(
+                'segment', read_result=lambda result: _from_shared(result, unlink=True),
+                image=descriptor, options=options
+            )
+        finally:
+            shm.close()
+            shm.unlink()
+
+
+class RemoteYOLO:
+    """Stands in for a YOLO model with its classes set, predicting in the server"""
+
+    def __init__(self, client, classes):
+        self.client = client
+        self.classes = list(classes or [])
+
+    def predict(self, source, conf=0.25, imgsz=None, verbose=False, **kwargs):
+        """
+        Predicts one image or a list of images.
+
+        Returns:
+            list: One result per image with ``boxes.xyxy``, ``boxes.conf``
+                and ``boxes.cls`` tensors, like ultralytics Results
+        """
+        images = source if isinstance(source, list) else [source]
+        shared = [_share_image(image) for image in images]
+        try:
+            arrays = self.client.call(
+                'detect', classes=self.classes, images=[d for _, d in shared], conf=conf, imgsz=imgsz
+            )
+        finally:
+            for shm, _ in shared:
+                shm.close()
+                shm.unlink()
+
+        return [
+            SimpleNamespace(boxes=SimpleNamespace(
+                xyxy=torch.from_numpy(xyxy), conf=torch.from_numpy(scores), cls=torch.from_numpy(cls)
+            ))
+            for xyxy, scores, cls in arrays
+        ]
+
+
+class RemoteDiffusionPipe:
+    """Stands in for a diffusers pipeline, generating in the server"""
+
+    def __init__(self, client):
+        self.client = client
+        self.num_timesteps = None
+
+    def __call__(self, prompt, width=None, height=None, callback_on_step_end=None,
+                 callback_on_step_end_tensor_inputs=None, **kwargs):
+        """
+        Generates an image. Step callbacks run here in the worker with copies
+        of the requested tensors; changes they make are not sent back.
+
+        Returns:
+            SimpleNamespace: With ``images``, a list of one PIL Image
+        """
+        request = {
+            'prompt': prompt,
+            'width': width,
+            'height': height,
+            'callback': callback_on_step_end is not None,
+            'tensor_inputs': list(callback_on_step_end_tensor_inputs or []),
+            'options': kwargs
+        }
+        try:
+            with self.client.connection() as conn:
+                conn.send(('generate', request))
+                while True:
+                    message = self.client.receive(conn)
+                    if message[0] != 'step':
+                        image = _from_shared(self.client.unwrap(message), unlink=True)
+                        return SimpleNamespace(images=[image])
+
+                    step = message[1]
+                    self.num_timesteps = step['num_timesteps']
+                    tensors = {name: torch.from_numpy(value) for name, value in step['tensors'].items()}
+                    callback_on_step_end(self, step['step'], step['timestep'], tensors)
+                    conn.send('continue')
+        except (ConnectionError, FileNotFoundError, EOFError) as e:
+            raise RuntimeError(f"Model server at {self.client.address} is not reachable: {e}")
+
+
+def serve(config=None):
+    """Runs a model server with a local model manager in this process."""
+    from .ai_models import ModelManager
+    from ..utils.thread_budget import ThreadBudget
+
+    config = config or Config()
+    # The server runs all inference on the host, so it gets all the cores
+    ThreadBudget(config, workers=1).apply()
+    ModelServer(ModelManager(config, use_server=False), config).serve_forever()
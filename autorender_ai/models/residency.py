@@ -0,0 +1,199 @@
+"""
+Memory-budgeted model residency
+
+Tracks the memory footprint and last use of every loaded model. When the
+configured budget is exceeded the least recently used models are unloaded,
+and models idle for longer than the TTL are unloaded by a background sweeper.
+"""
+
+import os
+import threading
+import time
+
+import torch
+
+
+def estimate_model_size(model):
+    """
+    Estimates the memory held by a model's weights.
+
+    Args:
+        model: A torch module, a diffusers pipeline, an ultralytics YOLO model,
+            or a path to exported model files
+
+    Returns:
+        int: Size in bytes, 0 if unknown
+    """
+    if isinstance(model, str):
+        if os.path.isdir(model):
+            return sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(model) for name in names
+            )
+        return os.path.getsize(model) if os.path.exists(model) else 0
+
+    # Diffusers pipelines hold their modules in `components`
+    components = getattr(model, 'components', None)
+    if isinstance(components, dict):
+        return sum(estimate_model_size(c) for c in components.values() if c is not None)
+
+    if isinstance(model, torch.nn.Module):
+        tensors = list(model.parameters()) + list(model.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    return 0
+
+
+class ModelResidency:
+    """Keeps loaded models within a memory budget and unloads idle ones"""
+
+    def __init__(self, budget_mb=0, idle_ttl=0):
+        """
+        Args:
+            budget_mb (int): Memory budget for all models, 0 for unlimited
+            idle_ttl (int): Seconds after which an unused model is unloaded,
+                0 to keep models loaded
+        """
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self.idle_ttl = idle_ttl
+
+        self.entries = {}
+        self._lock = threading.RLock()
+        self._sweeper = None
+
+    def register(self, name, size_bytes, unload):
+        """
+        Records a newly loaded model and enforces the budget.
+
+        Args:
+            name (str): Model name
+            size_bytes (int): Memory footprint
+            unload (callable): Releases the model when called
+        """
+        now = time.time()
+        with self._lock:
+            self.entries[name] = {
+                'size_bytes': size_bytes,
+                'loaded_at': now,
+                'last_used': now,
+                'unload': unload
+            }
+            print(f"Model '{name}' resident ({size_bytes / 1024 ** 2:.0f} MB).")
+
+        self.enforce_budget(keep=name)
+        self._start_sweeper()
+
+    def touch(self, name):
+        """Marks a model as just used."""
+        with self._lock:
+            if name in self.entries:
+                self.entries[name]['last_used'] = time.time()
+
+    def forget(self, name):
+        """Drops a model's entry without calling its unload function."""
+        with self._lock:
+            self.entries.pop(name, None)
+
+    def evict(self, name, reason):
+        """
+        Unloads a model and frees cached accelerator memory.
+
+        Args:
+            name (str): Model name
+            reason (str): Logged reason for the eviction
+        """
+        with self._lock:
+            entry = self.entries.pop(name, None)
+        if entry is None:
+            return
+
+        print(f"Unloading model '{name}' ({reason}).")
+        entry['unload']()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    @property
+    def resident_bytes(self):
+        """Total footprint of all resident models."""
+        with self._lock:
+            return sum(entry['size_bytes'] for entry in self.entries.values())
+
+    def enforce_budget(self, keep=None):
+        """
+        Evicts least recently used models until the budget is met.
+
+        Victims are chosen under the lock but unloaded after releasing it:
+        unload functions take the model manager's locks, which are held
+        while models are touched or registered.
+
+        Args:
+            keep (str): Model that must stay loaded, usually the one just loaded
+        """
+        if not self.budget_bytes:
+            return
+
+        victims = []
+        with self._lock:
+            excess = self.resident_bytes - self.budget_bytes
+            candidates = sorted(
+                (n for n in self.entries if n != keep),
+                key=lambda n: self.entries[n]['last_used']
+            )
+            for name in candidates:
+                if excess <= 0:
+                    break
+                victims.append(name)
+                excess -= self.entries[name]['size_bytes']
+
+        for name in victims:
+            self.evict(name, "memory budget exceeded")
+
+    def evict_idle(self):
+        """Unloads every model unused for longer than the idle TTL."""
+        if not self.idle_ttl:
+            return
+
+        cutoff = time.time() - self.idle_ttl
+        with self._lock:
+            idle = [n for n, e in self.entries.items() if e['last_used'] < cutoff]
+        for name in idle:
+            self.evict(name, f"idle for more than {self.idle_ttl}s")
+
+    def _start_sweeper(self):
+        """Starts the idle sweeper thread once, if a TTL is configured."""
+        if not self.idle_ttl or self._sweeper is not None:
+            return
+
+        interval = max(1, min(self.idle_ttl / 2, 60))
+
+        def sweep():
+            while True:
+                time.sleep(interval)
+                self.evict_idle()
+
+        self._sweeper = threading.Thread(target=sweep, name="model-residency", daemon=True)
+        self._sweeper.start()
+
+    def get_status(self):
+        """
+        Reports resident models for /status.
+
+        Returns:
+            dict: Budget, total resident size and per-model size and last use
+        """
+        now = time.time()
+        with self._lock:
+            models = {
+                name: {
+                    'resident_mb': round(entry['size_bytes'] / 1024 ** 2, 1),
+                    'last_used': entry['last_used'],
+                    'idle_seconds': round(now - entry['last_used'], 1)
+                }
+                for name, entry in self.entries.items()
+            }
+        return {
+            'budget_mb': self.budget_bytes // (1024 * 1024),
+            'idle_ttl': self.idle_ttl,
+            'resident_mb': round(self.resident_bytes / 1024 ** 2, 1),
+            'models': models
+        }
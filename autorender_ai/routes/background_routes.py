@@ -2,27 +2,46 @@
 Background processing routes
 """
 
-from flask import Blueprint, jsonify, request
+import json
+import os
+import shutil
+import tempfile
+
+from flask import Blueprint, Response, jsonify, request
 
 from ..services.background_service import BackgroundService
 from ..services.image_utils import ImageUtils
+from ..services.video_service import IMAGE_EXTENSIONS, VIDEO_EXTENSIONS, VIDEO_FORMATS, VideoService
+from ..utils.cancellation import CancelToken, OperationCancelled, cancelled_response
+from ..utils.output_encoder import OutputEncoder
 
 # Create blueprint
 background_bp = Blueprint('background', __name__)
 
-# Initialize service
+# Initialize services
 bg_service = BackgroundService()
+video_service = VideoService()
 
 
 @background_bp.route("/remove-bg", methods=["POST"])
 def remove_bg_endpoint():
     """
     Removes the background from an image.
-    Params: image or image_url, bg_color (optional hex), edge_blur_radius (optional int).
+    Params: image or image_url, bg_color (optional hex), edge_blur_radius (optional int),
+    full_resolution (optional bool, keep the input's resolution up to
+    Config.FULL_RES_MAX_SIZE), encoding (optional preset) and encoder options,
+    see OutputEncoder.from_request.
+    Header: X-Request-Timeout (optional seconds, defaults to Config.REQUEST_TIMEOUT).
     """
     try:
+        cancel_token = CancelToken.from_request(bg_service.config)
         image, form = ImageUtils.load_image_from_request()
-        image = ImageUtils.compress_image(image)
+        full_resolution = str(form.get("full_resolution", "")).lower() in ("1", "true", "yes", "on")
+        if full_resolution:
+            image = ImageUtils.compress_image(image, max_size=bg_service.config.FULL_RES_MAX_SIZE)
+        else:
+            image = ImageUtils.compress_image(image)
+        encoder = OutputEncoder.from_request(form, 'remove-bg', bg_service.config)
 
         # Get parameters
         bg_color = form.get("bg_color")
@@ -32,29 +51,103 @@ def remove_bg_endpoint():
         final_image = bg_service.remove_background(
             image, 
             bg_color=bg_color, 
-            edge_blur_radius=edge_blur_radius
+            edge_blur_radius=edge_blur_radius,
+            cancel_token=cancel_token,
+            full_resolution=full_resolution
         )
 
         return jsonify({
             "success": True,
-            "image": ImageUtils.image_to_base64(final_image)
+            "image": encoder.to_base64(final_image),
+            "encoding": encoder.report()
         })
         
+    except OperationCancelled as e:
+        return cancelled_response(e)
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@background_bp.route("/remove-bg/video", methods=["POST"])
+def remove_bg_video_endpoint():
+    """
+    Removes the background of a video or frame sequence.
+    Params (multipart/form-data): video (file) or frames (several image files,
+    in upload order), format (optional 'webp', 'apng', 'png' or 'mp4'),
+    change_threshold (optional float, see Config.VIDEO_CHANGE_THRESHOLD),
+    bg_color (optional hex, required for mp4).
+    Returns the encoded file, with frame counts in the X-Frames,
+    X-Frames-Segmented and X-Frames-Skipped headers.
+    """
+    workdir = tempfile.mkdtemp(prefix="autorender-video-")
+    try:
+        cancel_token = CancelToken.from_request(video_service.config)
+        form = request.form
+
+        format = form.get('format', video_service.config.VIDEO_FORMAT).lower()
+        if format not in VIDEO_FORMATS:
+            return jsonify({"error": f"'format' must be one of: {', '.join(VIDEO_FORMATS)}."}), 400
+        change_threshold = form.get('change_threshold')
+        change_threshold = float(change_threshold) if change_threshold not in (None, '') else None
+
+        # OpenCV reads from files, so uploads are written to a scratch directory
+        if 'video' in request.files:
+            upload = request.files['video']
+            source = os.path.join(workdir, "input" + os.path.splitext(upload.filename or '')[1])
+            upload.save(source)
+        elif 'frames' in request.files:
+            source = os.path.join(workdir, "frames")
+            os.makedirs(source)
+            for index, upload in enumerate(request.files.getlist('frames')):
+                extension = os.path.splitext(upload.filename or '')[1].lower()
+                if extension not in IMAGE_EXTENSIONS:
+                    extension = ".png"
+                upload.save(os.path.join(source, f"{index:05d}{extension}"))
+        else:
+            return jsonify({"error": "No video provided. Upload a 'video' file or several 'frames' images."}), 400
+
+        output = os.path.join(workdir, "output" + VIDEO_EXTENSIONS[format])
+        stats = video_service.process_video(
+            source, output, format, change_threshold, form.get("bg_color"), cancel_token
+        )
+        with open(output, 'rb') as f:
+            data = f.read()
+
+        return Response(data, mimetype=VIDEO_FORMATS[format], headers={
+            "Content-Disposition": f"attachment; filename=output{VIDEO_EXTENSIONS[format]}",
+            "X-Frames": str(stats['frames']),
+            "X-Frames-Segmented": str(stats['segmented']),
+            "X-Frames-Skipped": str(stats['skipped'])
+        })
+
+    except OperationCancelled as e:
+        return cancelled_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        print(f"Error in /remove-bg/video: {e}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
 @background_bp.route("/swap-background", methods=["POST"])
 def swap_background_endpoint():
     """
     Swaps the background of an image using a generative AI prompt.
-    Params: image or image_url, prompt, width (optional), height (optional).
+    Params: image or image_url, prompt, width (optional), height (optional),
+    encoding (optional preset) and encoder options, see OutputEncoder.from_request.
+    Header: X-Request-Timeout (optional seconds, defaults to Config.REQUEST_TIMEOUT).
     """
     try:
+        cancel_token = CancelToken.from_request(bg_service.config)
         image, form = ImageUtils.load_image_from_request()
         image = ImageUtils.compress_image(image, max_size=768)  # SD works best with smaller images
+        encoder = OutputEncoder.from_request(form, 'swap-background', bg_service.config)
 
         # Get parameters
         prompt = form.get('prompt')
@@ -69,14 +162,18 @@ def swap_background_endpoint():
             image,
             prompt=prompt,
             width=width,
-            height=height
+            height=height,
+            cancel_token=cancel_token
         )
 
         return jsonify({
             "success": True,
-            "image": ImageUtils.image_to_base64(final_image, format="JPEG")
+            "image": encoder.to_base64(final_image),
+            "encoding": encoder.report()
         })
         
+    except OperationCancelled as e:
+        return cancelled_response(e)
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except RuntimeError as e:
@@ -84,3 +181,81 @@ def swap_background_endpoint():
     except Exception as e:
         print(f"Error in /swap-background: {e}")
         return jsonify({"error": str(e)}), 500
+
+
+def format_sse(event, data):
+    """
+    Formats one Server-Sent Event.
+    
+    Args:
+        event (str): Event name
+        data (dict): JSON-serializable payload
+        
+    Returns:
+        str: Event in text/event-stream framing
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@background_bp.route("/swap-background/stream", methods=["POST"])
+def swap_background_stream_endpoint():
+    """
+    Streams progress of a background swap as Server-Sent Events.
+    Params: image or image_url, prompt, width (optional), height (optional),
+    preview_every (optional int, 0 disables previews), encoding (optional preset
+    for the result) and encoder options.
+    Events: progress, preview (low-resolution JPEG), result (final image), error.
+    Closing the connection stops generation at the next diffusion step.
+    """
+    try:
+        cancel_token = CancelToken.from_request(bg_service.config)
+        image, form = ImageUtils.load_image_from_request()
+        image = ImageUtils.compress_image(image, max_size=768)  # SD works best with smaller images
+        encoder = OutputEncoder.from_request(form, 'swap-background', bg_service.config)
+
+        # Get parameters
+        prompt = form.get('prompt')
+        if not prompt:
+            return jsonify({"error": "A 'prompt' is required."}), 400
+
+        width = int(form.get('width', image.width))
+        height = int(form.get('height', image.height))
+        preview_every = form.get('preview_every')
+        preview_every = int(preview_every) if preview_every not in (None, '') else None
+
+        events = bg_service.swap_background_stream(
+            image,
+            prompt=prompt,
+            width=width,
+            height=height,
+            preview_every=preview_every,
+            cancel_token=cancel_token
+        )
+
+    except OperationCancelled as e:
+        return cancelled_response(e)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        print(f"Error in /swap-background/stream: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    def stream():
+        try:
+            for event, data in events:
+                if event == 'result':
+                    data = {**data, 'image': encoder.to_base64(data['image']), 'encoding': encoder.report()}
+                elif 'image' in data:
+                    data = {**data, 'image': ImageUtils.image_to_base64(data['image'], format="JPEG")}
+                yield format_sse(event, data)
+        finally:
+            # Stops generation if the client disconnected mid-stream
+            events.close()
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -6,6 +6,8 @@ from flask import Blueprint, jsonify, request
 
 from ..services.detection_service import DetectionService
 from ..services.image_utils import ImageUtils
+from ..utils.cancellation import CancelToken, OperationCancelled, cancelled_response
+from ..utils.output_encoder import OutputEncoder
 
 # Create blueprint
 detection_bp = Blueprint('detection', __name__)
@@ -14,27 +16,111 @@ detection_bp = Blueprint('detection', __name__)
 detection_service = DetectionService()
 
 
+def get_prompts(form):
+    """
+    Reads one or more prompts from the request.
+    
+    Accepts a JSON list in 'prompts', repeated 'prompts' form fields, or a
+    comma-separated string in 'prompts'. A single 'prompt' is one class,
+    commas included.
+    
+    Returns:
+        list: Class names, empty if none were provided
+        
+    Raises:
+        ValueError: If the prompts given are all blank
+    """
+    prompts = form.get('prompts')
+    if hasattr(form, 'getlist') and len(form.getlist('prompts')) > 1:
+        prompts = form.getlist('prompts')
+    if not prompts:
+        prompt = form.get('prompt')
+        if not prompt:
+            return []
+        prompts = [prompt]
+    
+    return DetectionService.normalize_prompts(prompts)
+
+
+def get_confidences(form):
+    """
+    Reads optional confidence thresholds from the request.
+    
+    'confidence' may be a single number for all classes, a JSON object mapping
+    class to threshold, or a form string like "shoe:0.3,bag:0.6".
+    
+    Returns:
+        float | dict | None: Thresholds to pass to the detection service
+    """
+    confidence = form.get('confidence')
+    if confidence is None or confidence == '':
+        return None
+    if isinstance(confidence, (dict, int, float)):
+        return confidence
+    
+    if ':' not in confidence:
+        return float(confidence)
+    
+    confidences = {}
+    for item in confidence.split(','):
+        name, _, value = item.rpartition(':')
+        if not name.strip():
+            raise ValueError(f"Invalid confidence entry: '{item}'")
+        confidences[name.strip()] = float(value)
+    return confidences
+
+
 @detection_bp.route("/detect", methods=["POST"])
 def detect_endpoint():
     """
     Detects an object via a prompt and crops to it.
-    Params: image or image_url, prompt
+    Params: image or image_url, prompt or prompts (list), confidence (optional),
+    tiled (optional 'on', 'off' or 'auto'), encoding (optional preset) and
+    encoder options.
+    With several prompts, returns every crop grouped by class.
     """
     try:
+        cancel_token = CancelToken.from_request(detection_service.config)
         image, form = ImageUtils.load_image_from_request()
-        prompt = form.get('prompt')
+        encoder = OutputEncoder.from_request(form, 'detect', detection_service.config)
+        prompts = get_prompts(form)
         
-        if not prompt:
+        if not prompts:
             return jsonify({"error": "Prompt is required."}), 400
-
-        # Detect and crop object
-        cropped = detection_service.detect_and_crop(image, prompt)
+        confidences = get_confidences(form)
+        tiled = form.get('tiled')
+
+        if len(prompts) == 1:
+            # Detect and crop object
+            cropped = detection_service.detect_and_crop(
+                image, prompts[0], confidences, tiled, cancel_token
+            )
+
+            return jsonify({
+                "success": True,
+                "image": encoder.to_base64(cropped),
+                "encoding": encoder.report()
+            })
+
+        # Detect all classes in one pass and crop each detection
+        crops = detection_service.detect_and_crop_classes(
+            image, prompts, confidences, tiled, cancel_token
+        )
+
+        encoded = {
+            name: [encoder.to_base64(crop) for crop in class_crops]
+            for name, class_crops in crops.items()
+        }
 
         return jsonify({
             "success": True,
-            "image": ImageUtils.image_to_base64(cropped)
+            "crops": encoded,
+            "count": sum(len(class_crops) for class_crops in crops.values()),
+            "encoding": encoder.report()
         })
         
+    except OperationCancelled as e:
+        return cancelled_response(e)
     except ValueError as e:
         if "No matching object found" in str(e):
             return jsonify({"error": str(e)}), 404
@@ -47,20 +133,26 @@ def detect_endpoint():
 def face_crop_endpoint():
     """
     Detects and crops faces from an image.
-    Params: image or image_url, padding (optional int)
+    Params: image or image_url, padding (optional int), encoding (optional
+    preset) and encoder options
     """
     try:
+        cancel_token = CancelToken.from_request(detection_service.config)
         image, form = ImageUtils.load_image_from_request()
+        encoder = OutputEncoder.from_request(form, 'face-crop', detection_service.config)
         padding = int(form.get('padding', 50))
 
         # Detect and crop face
-        cropped = detection_service.face_crop(image, padding=padding)
+        cropped = detection_service.face_crop(image, padding=padding, cancel_token=cancel_token)
 
         return jsonify({
             "success": True,
-            "image": ImageUtils.image_to_base64(cropped)
+            "image": encoder.to_base64(cropped),
+            "encoding": encoder.report()
         })
         
+    except OperationCancelled as e:
+        return cancelled_response(e)
     except ValueError as e:
         if "No face detected" in str(e):
             return jsonify({"error": str(e)}), 404
@@ -73,10 +165,13 @@ def face_crop_endpoint():
 def smart_crop_endpoint():
     """
     Performs smart cropping on an image.
-    Params: image or image_url, width (int), height (int)
+    Params: image or image_url, width (int), height (int), encoding (optional
+    preset) and encoder options
     """
     try:
+        cancel_token = CancelToken.from_request(detection_service.config)
         image, form = ImageUtils.load_image_from_request()
+        encoder = OutputEncoder.from_request(form, 'smart-crop', detection_service.config)
         
         # Get required parameters
         width = form.get('width')
@@ -89,13 +184,16 @@ def smart_crop_endpoint():
         height = int(height)
 
         # Perform smart crop
-        cropped = detection_service.smart_crop(image, width, height)
+        cropped = detection_service.smart_crop(image, width, height, cancel_token=cancel_token)
 
         return jsonify({
             "success": True,
-            "image": ImageUtils.image_to_base64(cropped)
+            "image": encoder.to_base64(cropped),
+            "encoding": encoder.report()
         })
         
+    except OperationCancelled as e:
+        return cancelled_response(e)
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
@@ -106,23 +204,29 @@ def smart_crop_endpoint():
 def detect_info_endpoint():
     """
     Gets detection information without cropping.
-    Params: image or image_url, prompt
+    Params: image or image_url, prompt or prompts (list), confidence (optional),
+    tiled (optional 'on', 'off' or 'auto')
     """
     try:
+        cancel_token = CancelToken.from_request(detection_service.config)
         image, form = ImageUtils.load_image_from_request()
-        prompt = form.get('prompt')
+        prompts = get_prompts(form)
         
-        if not prompt:
+        if not prompts:
             return jsonify({"error": "Prompt is required."}), 400
 
         # Get detection information
-        detection_info = detection_service.get_detection_info(image, prompt)
+        detection_info = detection_service.get_detection_info(
+            image, prompts, get_confidences(form), form.get('tiled'), cancel_token
+        )
 
         return jsonify({
             "success": True,
             **detection_info
         })
         
+    except OperationCancelled as e:
+        return cancelled_response(e)
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
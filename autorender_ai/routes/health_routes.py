@@ -5,6 +5,12 @@ Health and status routes
 from flask import Blueprint, jsonify
 
 from ..models.ai_models import model_manager
+from ..services.background_service import mask_cache
+from ..services.detection_service import detection_cache
+from ..config import Config
+from ..utils.cpu_pool import cpu_pool
+from ..utils.metrics import metrics
+from ..utils.thread_budget import thread_budget
 from .. import __version__
 
 # Create blueprint
@@ -35,14 +41,30 @@ def status_endpoint():
         "status": "running",
         "version": __version__,
         "models": model_status,
+        "cpu_pool": cpu_pool.get_status(),
+        "threads": thread_budget.get_status(),
+        "perceptual_cache": {
+            "enabled": Config.PERCEPTUAL_CACHE,
+            "masks": mask_cache.get_status(),
+            "detections": detection_cache.get_status()
+        },
         "endpoints": {
-            "background": ["/remove-bg", "/swap-background"],
+            "background": ["/remove-bg", "/remove-bg/video", "/swap-background", "/swap-background/stream"],
             "detection": ["/detect", "/face-crop", "/smart-crop", "/detect-info"],
-            "health": ["/", "/health", "/status"]
+            "pipeline": ["/pipeline"],
+            "health": ["/", "/health", "/status", "/metrics"]
         }
     })
 
 
+@health_bp.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """
+    Get counters and timings for this worker process.
+    """
+    return jsonify(metrics.snapshot())
+
+
 @health_bp.route("/models/load", methods=["POST"])
 def load_models_endpoint():
     """
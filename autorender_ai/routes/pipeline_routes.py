@@ -0,0 +1,76 @@
+"""
+Operation pipeline routes
+"""
+
+import json
+
+from flask import Blueprint, jsonify
+
+from ..services.pipeline_service import PipelineService
+from ..services.image_utils import ImageUtils
+from ..utils.cancellation import CancelToken, OperationCancelled, cancelled_response
+from ..utils.output_encoder import OutputEncoder
+
+# Create blueprint
+pipeline_bp = Blueprint('pipeline', __name__)
+
+# Initialize service
+pipeline_service = PipelineService()
+
+
+@pipeline_bp.route("/pipeline", methods=["POST"])
+def pipeline_endpoint():
+    """
+    Runs an ordered list of operations on one uploaded image.
+    Params: image or image_url, steps (JSON list, or JSON string in form data),
+    encoding or format (optional) and encoder options for the final output.
+    Each step has an 'op' (detect, face_crop, smart_crop, remove_bg,
+    swap_background, compress) plus that operation's parameters, and may set
+    'output': true to also return its intermediate result, encoded with the
+    step's own 'encoding' or 'format' and encoder options.
+    """
+    try:
+        cancel_token = CancelToken.from_request(pipeline_service.config)
+        image, form = ImageUtils.load_image_from_request()
+
+        steps = form.get('steps')
+        if isinstance(steps, str):
+            try:
+                steps = json.loads(steps)
+            except json.JSONDecodeError:
+                return jsonify({"error": "'steps' must be a JSON list."}), 400
+        if not steps:
+            return jsonify({"error": "'steps' is required."}), 400
+        encoder = OutputEncoder.from_request(form, 'pipeline', pipeline_service.config)
+
+        # Run all steps in process, encoding only the requested outputs
+        final_image, outputs = pipeline_service.run(image, steps, cancel_token)
+
+        encoded_outputs = []
+        for index, step, output in outputs:
+            step_encoder = OutputEncoder.from_request(step, 'pipeline', pipeline_service.config)
+            encoded_outputs.append({
+                "step": index,
+                "op": step['op'],
+                "image": step_encoder.to_base64(output),
+                "encoding": step_encoder.report()
+            })
+
+        return jsonify({
+            "success": True,
+            "image": encoder.to_base64(final_image),
+            "encoding": encoder.report(),
+            "outputs": encoded_outputs
+        })
+
+    except OperationCancelled as e:
+        return cancelled_response(e)
+    except ValueError as e:
+        if "No matching object found" in str(e) or "No face detected" in str(e):
+            return jsonify({"error": str(e)}), 404
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        print(f"Error in /pipeline: {e}")
+        return jsonify({"error": str(e)}), 500
@@ -6,10 +6,14 @@ Contains business logic for:
 - Image processing utilities
 - Object detection services
 - Smart cropping functionality
+- Chained operation pipelines
+- Video background removal
 """
 
 from .background_service import BackgroundService
 from .detection_service import DetectionService
 from .image_utils import ImageUtils
+from .pipeline_service import PipelineService
+from .video_service import VideoService
 
-__all__ = ["BackgroundService", "DetectionService", "ImageUtils"]
+__all__ = ["BackgroundService", "DetectionService", "ImageUtils", "PipelineService", "VideoService"]
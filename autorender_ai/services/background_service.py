@@ -2,14 +2,40 @@
 Background processing service for removal and replacement
 """
 
+import hashlib
+import queue
+import threading
 from functools import lru_cache
 from io import BytesIO
+
+import torch
 from PIL import Image, ImageFilter
-from rembg import remove
 
 from .image_utils import ImageUtils
 from ..models.ai_models import model_manager
 from ..config import Config
+from ..utils.cancellation import (
+    CancelToken, DeadlineExceeded, OperationCancelled, active_token, check_cancelled, current_token
+)
+from ..utils.cpu_pool import cpu_pool
+from ..utils.metrics import metrics
+from ..utils.perceptual_cache import PerceptualCache
+from ..utils.single_flight import SingleFlight
+
+# Coalesces identical removals and swaps running at the same time, across instances
+background_flight = SingleFlight('background')
+
+# Segmentation masks of recent uploads, reused for near-identical images
+mask_cache = PerceptualCache('masks', Config.PERCEPTUAL_CACHE_SIZE)
+
+# Linear approximation of the Stable Diffusion 1.x VAE decoder, used for cheap
+# previews straight from the 4-channel latents
+LATENT_RGB_FACTORS = torch.tensor([
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+])
 
 
 class BackgroundService:
@@ -18,6 +44,60 @@ class BackgroundService:
     def __init__(self, config=None):
         self.config = config or Config()
     
+    def segment_mask(self, image):
+        """
+        Predicts an image's foreground mask.
+        
+        With ``Config.PERCEPTUAL_CACHE`` enabled, the mask of an earlier
+        near-identical image (re-saved, resized or recompressed) is reused,
+        rescaled to this image with a guided filter so its edges follow this
+        image's pixels.
+        
+        Args:
+            image (PIL.Image): Input image
+            
+        Returns:
+            PIL.Image: L mode mask the size of the image (255 = foreground)
+        """
+        if not self.config.PERCEPTUAL_CACHE:
+            return model_manager.segment(image, only_mask=True)
+        
+        fingerprint = ImageUtils.fingerprint(image)
+        hit = mask_cache.lookup(
+            image, 'mask', fingerprint,
+            self.config.PERCEPTUAL_HASH_DISTANCE, self.config.PERCEPTUAL_MAX_DIFFERENCE
+        )
+        if hit is not None:
+            mask, size, _ = hit
+            if size == image.size:
+                return mask.copy()
+            return ImageUtils.upsample_mask(
+                mask, image, self.config.MASK_GUIDED_RADIUS, self.config.MASK_GUIDED_EPS
+            )
+        
+        mask = model_manager.segment(image, only_mask=True)
+        mask_cache.store(image, 'mask', fingerprint, mask.copy())
+        return mask
+    
+    def segment(self, image):
+        """
+        Cuts out an image's foreground.
+        
+        Args:
+            image (PIL.Image): Input image
+            
+        Returns:
+            PIL.Image: RGBA cutout, see ``segment_mask`` for mask reuse
+        """
+        if not self.config.PERCEPTUAL_CACHE:
+            return model_manager.segment(image)
+        
+        mask = self.segment_mask(image)
+        # Match rembg's cutouts, which are transparent black outside the mask
+        cutout = Image.new("RGBA", image.size, (0, 0, 0, 0))
+        cutout.paste(image.convert("RGBA"), (0, 0), mask)
+        return cutout
+    
     @lru_cache(maxsize=32)
     def _process_background_removal_cached(self, image_bytes, bg_color_hex, edge_blur_radius):
         """
@@ -33,9 +113,46 @@ class BackgroundService:
         """
         image = Image.open(BytesIO(image_bytes)).convert("RGBA")
         
+        # Drop the work if the request was aborted while it waited
+        check_cancelled()
+        
         # Remove background
-        foreground = remove(image)
+        foreground = self.segment(image)
+        return self._finish_cutout(foreground, bg_color_hex, edge_blur_radius)
+    
+    def _remove_background_full_resolution(self, image, bg_color_hex, edge_blur_radius):
+        """
+        Removes the background at full resolution for the cost of segmenting
+        at the working size.
+        
+        The mask is predicted on a copy limited to ``Config.MAX_IMAGE_SIZE``
+        and upsampled to the original size with a guided filter against the
+        full-resolution image.
+        
+        Args:
+            image (PIL.Image): Full-resolution input image
+            bg_color_hex (str): Background color in hex format
+            edge_blur_radius (int): Blur radius for edge refinement
+            
+        Returns:
+            PIL.Image: Processed image at the input's size
+        """
+        check_cancelled()
+        working = ImageUtils.compress_image(image.copy(), max_size=self.config.MAX_IMAGE_SIZE)
+        mask = self.segment_mask(working)
+        check_cancelled()
         
+        if mask.size != image.size:
+            mask = ImageUtils.upsample_mask(
+                mask, image, self.config.MASK_GUIDED_RADIUS, self.config.MASK_GUIDED_EPS
+            )
+        foreground = image.convert("RGBA")
+        foreground.putalpha(mask)
+        return self._finish_cutout(foreground, bg_color_hex, edge_blur_radius)
+    
+    @staticmethod
+    def _finish_cutout(foreground, bg_color_hex, edge_blur_radius):
+        """Applies edge refinement and background color replacement to a cutout."""
         # Edge Refinement
         if edge_blur_radius > 0:
             mask = foreground.getchannel('A')
@@ -47,12 +164,12 @@ class BackgroundService:
             bg_color = ImageUtils.validate_hex_color(bg_color_hex)
             if bg_color:
                 background = Image.new("RGB", foreground.size, bg_color)
-                background.paste(foreground, mask=foreground.getchannel('A'))
-                return background
+                return cpu_pool.composite(background, foreground)
         
         return foreground
     
-    def remove_background(self, image, bg_color=None, edge_blur_radius=0):
+    def remove_background(self, image, bg_color=None, edge_blur_radius=0, cancel_token=None,
+                          full_resolution=False):
         """
         Remove background from an image with optional color replacement.
         
@@ -60,16 +177,34 @@ class BackgroundService:
             image (PIL.Image): Input image
             bg_color (str): Optional background color (hex)
             edge_blur_radius (int): Optional edge blur radius
+            cancel_token (CancelToken): Optional cancellation token
+            full_resolution (bool): Segment at the working size and upsample
+                the mask to the input's size, instead of segmenting the input
             
         Returns:
             PIL.Image: Processed image
+            
+        Raises:
+            OperationCancelled: If the token is cancelled or expires first
         """
-        # Convert image to bytes for caching
-        image_bytes = ImageUtils.image_to_bytes(image)
-        
-        return self._process_background_removal_cached(
-            image_bytes, bg_color, edge_blur_radius
-        )
+        with active_token(cancel_token):
+            check_cancelled()
+            
+            if full_resolution:
+                # Large inputs are keyed by their pixels rather than re-encoded
+                key = ('remove-full', ImageUtils.fingerprint(image), bg_color, edge_blur_radius)
+                return background_flight.do(key, lambda: self._remove_background_full_resolution(
+                    image, bg_color, edge_blur_radius
+                ))
+            
+            # Convert image to bytes for caching
+            image_bytes = ImageUtils.image_to_bytes(image)
+            
+            # Identical concurrent requests share one segmentation
+            key = ('remove', hashlib.sha1(image_bytes).hexdigest(), bg_color, edge_blur_radius)
+            return background_flight.do(key, lambda: self._process_background_removal_cached(
+                image_bytes, bg_color, edge_blur_radius
+            ))
     
     @lru_cache(maxsize=16)
     def _process_background_swap_cached(self, image_bytes, prompt, width, height):
@@ -91,22 +226,32 @@ class BackgroundService:
             raise RuntimeError("Stable Diffusion model is not available.")
         
         # Step 1: Foreground Segmentation
+        check_cancelled()
         original_image = Image.open(BytesIO(image_bytes))
-        subject = remove(original_image)
+        subject = self.segment(original_image)
+        
+        # Step 2: Background Generation, stopping at a step boundary if the
+        # request is cancelled or runs out of time
+        check_cancelled()
+        token = current_token()
+        
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            token.check()
+            return callback_kwargs
         
-        # Step 2: Background Generation
         print(f"Generating background for prompt: '{prompt}'")
-        generated_bg = sd_pipe(prompt, width=width, height=height).images[0]
+        generated_bg = sd_pipe(
+            prompt,
+            width=width,
+            height=height,
+            callback_on_step_end=on_step_end if token else None
+        ).images[0]
         
         # Step 3: Compositing
-        # Ensure background is the correct size
-        generated_bg = generated_bg.resize(subject.size)
-        # Paste the subject onto the generated background using its alpha channel as a mask
-        generated_bg.paste(subject, (0, 0), subject)
-        
-        return generated_bg
+        # Resize the background to the subject and paste the subject using its alpha channel
+        return cpu_pool.composite(generated_bg, subject)
     
-    def swap_background(self, image, prompt, width=None, height=None):
+    def swap_background(self, image, prompt, width=None, height=None, cancel_token=None):
         """
         Swap background using AI-generated content.
         
@@ -115,9 +260,14 @@ class BackgroundService:
             prompt (str): Text prompt for background generation
             width (int): Optional target width
             height (int): Optional target height
+            cancel_token (CancelToken): Optional token, checked at every
+                diffusion step
             
         Returns:
             PIL.Image: Image with AI-generated background
+            
+        Raises:
+            OperationCancelled: If the token is cancelled or expires first
         """
         # Use image dimensions if not specified
         if width is None:
@@ -125,9 +275,126 @@ class BackgroundService:
         if height is None:
             height = image.height
             
-        # Convert image to bytes for caching
-        image_bytes = ImageUtils.image_to_bytes(image)
+        with active_token(cancel_token):
+            check_cancelled()
+            
+            # Convert image to bytes for caching
+            image_bytes = ImageUtils.image_to_bytes(image)
+            
+            # Identical concurrent requests share one diffusion run
+            key = ('swap', hashlib.sha1(image_bytes).hexdigest(), prompt, width, height)
+            return background_flight.do(key, lambda: self._process_background_swap_cached(
+                image_bytes, prompt, width, height
+            ))
+    
+    @staticmethod
+    def latents_to_preview(latents):
+        """
+        Converts diffusion latents to a low-resolution RGB preview.
+        
+        Uses a fixed linear projection instead of the VAE decoder, so a preview
+        costs almost nothing. The image is 1/8 of the output resolution.
+        
+        Args:
+            latents (torch.Tensor): Latents of shape (batch, 4, h, w)
+            
+        Returns:
+            PIL.Image: Preview of the first latent in the batch
+        """
+        latent = latents[0].detach().float().cpu()
+        rgb = torch.einsum('chw,cr->hwr', latent, LATENT_RGB_FACTORS)
+        rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).byte().numpy()
+        return Image.fromarray(rgb)
+    
+    def swap_background_stream(self, image, prompt, width=None, height=None,
+                               preview_every=None, cancel_token=None):
+        """
+        Swap background using AI-generated content, reporting progress.
+        
+        Diffusion runs in a background thread. Events are yielded as it
+        progresses, and when the returned generator is closed (for example
+        because the client disconnected) generation stops at the next step.
         
-        return self._process_background_swap_cached(
-            image_bytes, prompt, width, height
+        Args:
+            image (PIL.Image): Input image
+            prompt (str): Text prompt for background generation
+            width (int): Optional target width
+            height (int): Optional target height
+            preview_every (int): Emit a latent preview every N steps, 0 for none
+            cancel_token (CancelToken): Optional token to stop generation early,
+                e.g. with the request's deadline
+            
+        Returns:
+            generator: (event, data) tuples. 'progress' carries step counts,
+                'preview' and 'result' carry a PIL Image, 'error' a message
+            
+        Raises:
+            RuntimeError: If Stable Diffusion is not available
+        """
+        sd_pipe = model_manager.load_stable_diffusion_model()
+        if not sd_pipe:
+            raise RuntimeError("Stable Diffusion model is not available.")
+        
+        width = width or image.width
+        height = height or image.height
+        if preview_every is None:
+            preview_every = self.config.SD_PREVIEW_EVERY
+        cancel_token = cancel_token or CancelToken()
+        
+        return self._swap_background_events(
+            sd_pipe, image, prompt, width, height, preview_every, cancel_token
         )
+    
+    def _swap_background_events(self, sd_pipe, image, prompt, width, height,
+                                preview_every, cancel_token):
+        """Generator behind ``swap_background_stream``."""
+        events = queue.Queue()
+        
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            # Step boundaries are the safe points to stop diffusion
+            cancel_token.check()
+            total = pipe.num_timesteps
+            events.put(('progress', {'step': step + 1, 'total': total}))
+            if preview_every and (step + 1) % preview_every == 0 and step + 1 < total:
+                preview = self.latents_to_preview(callback_kwargs['latents'])
+                events.put(('preview', {'step': step + 1, 'image': preview}))
+            return callback_kwargs
+        
+        def generate():
+            try:
+                subject = self.segment(image)
+                cancel_token.check()
+                
+                print(f"Generating background for prompt: '{prompt}'")
+                generated_bg = sd_pipe(
+                    prompt,
+                    width=width,
+                    height=height,
+                    callback_on_step_end=on_step_end,
+                    callback_on_step_end_tensor_inputs=['latents']
+                ).images[0]
+                
+                events.put(('result', {'image': cpu_pool.composite(generated_bg, subject)}))
+            except DeadlineExceeded as e:
+                metrics.increment(f"requests.{e.status}")
+                events.put(('error', {'error': str(e), 'status': e.status}))
+            except OperationCancelled as e:
+                metrics.increment(f"requests.{e.status}")
+                print(f"Background generation cancelled for prompt: '{prompt}'")
+            except Exception as e:
+                events.put(('error', {'error': str(e)}))
+            finally:
+                events.put(None)
+        
+        worker = threading.Thread(target=generate, name="swap-background-stream", daemon=True)
+        worker.start()
+        
+        try:
+            while True:
+                event = events.get()
+                if event is None:
+                    break
+                yield event
+        finally:
+            # Reached when the stream completes or the consumer goes away
+            cancel_token.cancel("cancelled by client")
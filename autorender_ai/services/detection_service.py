@@ -6,8 +6,19 @@ import cv2
 import numpy as np
 from PIL import Image
 
+from .image_utils import ImageUtils
 from ..models.ai_models import model_manager
 from ..config import Config
+from ..utils.cancellation import active_token, check_cancelled
+from ..utils.cpu_pool import cpu_pool
+from ..utils.perceptual_cache import PerceptualCache
+from ..utils.single_flight import SingleFlight
+
+# Coalesces identical detections running at the same time, across instances
+detection_flight = SingleFlight('detection')
+
+# Detections of recent uploads, reused for near-identical images
+detection_cache = PerceptualCache('detections', Config.PERCEPTUAL_CACHE_SIZE)
 
 
 class DetectionService:
@@ -16,62 +27,466 @@ class DetectionService:
     def __init__(self, config=None):
         self.config = config or Config()
     
-    def detect_and_crop(self, image, prompt):
+    @staticmethod
+    def normalize_prompts(prompts):
         """
-        Detect an object via a prompt and crop to it.
+        Normalizes a prompt or list of prompts into a list of unique class names.
+        
+        Args:
+            prompts (str | list): A single prompt, a comma-separated string of
+                prompts or a list of prompts
+            
+        Returns:
+            list: Unique, non-empty class names in their original order
+            
+        Raises:
+            ValueError: If no prompt is provided
+        """
+        if isinstance(prompts, str):
+            prompts = prompts.split(',')
+        
+        classes = []
+        for prompt in prompts or []:
+            prompt = str(prompt).strip()
+            if prompt and prompt not in classes:
+                classes.append(prompt)
+        
+        if not classes:
+            raise ValueError("Prompt is required.")
+        return classes
+    
+    def get_class_thresholds(self, classes, confidences=None):
+        """
+        Resolves the confidence threshold to use for each class.
+        
+        Per-request values take precedence over ``Config.YOLO_CLASS_CONFIDENCE``,
+        which in turn takes precedence over the global ``Config.YOLO_CONFIDENCE``.
+        
+        Args:
+            classes (list): Class names
+            confidences (float | dict): Optional threshold for all classes or a
+                mapping of class name to threshold
+            
+        Returns:
+            dict: Mapping of class name to confidence threshold
+            
+        Raises:
+            ValueError: If a threshold is not between 0 and 1
+        """
+        if confidences is None:
+            confidences = {}
+        elif not isinstance(confidences, dict):
+            confidences = {name: confidences for name in classes}
+        
+        class_confidence = getattr(self.config, 'YOLO_CLASS_CONFIDENCE', {})
+        thresholds = {}
+        for name in classes:
+            value = confidences.get(name, class_confidence.get(name, self.config.YOLO_CONFIDENCE))
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid confidence for '{name}': {value}")
+            if not 0 <= value <= 1:
+                raise ValueError(f"Confidence for '{name}' must be between 0 and 1.")
+            thresholds[name] = value
+        return thresholds
+    
+    @staticmethod
+    def tile_grid(width, height, tile_size, overlap):
+        """
+        Computes overlapping tile boxes covering an image.
+        
+        Args:
+            width (int): Image width
+            height (int): Image height
+            tile_size (int): Tile edge length in pixels
+            overlap (float): Fraction of a tile shared with its neighbour
+            
+        Returns:
+            list: (x0, y0, x1, y1) tile boxes, the last row and column are
+                aligned to the image edge
+        """
+        stride = max(1, int(tile_size * (1 - overlap)))
+        
+        def positions(length):
+            if length <= tile_size:
+                return [0]
+            starts = list(range(0, length - tile_size, stride))
+            return starts + [length - tile_size]
+        
+        return [
+            (x, y, min(x + tile_size, width), min(y + tile_size, height))
+            for y in positions(height)
+            for x in positions(width)
+        ]
+    
+    @staticmethod
+    def non_max_suppression(boxes, scores, classes, iou_threshold):
+        """
+        Class-aware non-maximum suppression.
+        
+        Args:
+            boxes (np.ndarray): (N, 4) boxes in xyxy format
+            scores (np.ndarray): (N,) confidence scores
+            classes (np.ndarray): (N,) class indices
+            iou_threshold (float): Boxes of the same class overlapping more
+                than this are suppressed
+            
+        Returns:
+            np.ndarray: Indices of the kept boxes, highest score first
+        """
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        order = np.argsort(-scores)
+        keep = []
+        
+        while order.size:
+            best, rest = order[0], order[1:]
+            keep.append(best)
+            
+            x0 = np.maximum(boxes[best, 0], boxes[rest, 0])
+            y0 = np.maximum(boxes[best, 1], boxes[rest, 1])
+            x1 = np.minimum(boxes[best, 2], boxes[rest, 2])
+            y1 = np.minimum(boxes[best, 3], boxes[rest, 3])
+            intersection = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+            iou = intersection / (areas[best] + areas[rest] - intersection + 1e-9)
+            
+            suppressed = (iou > iou_threshold) & (classes[rest] == classes[best])
+            order = rest[~suppressed]
+        
+        return np.array(keep, dtype=int)
+    
+    def use_tiling(self, image, tiled=None):
+        """
+        Decides whether an image should be detected tile by tile.
         
         Args:
             image (PIL.Image): Input image
-            prompt (str): Object detection prompt
+            tiled (bool | str): True/'on' or False/'off' to force a mode,
+                'auto' to tile large images, None to follow
+                ``Config.DETECTION_TILING``
             
         Returns:
-            PIL.Image: Cropped image containing the detected object
+            bool: True if tiled inference should be used
             
         Raises:
-            ValueError: If no matching object is found
+            ValueError: If the mode is not recognised
+        """
+        if tiled is None or tiled == '':
+            tiled = self.config.DETECTION_TILING
+        if isinstance(tiled, bool):
+            return tiled
+        
+        mode = str(tiled).lower()
+        if mode == 'auto':
+            return max(image.size) > self.config.DETECTION_TILE_MIN_SIZE
+        if mode in ('on', 'true', '1'):
+            return True
+        if mode in ('off', 'false', '0'):
+            return False
+        raise ValueError("'tiled' must be one of 'on', 'off' or 'auto'.")
+    
+    @staticmethod
+    def _result_arrays(result):
+        """Returns (xyxy, conf, cls) numpy arrays for one YOLO result."""
+        boxes = result.boxes
+        return (
+            boxes.xyxy.cpu().numpy(),
+            boxes.conf.cpu().numpy(),
+            boxes.cls.cpu().numpy()
+        )
+    
+    def _predict_tiled(self, yolo_model, image, conf):
+        """
+        Runs YOLO on overlapping tiles and merges the boxes.
+        
+        Tiles are predicted in batches of ``Config.DETECTION_TILE_BATCH``,
+        or one at a time with a static export.
+        Each tile is inferred at full resolution, so small objects survive
+        YOLO's internal downsampling. A downscaled pass over the whole image
+        is added for objects larger than a tile.
+        
+        Args:
+            yolo_model: YOLO model with classes already set
+            image (PIL.Image): Input image
+            conf (float): Minimum confidence
+            
+        Returns:
+            tuple: (xyxy, conf, cls) numpy arrays in full-image coordinates
+        """
+        tiles = self.tile_grid(
+            image.width, image.height,
+            self.config.DETECTION_TILE_SIZE,
+            self.config.DETECTION_TILE_OVERLAP
+        )
+        if self.config.DETECTION_TILE_FULL_IMAGE and len(tiles) > 1:
+            tiles.append((0, 0, image.width, image.height))
+        
+        all_boxes, all_scores, all_classes = [], [], []
+        batch_size = max(1, self.config.DETECTION_TILE_BATCH)
+        batch_size = min(batch_size, model_manager.get_yolo_batch_size() or batch_size)
+        
+        for start in range(0, len(tiles), batch_size):
+            check_cancelled()
+            batch = tiles[start:start + batch_size]
+            results = yolo_model.predict(
+                [image.crop(tile) for tile in batch],
+                conf=conf,
+                imgsz=model_manager.get_yolo_imgsz(self.config.DETECTION_TILE_SIZE),
+                verbose=False
+            )
+            
+            # Map boxes back to full-image coordinates
+            for (x0, y0, _, _), result in zip(batch, results):
+                xyxy, scores, classes = self._result_arrays(result)
+                all_boxes.append(xyxy + np.array([x0, y0, x0, y0], dtype=xyxy.dtype))
+                all_scores.append(scores)
+                all_classes.append(classes)
+        
+        boxes = np.concatenate(all_boxes).reshape(-1, 4)
+        scores = np.concatenate(all_scores)
+        classes = np.concatenate(all_classes)
+        
+        keep = self.non_max_suppression(boxes, scores, classes, self.config.DETECTION_NMS_IOU)
+        return boxes[keep], scores[keep], classes[keep]
+    
+    def detect(self, image, prompts, confidences=None, tiled=None, cancel_token=None):
+        """
+        Runs a single YOLO prediction for one or more prompts.
+        
+        All prompts are set as classes at once, so finding several objects costs
+        one forward pass. Detections are filtered with each class's threshold.
+        
+        Args:
+            image (PIL.Image): Input image
+            prompts (str | list): Object detection prompt(s)
+            confidences (float | dict): Optional confidence threshold(s)
+            tiled (bool | str): Force tiled inference on or off, or None/'auto'
+                to follow ``Config.DETECTION_TILING``
+            cancel_token (CancelToken): Optional token; queued work is dropped
+                once it is cancelled or its deadline passes
+            
+        Returns:
+            list: Detections as dicts with 'bbox', 'confidence' and 'class',
+                highest confidence first
+            
+        Raises:
+            OperationCancelled: If the token is cancelled or expires
+        """
+        classes = self.normalize_prompts(prompts)
+        thresholds = self.get_class_thresholds(classes, confidences)
+        tiled = self.use_tiling(image, tiled)
+        
+        with active_token(cancel_token):
+            check_cancelled()
+            
+            # Identical concurrent requests share one prediction
+            fingerprint = ImageUtils.fingerprint(image)
+            params = (tuple(classes), tuple(sorted(thresholds.items())), tiled)
+            if self.config.PERCEPTUAL_CACHE:
+                compute = lambda: self._detect_cached(image, fingerprint, params, classes, thresholds, tiled)
+            else:
+                compute = lambda: self._detect(image, classes, thresholds, tiled)
+            return detection_flight.do((fingerprint, *params), compute)
+    
+    def _detect_cached(self, image, fingerprint, params, classes, thresholds, tiled):
+        """
+        Runs ``_detect``, reusing the detections of an earlier near-identical
+        image scaled to this image's size.
+        
+        Args:
+            image (PIL.Image): Input image
+            fingerprint (str): Exact digest of the image's pixels
+            params (tuple): Parameters the detections depend on
+            classes (list): Normalized class names
+            thresholds (dict): Confidence threshold per class
+            tiled (bool): Whether to use tiled inference
+            
+        Returns:
+            list: Detections, see ``detect``
+        """
+        hit = detection_cache.lookup(
+            image, params, fingerprint,
+            self.config.PERCEPTUAL_HASH_DISTANCE, self.config.PERCEPTUAL_MAX_DIFFERENCE
+        )
+        if hit is not None:
+            detections, size, _ = hit
+            return self.scale_detections(detections, size, image.size)
+        
+        detections = self._detect(image, classes, thresholds, tiled)
+        # Cache a copy, callers may modify the returned dicts
+        detection_cache.store(
+            image, params, fingerprint, self.scale_detections(detections, image.size, image.size)
+        )
+        return detections
+    
+    @staticmethod
+    def scale_detections(detections, from_size, to_size):
+        """
+        Maps detections to an image of another size.
+        
+        Args:
+            detections (list): Detections, see ``detect``
+            from_size (tuple): (width, height) the boxes refer to
+            to_size (tuple): (width, height) to map them to
+            
+        Returns:
+            list: New detection dicts with scaled boxes
+        """
+        sx = to_size[0] / from_size[0]
+        sy = to_size[1] / from_size[1]
+        return [
+            {
+                **detection,
+                'bbox': [
+                    min(to_size[0], round(x0 * sx)), min(to_size[1], round(y0 * sy)),
+                    min(to_size[0], round(x1 * sx)), min(to_size[1], round(y1 * sy))
+                ]
+            }
+            for detection in detections
+            for x0, y0, x1, y1 in [detection['bbox']]
+        ]
+    
+    def _detect(self, image, classes, thresholds, tiled):
+        """
+        Runs the prediction for ``detect``.
+        
+        Args:
+            image (PIL.Image): Input image
+            classes (list): Normalized class names
+            thresholds (dict): Confidence threshold per class
+            tiled (bool): Whether to use tiled inference
+            
+        Returns:
+            list: Detections, see ``detect``
         """
-        # Get YOLO model
-        yolo_model = model_manager.load_yolo_model()
+        # Get a YOLO model with the detection classes set
+        yolo_model = model_manager.get_yolo_predictor(classes)
         if not yolo_model:
             raise RuntimeError("YOLO model is not available.")
+        check_cancelled()
         
-        # Set detection classes and run prediction
-        yolo_model.set_classes([prompt])
-        results = yolo_model.predict(
-            image, 
-            conf=self.config.YOLO_CONFIDENCE, 
-            verbose=False
-        )
+        # Run prediction with the lowest threshold, stricter classes are
+        # filtered below
+        if tiled:
+            boxes, scores, class_ids = self._predict_tiled(
+                yolo_model, image, min(thresholds.values())
+            )
+        else:
+            # Static exports only accept the size they were exported at
+            imgsz = model_manager.get_yolo_imgsz()
+            options = {'imgsz': imgsz} if imgsz else {}
+            results = yolo_model.predict(
+                image, 
+                conf=min(thresholds.values()), 
+                verbose=False,
+                **options
+            )
+            boxes, scores, class_ids = self._result_arrays(results[0])
+        
+        # Extract detection information
+        detections = []
+        
+        for xyxy, conf, cls in zip(boxes, scores, class_ids):
+            name = classes[int(cls)]
+            confidence = float(conf)
+            if confidence < thresholds[name]:
+                continue
+            
+            x0, y0, x1, y1 = map(int, xyxy)
+            detections.append({
+                'bbox': [x0, y0, x1, y1],
+                'confidence': confidence,
+                'class': name
+            })
+        
+        return detections
+    
+    @staticmethod
+    def group_detections(detections, classes):
+        """
+        Groups detections by class.
+        
+        Args:
+            detections (list): Detections as returned by ``detect``
+            classes (list): Class names, every class gets an entry
+            
+        Returns:
+            dict: Mapping of class name to its list of detections
+        """
+        groups = {name: [] for name in classes}
+        for detection in detections:
+            groups[detection['class']].append(detection)
+        return groups
+    
+    def detect_and_crop(self, image, prompt, confidences=None, tiled=None, cancel_token=None):
+        """
+        Detect an object via a prompt and crop to it.
         
-        # Extract bounding boxes
-        boxes = results[0].boxes
-        if not len(boxes):
+        Args:
+            image (PIL.Image): Input image
+            prompt (str): Object detection prompt
+            confidences (float | dict): Optional confidence threshold(s)
+            tiled (bool | str): Optional tiled inference mode
+            cancel_token (CancelToken): Optional cancellation token
+            
+        Returns:
+            PIL.Image: Cropped image containing the detected object
+            
+        Raises:
+            ValueError: If no matching object is found
+        """
+        # One class, even if the prompt contains commas
+        detections = self.detect(image, [prompt], confidences, tiled, cancel_token)
+        if not detections:
             raise ValueError("No matching object found.")
         
-        # Get the first detection's bounding box
-        x0, y0, x1, y1 = map(int, boxes.xyxy[0].cpu().numpy())
+        # Crop to the first detection's bounding box
+        return image.crop(tuple(detections[0]['bbox']))
+    
+    def detect_and_crop_classes(self, image, prompts, confidences=None, tiled=None, cancel_token=None):
+        """
+        Detect several objects in one pass and crop every detection.
         
-        # Crop the image
-        cropped = image.crop((x0, y0, x1, y1))
+        Args:
+            image (PIL.Image): Input image
+            prompts (str | list): Object detection prompts
+            confidences (float | dict): Optional confidence threshold(s)
+            tiled (bool | str): Optional tiled inference mode
+            cancel_token (CancelToken): Optional cancellation token
+            
+        Returns:
+            dict: Mapping of class name to a list of cropped images
+            
+        Raises:
+            ValueError: If no matching object is found for any class
+        """
+        classes = self.normalize_prompts(prompts)
+        detections = self.detect(image, classes, confidences, tiled, cancel_token)
+        if not detections:
+            raise ValueError("No matching object found.")
         
-        return cropped
+        groups = self.group_detections(detections, classes)
+        return {
+            name: [image.crop(tuple(d['bbox'])) for d in class_detections]
+            for name, class_detections in groups.items()
+        }
     
-    def face_crop(self, image, padding=50):
+    def find_face_box(self, image, padding=50):
         """
-        Detect and crop faces using OpenCV.
+        Detect the first face using OpenCV and return its padded bounding box.
         
         Args:
             image (PIL.Image): Input image
             padding (int): Padding around detected face
             
         Returns:
-            PIL.Image: Cropped image containing the face
+            tuple: (x0, y0, x1, y1) crop box
             
         Raises:
             ValueError: If no face is detected
         """
         # Convert PIL to OpenCV format
-        cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+        cv_image = cv2.cvtColor(np.array(ImageUtils.to_rgb(image)), cv2.COLOR_RGB2BGR)
         gray = cv2.cvtColor(cv_image, cv2.COLOR_BGR2GRAY)
         
         # Load face cascade classifier
@@ -92,14 +507,30 @@ class DetectionService:
         w = min(image.width - x, w + 2 * padding)
         h = min(image.height - y, h + 2 * padding)
         
-        # Crop the image
-        cropped = image.crop((x, y, x + w, y + h))
+        return (x, y, x + w, y + h)
+    
+    def face_crop(self, image, padding=50, cancel_token=None):
+        """
+        Detect and crop faces using OpenCV.
         
-        return cropped
+        Args:
+            image (PIL.Image): Input image
+            padding (int): Padding around detected face
+            cancel_token (CancelToken): Optional cancellation token
+            
+        Returns:
+            PIL.Image: Cropped image containing the face
+            
+        Raises:
+            ValueError: If no face is detected
+        """
+        with active_token(cancel_token):
+            check_cancelled()
+            return image.crop(self.find_face_box(image, padding=padding))
     
-    def smart_crop(self, image, width, height):
+    def find_smart_crop_box(self, image, width, height):
         """
-        Perform smart cropping using SmartCrop algorithm.
+        Run SmartCrop analysis and return the best crop box.
         
         Args:
             image (PIL.Image): Input image
@@ -107,22 +538,31 @@ class DetectionService:
             height (int): Target height
             
         Returns:
-            PIL.Image: Smart-cropped image
+            tuple: (x0, y0, x1, y1) crop box
         """
         smart_crop = model_manager.load_smart_crop()
         if not smart_crop:
             raise RuntimeError("SmartCrop is not available.")
         
-        # Perform smart crop analysis
-        result = smart_crop.crop(image, width, height)
+        # Perform smart crop analysis, in the CPU pool for large images
+        return cpu_pool.smart_crop_box(image, width, height, smart_crop)
+    
+    def smart_crop(self, image, width, height, cancel_token=None):
+        """
+        Perform smart cropping using SmartCrop algorithm.
         
-        # Extract crop coordinates
-        crop_box = (
-            result['top_crop']['x'],
-            result['top_crop']['y'],
-            result['top_crop']['x'] + result['top_crop']['width'],
-            result['top_crop']['y'] + result['top_crop']['height']
-        )
+        Args:
+            image (PIL.Image): Input image
+            width (int): Target width
+            height (int): Target height
+            cancel_token (CancelToken): Optional cancellation token
+            
+        Returns:
+            PIL.Image: Smart-cropped image
+        """
+        with active_token(cancel_token):
+            check_cancelled()
+            crop_box = self.find_smart_crop_box(image, width, height)
         
         # Crop and resize
         cropped = image.crop(crop_box)
@@ -130,45 +570,33 @@ class DetectionService:
         
         return cropped
     
-    def get_detection_info(self, image, prompt):
+    def get_detection_info(self, image, prompts, confidences=None, tiled=None, cancel_token=None):
         """
         Get detection information without cropping.
         
         Args:
             image (PIL.Image): Input image
-            prompt (str): Object detection prompt
+            prompts (str | list): Object detection prompt(s)
+            confidences (float | dict): Optional confidence threshold(s)
+            tiled (bool | str): Optional tiled inference mode
+            cancel_token (CancelToken): Optional cancellation token
             
         Returns:
-            dict: Detection information including bounding boxes and confidence scores
+            dict: Detection information including bounding boxes and confidence
+                scores, both as a flat list and grouped by class
         """
-        # Get YOLO model
-        yolo_model = model_manager.load_yolo_model()
-        if not yolo_model:
-            raise RuntimeError("YOLO model is not available.")
-        
-        # Set detection classes and run prediction
-        yolo_model.set_classes([prompt])
-        results = yolo_model.predict(
-            image, 
-            conf=self.config.YOLO_CONFIDENCE, 
-            verbose=False
-        )
-        
-        # Extract detection information
-        boxes = results[0].boxes
-        detections = []
-        
-        for box in boxes:
-            x0, y0, x1, y1 = map(int, box.xyxy[0].cpu().numpy())
-            confidence = float(box.conf[0].cpu().numpy())
-            
-            detections.append({
-                'bbox': [x0, y0, x1, y1],
-                'confidence': confidence,
-                'class': prompt
-            })
+        classes = self.normalize_prompts(prompts)
+        detections = self.detect(image, classes, confidences, tiled, cancel_token)
+        groups = self.group_detections(detections, classes)
         
         return {
             'detections': detections,
-            'count': len(detections)
-        } 
\ No newline at end of file
+            'count': len(detections),
+            'classes': {
+                name: {
+                    'detections': class_detections,
+                    'count': len(class_detections)
+                }
+                for name, class_detections in groups.items()
+            }
+        }
@@ -3,11 +3,20 @@ Image processing utilities and helper functions
 """
 
 import base64
+import hashlib
 import requests
 from io import BytesIO
+
+import cv2
+import numpy as np
 from PIL import Image
 from flask import request
 
+from ..utils.cpu_pool import cpu_pool
+
+# Pixels per band of rows when applying upsampled mask coefficients
+UPSAMPLE_BAND_PIXELS = 1 << 20
+
 
 class ImageUtils:
     """Utility class for image processing operations"""
@@ -30,10 +39,10 @@ class ImageUtils:
             
             response = requests.get(data['image_url'])
             response.raise_for_status()  # Raises an exception for bad status codes
-            return Image.open(BytesIO(response.content)).convert("RGB"), data
+            return cpu_pool.decode(response.content), data
             
         elif 'image' in request.files:
-            return Image.open(request.files['image']).convert("RGB"), request.form
+            return cpu_pool.decode(request.files['image'].read()), request.form
         else:
             raise ValueError(
                 "No image provided. Use 'image' in a multipart/form-data request "
@@ -52,15 +61,16 @@ class ImageUtils:
         Returns:
             str: Base64 encoded image string
         """
-        buffer = BytesIO()
-        image.save(buffer, format=format)
-        return base64.b64encode(buffer.getvalue()).decode("utf-8")
+        return base64.b64encode(cpu_pool.encode(image, format)).decode("utf-8")
     
     @staticmethod
     def compress_image(image, max_size=1024):
         """
         Compresses an image to a maximum dimension while maintaining aspect ratio.
         
+        Large images are resized in the CPU pool and returned as a new object,
+        so always use the return value.
+        
         Args:
             image (PIL.Image): The image to compress
             max_size (int): Maximum dimension for width or height
@@ -68,9 +78,7 @@ class ImageUtils:
         Returns:
             PIL.Image: Compressed image
         """
-        if image.width > max_size or image.height > max_size:
-            image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-        return image
+        return cpu_pool.thumbnail(image, max_size)
     
     @staticmethod
     def image_to_bytes(image, format='PNG'):
@@ -101,6 +109,85 @@ class ImageUtils:
         """
         return Image.open(BytesIO(image_bytes))
     
+    @staticmethod
+    def fingerprint(image):
+        """
+        Computes a digest of an image's pixels, without encoding it.
+        
+        Args:
+            image (PIL.Image): Input image
+            
+        Returns:
+            str: Hex digest covering mode, size and pixel data
+        """
+        digest = hashlib.sha1(f"{image.mode}:{image.size}".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+    
+    @staticmethod
+    def to_rgb(image):
+        """
+        Returns an RGB view of an image, converting only when needed.
+        
+        Args:
+            image (PIL.Image): Input image
+            
+        Returns:
+            PIL.Image: The image itself if already RGB, otherwise an RGB copy
+        """
+        return image if image.mode == "RGB" else image.convert("RGB")
+    
+    @staticmethod
+    def upsample_mask(mask, guide, radius=4, eps=1e-3):
+        """
+        Upsamples a low-resolution mask to the size of a guide image with a
+        fast guided filter, so mask edges follow the guide's full-resolution edges.
+        
+        The filter's linear coefficients are fitted at the mask's resolution
+        and only applied at full resolution, keeping the cost close to that of
+        a plain resize.
+        
+        Args:
+            mask (PIL.Image): Low-resolution mask (L mode, 255 = foreground)
+            guide (PIL.Image): Full-resolution image the mask belongs to
+            radius (int): Filter radius in mask pixels
+            eps (float): Regularization; larger values smooth more across edges
+            
+        Returns:
+            PIL.Image: L mode mask the size of the guide
+        """
+        guide_full = np.asarray(guide.convert("L"))
+        p = np.asarray(mask.convert("L"), dtype=np.float32) / 255
+        guide_low = cv2.resize(guide_full, (mask.width, mask.height), interpolation=cv2.INTER_AREA)
+        guide_low = guide_low.astype(np.float32) / 255
+        
+        def box(x):
+            return cv2.boxFilter(x, -1, (2 * radius + 1, 2 * radius + 1))
+        
+        mean_i = box(guide_low)
+        mean_p = box(p)
+        cov_ip = box(guide_low * p) - mean_i * mean_p
+        var_i = box(guide_low * guide_low) - mean_i * mean_i
+        a = cov_ip / (var_i + eps)
+        b = mean_p - a * mean_i
+        
+        # Smooth the coefficients, then resize and apply them to the
+        # full-resolution guide a band of rows at a time. Only the 8-bit
+        # guide and output are held at full resolution
+        a, b = box(a), box(b)
+        width, height = guide.size
+        band = max(1, UPSAMPLE_BAND_PIXELS // width)
+        map_x = (np.arange(width, dtype=np.float32) + 0.5) * (mask.width / width) - 0.5
+        refined = np.empty((height, width), dtype=np.uint8)
+        for top in range(0, height, band):
+            rows = np.arange(top, min(top + band, height), dtype=np.float32)
+            xs, ys = np.meshgrid(map_x, (rows + 0.5) * (mask.height / height) - 0.5)
+            band_a = cv2.remap(a, xs, ys, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            band_b = cv2.remap(b, xs, ys, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            values = band_a * guide_full[top:top + len(rows)] * np.float32(1 / 255) + band_b
+            refined[top:top + len(rows)] = (np.clip(values, 0, 1) * 255 + 0.5).astype(np.uint8)
+        return Image.fromarray(refined, mode="L")
+    
     @staticmethod
     def validate_hex_color(color_hex):
         """
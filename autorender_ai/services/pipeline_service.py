@@ -0,0 +1,174 @@
+"""
+Pipeline service for running several operations on one in-memory image
+"""
+
+from .background_service import BackgroundService
+from .detection_service import DetectionService
+from .image_utils import ImageUtils
+from ..config import Config
+from ..utils.cancellation import active_token, check_cancelled
+from ..utils.output_encoder import OutputEncoder
+
+# Step parameters that are flags, and the values they accept besides JSON booleans
+BOOLEAN_PARAMS = ('full_resolution',)
+BOOLEAN_VALUES = {
+    '1': True, 'true': True, 'yes': True, 'on': True,
+    '0': False, 'false': False, 'no': False, 'off': False, '': False,
+}
+
+
+class PipelineService:
+    """Service that chains detection and background operations in process"""
+
+    def __init__(self, config=None, detection_service=None, background_service=None):
+        self.config = config or Config()
+        self.detection_service = detection_service or DetectionService(self.config)
+        self.background_service = background_service or BackgroundService(self.config)
+
+        # Maps step names to their handlers
+        self.operations = {
+            'detect': self._detect,
+            'face_crop': self._face_crop,
+            'smart_crop': self._smart_crop,
+            'remove_bg': self._remove_bg,
+            'swap_background': self._swap_background,
+            'compress': self._compress,
+        }
+
+    @staticmethod
+    def _require(step, name):
+        """Returns a required step parameter or raises a ValueError."""
+        value = step.get(name)
+        if value is None or value == '':
+            raise ValueError(f"Step '{step['op']}' requires '{name}'.")
+        return value
+
+    @staticmethod
+    def _flag(step, name):
+        """Returns a boolean step parameter or raises a ValueError."""
+        value = step.get(name, False)
+        if isinstance(value, bool):
+            return value
+        text = str(value).strip().lower()
+        if text not in BOOLEAN_VALUES:
+            raise ValueError(f"'{name}' of step '{step['op']}' must be true or false, not '{value}'.")
+        return BOOLEAN_VALUES[text]
+
+    @staticmethod
+    def _limit_size(image, max_size):
+        """Like ImageUtils.compress_image, without resizing an image in place."""
+        if image.width > max_size or image.height > max_size:
+            return ImageUtils.compress_image(image.copy(), max_size=max_size)
+        return image
+
+    def _detect(self, image, step):
+        """Crops to the first detection, optionally of one class."""
+        # A single prompt is one class, commas included
+        prompts = step.get('prompts') or [self._require(step, 'prompt')]
+        detections = self.detection_service.detect(
+            image, prompts, step.get('confidence'), step.get('tiled')
+        )
+        if not detections:
+            raise ValueError("No matching object found.")
+
+        # Crop to the best detection of the requested class, if any
+        wanted = step.get('class')
+        if wanted is not None:
+            detections = [d for d in detections if d['class'] == wanted]
+            if not detections:
+                raise ValueError(f"No matching object found for '{wanted}'.")
+        return image.crop(tuple(detections[0]['bbox']))
+
+    def _face_crop(self, image, step):
+        """Crops to the first detected face."""
+        return self.detection_service.face_crop(image, padding=int(step.get('padding', 50)))
+
+    def _smart_crop(self, image, step):
+        """Smart-crops and resizes to the requested size."""
+        width = int(self._require(step, 'width'))
+        height = int(self._require(step, 'height'))
+        return self.detection_service.smart_crop(image, width, height)
+
+    def _remove_bg(self, image, step):
+        """Removes the background at the /remove-bg working size, or at full resolution."""
+        full_resolution = self._flag(step, 'full_resolution')
+        max_size = self.config.FULL_RES_MAX_SIZE if full_resolution else self.config.MAX_IMAGE_SIZE
+        return self.background_service.remove_background(
+            self._limit_size(image, max_size),
+            bg_color=step.get('bg_color'),
+            edge_blur_radius=int(step.get('edge_blur_radius', self.config.DEFAULT_EDGE_BLUR)),
+            full_resolution=full_resolution
+        )
+
+    def _swap_background(self, image, step):
+        """Swaps the background at the /swap-background working size."""
+        prompt = self._require(step, 'prompt')
+        image = self._limit_size(ImageUtils.to_rgb(image), self.config.SD_MAX_SIZE)
+        return self.background_service.swap_background(
+            image,
+            prompt=prompt,
+            width=int(step.get('width', image.width)),
+            height=int(step.get('height', image.height))
+        )
+
+    def _compress(self, image, step):
+        """Limits the image to a maximum dimension."""
+        return self._limit_size(image, int(step.get('max_size', self.config.MAX_IMAGE_SIZE)))
+
+    def validate(self, steps):
+        """
+        Validates a list of steps before any work is done.
+
+        Args:
+            steps (list): Step dicts, each with an 'op' key
+
+        Raises:
+            ValueError: If the list is empty, a step is malformed, a flag is
+                not true or false, or an output step has invalid encoder settings
+        """
+        if not isinstance(steps, list) or not steps:
+            raise ValueError("'steps' must be a non-empty list.")
+
+        for index, step in enumerate(steps):
+            if not isinstance(step, dict) or 'op' not in step:
+                raise ValueError(f"Step {index} must be an object with an 'op'.")
+            if step['op'] not in self.operations:
+                raise ValueError(
+                    f"Unknown operation '{step['op']}' in step {index}. "
+                    f"Available: {', '.join(self.operations)}"
+                )
+            for name in BOOLEAN_PARAMS:
+                self._flag(step, name)
+            if step.get('output'):
+                # Fail on bad encoder settings before any work is done
+                OutputEncoder.from_request(step, 'pipeline', self.config)
+
+    def run(self, image, steps, cancel_token=None):
+        """
+        Runs the steps in order on an in-memory image.
+
+        Args:
+            image (PIL.Image): Input image
+            steps (list): Step dicts. Each has an 'op' and that operation's
+                parameters; 'output': true keeps the step's result
+            cancel_token (CancelToken): Optional token, checked between and
+                within steps
+
+        Returns:
+            tuple: (final PIL.Image, list of (index, step, PIL.Image) for the
+                steps marked as outputs)
+
+        Raises:
+            OperationCancelled: If the token is cancelled or expires
+        """
+        self.validate(steps)
+
+        outputs = []
+        with active_token(cancel_token):
+            for index, step in enumerate(steps):
+                check_cancelled()
+                image = self.operations[step['op']](image, step)
+                if step.get('output') and index < len(steps) - 1:
+                    outputs.append((index, step, image))
+
+        return image, outputs
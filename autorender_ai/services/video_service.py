@@ -0,0 +1,264 @@
+"""
+Video and frame-sequence background removal
+
+Consecutive frames of a product spin differ little, so segmentation only
+runs on keyframes: frames whose pixels changed by more than a threshold
+since the last keyframe. The frames in between reuse the keyframe's mask.
+"""
+
+import os
+import tempfile
+import time
+import zipfile
+
+import cv2
+import numpy as np
+from PIL import Image, TiffImagePlugin
+
+from .image_utils import ImageUtils
+from ..config import Config
+from ..models.ai_models import model_manager
+from ..utils.cpu_pool import composite_image, encode_image
+from ..utils.metrics import metrics
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+
+# Output formats: animated WebP and APNG keep alpha, 'png' is a zip of PNG
+# frames and 'mp4' needs a background color
+VIDEO_FORMATS = {
+    'webp': "image/webp",
+    'apng': "image/apng",
+    'png': "application/zip",
+    'mp4': "video/mp4",
+}
+VIDEO_EXTENSIONS = {'webp': ".webp", 'apng': ".png", 'png': ".zip", 'mp4': ".mp4"}
+
+
+class VideoService:
+    """Service for background removal on videos and frame sequences"""
+
+    def __init__(self, config=None):
+        self.config = config or Config()
+
+    def open_frames(self, source):
+        """
+        Opens a video file or a directory of frame images.
+
+        Args:
+            source (str): Video path, or a directory whose images are frames
+                in filename order
+
+        Returns:
+            tuple: (iterator of RGB PIL Images, frames per second)
+
+        Raises:
+            ValueError: If the source cannot be read
+        """
+        if os.path.isdir(source):
+            names = sorted(n for n in os.listdir(source) if n.lower().endswith(IMAGE_EXTENSIONS))
+            if not names:
+                raise ValueError(f"No frame images found in '{source}'.")
+            frames = (ImageUtils.to_rgb(Image.open(os.path.join(source, name))) for name in names)
+            return frames, self.config.VIDEO_SEQUENCE_FPS
+
+        capture = cv2.VideoCapture(source)
+        if not capture.isOpened():
+            raise ValueError(f"Could not open video '{source}'.")
+        fps = capture.get(cv2.CAP_PROP_FPS) or self.config.VIDEO_SEQUENCE_FPS
+        return self._read_video(capture), fps
+
+    @staticmethod
+    def _read_video(capture):
+        """Yields a capture's frames as RGB images, releasing it when done."""
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        finally:
+            capture.release()
+
+    @staticmethod
+    def frame_signature(frame, size=64):
+        """
+        Reduces a frame to a small grayscale array for change detection.
+
+        Args:
+            frame (PIL.Image): Frame
+            size (int): Side of the square signature
+
+        Returns:
+            numpy.ndarray: Float pixels between 0 and 1
+        """
+        small = frame.convert("L").resize((size, size), Image.Resampling.BILINEAR)
+        return np.asarray(small, dtype=np.float32) / 255
+
+    def remove_background_frames(self, frames, change_threshold=None, bg_color=None,
+                                 max_size=None, max_frames=None, cancel_token=None):
+        """
+        Removes the background of each frame, segmenting keyframes only.
+
+        A frame becomes a keyframe when its mean absolute pixel change from
+        the last keyframe exceeds the threshold; other frames reuse the
+        keyframe's mask.
+
+        Args:
+            frames (iterable): RGB PIL Images
+            change_threshold (float): Change between 0 and 1 above which a
+                frame is segmented, defaults to ``Config.VIDEO_CHANGE_THRESHOLD``
+            bg_color (str): Optional background color (hex)
+            max_size (int): Frames are limited to this size, defaults to
+                ``Config.MAX_IMAGE_SIZE``
+            max_frames (int): Most frames accepted, defaults to
+                ``Config.VIDEO_MAX_FRAMES``
+            cancel_token (CancelToken): Optional token, checked every frame
+
+        Yields:
+            tuple: (PIL.Image, bool) the RGBA frame, or RGB with bg_color,
+                and whether it was segmented
+
+        Raises:
+            ValueError: If there are more than ``max_frames`` frames
+        """
+        if change_threshold is None:
+            change_threshold = self.config.VIDEO_CHANGE_THRESHOLD
+        max_size = max_size or self.config.MAX_IMAGE_SIZE
+        max_frames = max_frames or self.config.VIDEO_MAX_FRAMES
+        background = ImageUtils.validate_hex_color(bg_color)
+
+        mask = keyframe = None
+        for index, frame in enumerate(frames):
+            if cancel_token:
+                cancel_token.check()
+            if index >= max_frames:
+                raise ValueError(f"Videos are limited to {max_frames} frames in this format.")
+
+            frame = ImageUtils.compress_image(frame, max_size=max_size)
+            signature = self.frame_signature(frame)
+            segment = (
+                mask is None
+                or mask.size != frame.size
+                or float(np.abs(signature - keyframe).mean()) > change_threshold
+            )
+            if segment:
+                mask = model_manager.segment(frame, only_mask=True)
+                keyframe = signature
+
+            cutout = frame.convert("RGBA")
+            cutout.putalpha(mask)
+            if background:
+                cutout = composite_image(Image.new("RGB", cutout.size, background), cutout)
+            yield cutout, segment
+
+    @staticmethod
+    def write_frames(frames, path, format, fps):
+        """
+        Encodes frames to a file.
+
+        Args:
+            frames (iterable): PIL Images
+            path (str): Output path
+            format (str): One of VIDEO_FORMATS
+            fps (float): Frames per second
+
+        Returns:
+            int: Number of frames written
+
+        Raises:
+            ValueError: If the format is unknown, there are no frames, or
+                'mp4' is asked for frames with transparency
+        """
+        if format not in VIDEO_FORMATS:
+            raise ValueError(f"Unsupported video format '{format}'. Use one of: {', '.join(VIDEO_FORMATS)}.")
+
+        count = 0
+        if format == 'png':
+            # Frames are already compressed, don't deflate them again
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as archive:
+                for count, frame in enumerate(frames, 1):
+                    archive.writestr(f"frame_{count:05d}.png", encode_image(frame, "PNG", compress_level=1))
+
+        elif format == 'mp4':
+            writer = None
+            try:
+                for count, frame in enumerate(frames, 1):
+                    if frame.mode == "RGBA":
+                        raise ValueError("mp4 has no alpha channel, set bg_color or use webp, apng or png.")
+                    if writer is None:
+                        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, frame.size)
+                    writer.write(cv2.cvtColor(np.asarray(frame), cv2.COLOR_RGB2BGR))
+            finally:
+                if writer is not None:
+                    writer.release()
+
+        else:
+            # Pillow writes animations from frames it is given all at once.
+            # They are spooled to a multi-page TIFF instead of kept in memory,
+            # and the animation is written from it one page at a time
+            with tempfile.TemporaryDirectory() as spool:
+                pages = os.path.join(spool, "frames.tif")
+                with TiffImagePlugin.AppendingTiffWriter(pages, new=True) as writer:
+                    for count, frame in enumerate(frames, 1):
+                        frame.save(writer, format="TIFF", compression="tiff_lzw")
+                        writer.newFrame()
+                if count:
+                    # Lossless keeps the alpha channel intact across frames; a
+                    # low quality setting only means less effort compressing
+                    options = {'lossless': True, 'quality': 25, 'method': 0} if format == 'webp' else {}
+                    with Image.open(pages) as animation:
+                        animation.save(
+                            path, format="WEBP" if format == 'webp' else "PNG", save_all=True,
+                            duration=round(1000 / fps), loop=0, **options
+                        )
+
+        if count == 0:
+            raise ValueError("The video has no frames.")
+        return count
+
+    def process_video(self, source, path, format=None, change_threshold=None, bg_color=None,
+                      cancel_token=None):
+        """
+        Removes the background of a video or frame sequence and encodes the result.
+
+        Args:
+            source (str): Video path or directory of frames, see ``open_frames``
+            path (str): Output path
+            format (str): One of VIDEO_FORMATS, defaults to ``Config.VIDEO_FORMAT``
+            change_threshold (float): See ``remove_background_frames``
+            bg_color (str): Optional background color (hex)
+            cancel_token (CancelToken): Optional cancellation token
+
+        Returns:
+            dict: Frame counts (total, segmented, skipped), fps, format and seconds
+
+        Raises:
+            ValueError: If the source, format or options are invalid
+        """
+        format = (format or self.config.VIDEO_FORMAT).lower()
+        if format == 'mp4' and not bg_color:
+            raise ValueError("mp4 has no alpha channel, set bg_color or use webp, apng or png.")
+        start = time.perf_counter()
+        frames, fps = self.open_frames(source)
+        stats = {'frames': 0, 'segmented': 0, 'skipped': 0}
+        # Pillow's APNG writer keeps every frame in memory
+        max_frames = self.config.VIDEO_MAX_APNG_FRAMES if format == 'apng' else None
+
+        def counted():
+            for frame, segmented in self.remove_background_frames(
+                frames, change_threshold, bg_color, max_frames=max_frames, cancel_token=cancel_token
+            ):
+                stats['frames'] += 1
+                stats['segmented' if segmented else 'skipped'] += 1
+                yield frame
+
+        self.write_frames(counted(), path, format, fps)
+        metrics.increment('video.frames', stats['frames'])
+        metrics.increment('video.frames_skipped', stats['skipped'])
+
+        return {
+            **stats,
+            'fps': fps,
+            'format': format,
+            'seconds': round(time.perf_counter() - start, 3)
+        }
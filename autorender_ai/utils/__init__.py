@@ -4,4 +4,11 @@ Utilities module for AutoRender AI
 Contains helper functions and utility classes.
 """
 
-__all__ = []
+from .cpu_pool import CPUPool
+from .metrics import Metrics
+from .output_encoder import OutputEncoder
+from .perceptual_cache import PerceptualCache
+from .single_flight import SingleFlight
+from .thread_budget import ThreadBudget
+
+__all__ = ["CPUPool", "Metrics", "OutputEncoder", "PerceptualCache", "SingleFlight", "ThreadBudget"]
@@ -0,0 +1,174 @@
+"""
+Cancellation and deadlines for long-running inference
+
+A CancelToken is shared between the code serving a request and the work it
+started. It is cancelled when the client goes away and expires when the
+request's deadline passes. Work checks it at safe points, such as diffusion
+step boundaries or before starting queued work, and stops by raising
+OperationCancelled.
+
+Services take a ``cancel_token`` argument and make it the active token for
+the duration of the call, so helpers deeper down (cached functions, the CPU
+pool, model callbacks) can reach it through ``current_token()``.
+"""
+
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import jsonify, request
+
+from .metrics import metrics
+
+# Header a client can send to set its own deadline, in seconds
+TIMEOUT_HEADER = "X-Request-Timeout"
+
+
+class OperationCancelled(Exception):
+    """Raised inside work whose request was cancelled"""
+
+    status = "cancelled"
+    http_status = 499  # Client closed request
+
+
+class DeadlineExceeded(OperationCancelled):
+    """Raised inside work whose request ran past its deadline"""
+
+    status = "deadline_exceeded"
+    http_status = 504
+
+
+class CancelToken:
+    """Thread-safe cancellation flag with an optional deadline"""
+
+    def __init__(self, timeout=None):
+        """
+        Args:
+            timeout (float): Seconds from now until the deadline, None for none
+        """
+        self._event = threading.Event()
+        self.reason = None
+        self.deadline = time.monotonic() + timeout if timeout else None
+
+    @classmethod
+    def from_request(cls, config):
+        """
+        Creates a token for the current request.
+
+        The deadline comes from the X-Request-Timeout header, or
+        ``Config.REQUEST_TIMEOUT`` when the header is absent. A header can
+        shorten the configured deadline but not extend it.
+
+        Args:
+            config: Configuration object
+
+        Returns:
+            CancelToken: Token with the request's deadline
+
+        Raises:
+            ValueError: If the header is not a positive, finite number
+        """
+        header = request.headers.get(TIMEOUT_HEADER)
+        if header is None:
+            return cls(config.REQUEST_TIMEOUT or None)
+
+        try:
+            timeout = float(header)
+        except ValueError:
+            timeout = 0
+        if not math.isfinite(timeout) or timeout <= 0:
+            raise ValueError(f"{TIMEOUT_HEADER} must be a positive number of seconds.")
+        if config.REQUEST_TIMEOUT:
+            timeout = min(timeout, config.REQUEST_TIMEOUT)
+        return cls(timeout)
+
+    def cancel(self, reason="cancelled"):
+        """
+        Requests cancellation.
+
+        Args:
+            reason (str): Why the work is being cancelled
+        """
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        """Whether cancellation was requested."""
+        return self._event.is_set()
+
+    @property
+    def remaining(self):
+        """Seconds left until the deadline, None without a deadline."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    @property
+    def expired(self):
+        """Whether the deadline has passed."""
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def check(self):
+        """
+        Raises if the work should stop.
+
+        Raises:
+            OperationCancelled: If the token was cancelled
+            DeadlineExceeded: If the deadline has passed
+        """
+        if self.cancelled:
+            raise OperationCancelled(f"Operation {self.reason}.")
+        if self.expired:
+            raise DeadlineExceeded("Request deadline exceeded.")
+
+
+_current_token = contextvars.ContextVar('cancel_token', default=None)
+
+
+def current_token():
+    """Returns the token of the work running in this context, if any."""
+    return _current_token.get()
+
+
+def check_cancelled():
+    """Raises if the active token was cancelled or has expired."""
+    token = _current_token.get()
+    if token is not None:
+        token.check()
+
+
+@contextmanager
+def active_token(token):
+    """
+    Makes a token the active one for the enclosed block.
+
+    Args:
+        token (CancelToken): Token to activate, None keeps the current one
+    """
+    if token is None:
+        yield _current_token.get()
+        return
+
+    reset = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(reset)
+
+
+def cancelled_response(error):
+    """
+    Builds the JSON response for an aborted request and counts it.
+
+    Args:
+        error (OperationCancelled): The cancellation that ended the request
+
+    Returns:
+        tuple: (response, status code)
+    """
+    metrics.increment(f"requests.{error.status}")
+    return jsonify({"error": str(error), "status": error.status}), error.http_status
@@ -0,0 +1,357 @@
+"""
+Process-pool offload for CPU-bound image stages
+
+Decoding, thumbnailing, SmartCrop analysis, encoding and compositing are
+pure-Python/PIL work that holds the GIL. On a threaded server one large PNG
+encode stalls every other request, so large images are sent to a pool of
+worker processes. Pixels travel through shared memory instead of being
+pickled; small images stay in the calling thread where IPC would cost more
+than it saves.
+"""
+
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+from PIL import Image
+
+from .cancellation import current_token
+from ..config import Config
+
+
+# ---------------------------------------------------------------------------
+# Stage implementations, shared by the in-thread and in-process paths
+# ---------------------------------------------------------------------------
+
+def decode_image(data):
+    """Decodes image bytes into an RGB PIL Image."""
+    return Image.open(BytesIO(data)).convert("RGB")
+
+
+def thumbnail_image(image, max_size):
+    """Resizes an image in place to fit within max_size, keeping aspect ratio."""
+    if image.width > max_size or image.height > max_size:
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    return image
+
+
+def encode_image(image, format="PNG", **params):
+    """Encodes a PIL Image to bytes with the given format and save options."""
+    if format.upper() in ("JPEG", "JPG") and image.mode not in ("RGB", "L"):
+        # Dropping the alpha channel would leave cutouts on black
+        if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+            image = composite_image(Image.new("RGB", image.size, "white"), image.convert("RGBA"))
+        else:
+            image = image.convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, format=format, **params)
+    return buffer.getvalue()
+
+
+def smart_crop_box(image, width, height, smart_crop=None):
+    """Runs SmartCrop analysis and returns the best (x0, y0, x1, y1) box."""
+    if smart_crop is None:
+        import smartcrop
+        smart_crop = smartcrop.SmartCrop()
+
+    result = smart_crop.crop(image if image.mode == "RGB" else image.convert("RGB"), width, height)
+    top = result['top_crop']
+    return (top['x'], top['y'], top['x'] + top['width'], top['y'] + top['height'])
+
+
+def composite_image(background, foreground):
+    """Pastes an RGBA foreground onto an RGB copy of background using its alpha."""
+    background = background.convert("RGB")
+    if background.size != foreground.size:
+        background = background.resize(foreground.size)
+    background.paste(foreground, (0, 0), foreground.getchannel('A'))
+    return background
+
+
+# ---------------------------------------------------------------------------
+# Shared-memory transport
+# ---------------------------------------------------------------------------
+
+# Image modes whose pixels round-trip through a plain uint8 array
+SHAREABLE_MODES = ("L", "RGB", "RGBA")
+
+def _to_shared(image):
+    """Copies an image's pixels into a new shared memory block."""
+    array = np.asarray(image)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str, image.mode)
+
+
+def _from_shared(descriptor, unlink=False):
+    """Rebuilds an image from a shared memory descriptor and releases the block."""
+    name, shape, dtype, mode = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        image = Image.fromarray(array.copy())
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+    return image
+
+
+def _return_shared(image):
+    """Publishes a result image from a worker; the caller unlinks it."""
+    shm, descriptor = _to_shared(image)
+    shm.close()
+    return descriptor
+
+
+def _unlink_shared(descriptor):
+    """Releases a result block nobody will read."""
+    shm = shared_memory.SharedMemory(name=descriptor[0])
+    shm.close()
+    shm.unlink()
+
+
+def _release_abandoned(future, shared, returns_shared):
+    """
+    Done-callback of a job whose caller stopped waiting for it.
+
+    Releases the job's input blocks only now that the worker has finished
+    reading them, and the result block it published for nobody.
+    """
+    for shm in shared:
+        shm.close()
+        shm.unlink()
+    if returns_shared and not future.cancelled() and future.exception() is None:
+        _unlink_shared(future.result())
+
+
+def _worker_decode(data):
+    return _return_shared(decode_image(data))
+
+
+def _worker_thumbnail(descriptor, max_size):
+    return _return_shared(thumbnail_image(_from_shared(descriptor), max_size))
+
+
+def _worker_encode(descriptor, format, params):
+    return encode_image(_from_shared(descriptor), format, **params)
+
+
+def _worker_smart_crop_box(descriptor, width, height):
+    return smart_crop_box(_from_shared(descriptor), width, height)
+
+
+def _worker_composite(background, foreground):
+    return _return_shared(composite_image(_from_shared(background), _from_shared(foreground)))
+
+
+class CPUPool:
+    """Runs CPU-bound image stages in worker processes when it pays off"""
+
+    def __init__(self, config=None):
+        self.config = config or Config()
+        self.workers = self.config.CPU_POOL_WORKERS
+        self.min_pixels = self.config.CPU_POOL_MIN_PIXELS
+
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """Whether offloading is configured at all."""
+        return self.workers > 0
+
+    def _get_executor(self):
+        """Creates the process pool on first use."""
+        with self._lock:
+            if self._executor is None:
+                context = get_context(self.config.CPU_POOL_START_METHOD)
+                if self.config.CPU_POOL_START_METHOD == 'forkserver':
+                    # Import once in the fork server instead of in every worker
+                    context.set_forkserver_preload([__name__])
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=context
+                )
+                print(f"CPU pool started with {self.workers} workers.")
+            return self._executor
+
+    def should_offload(self, pixels):
+        """
+        Decides whether a stage is worth sending to the pool.
+
+        Args:
+            pixels (int): Number of pixels the stage works on
+
+        Returns:
+            bool: True if the pool is enabled and the image is large enough
+        """
+        return self.enabled and pixels >= self.min_pixels
+
+    def _should_offload_image(self, image):
+        """Like should_offload, limited to modes that map 1:1 onto arrays."""
+        return image.mode in SHAREABLE_MODES and self.should_offload(image.width * image.height)
+
+    def _submit(self, fn, *args, shared=(), returns_shared=False):
+        """
+        Runs fn in the pool and waits for its result.
+
+        Args:
+            fn (callable): Module-level worker function
+            *args: Arguments for fn
+            shared (tuple): Shared memory blocks to release afterwards
+            returns_shared (bool): Whether fn returns a shared memory
+                descriptor, which is released if the caller gives up
+
+        Returns:
+            The worker's result, or None if the pool broke
+
+        Raises:
+            DeadlineExceeded: If the active cancel token expires first
+        """
+        token = current_token()
+        abandoned = False
+        try:
+            future = self._get_executor().submit(fn, *args)
+            try:
+                return future.result(timeout=token.remaining if token else None)
+            except TimeoutError:
+                # Drop the job if it is still queued. A running job keeps its
+                # blocks until it finishes, then releases them and its result
+                if not future.cancel():
+                    abandoned = True
+                    future.add_done_callback(
+                        lambda done: _release_abandoned(done, shared, returns_shared)
+                    )
+                token.check()
+                raise
+        except BrokenProcessPool:
+            print("CPU pool broke, falling back to in-thread execution.")
+            with self._lock:
+                self._executor = None
+            return None
+        finally:
+            if not abandoned:
+                for shm in shared:
+                    shm.close()
+                    shm.unlink()
+
+    def decode(self, data):
+        """
+        Decodes image bytes into an RGB image.
+
+        Args:
+            data (bytes): Encoded image
+
+        Returns:
+            PIL.Image: Decoded RGB image
+        """
+        if self.enabled:
+            # Only the header is read here, pixels are decoded in the worker
+            width, height = Image.open(BytesIO(data)).size
+            if self.should_offload(width * height):
+                descriptor = self._submit(_worker_decode, data, returns_shared=True)
+                if descriptor is not None:
+                    return _from_shared(descriptor, unlink=True)
+        return decode_image(data)
+
+    def thumbnail(self, image, max_size):
+        """
+        Limits an image to max_size, see ``ImageUtils.compress_image``.
+
+        Offloaded images are returned as new objects instead of being
+        resized in place.
+        """
+        needs_resize = image.width > max_size or image.height > max_size
+        if needs_resize and self._should_offload_image(image):
+            shm, descriptor = _to_shared(image)
+            result = self._submit(
+                _worker_thumbnail, descriptor, max_size, shared=(shm,), returns_shared=True
+            )
+            if result is not None:
+                return _from_shared(result, unlink=True)
+        return thumbnail_image(image, max_size)
+
+    def encode(self, image, format="PNG", **params):
+        """
+        Encodes an image to bytes.
+
+        Args:
+            image (PIL.Image): Image to encode
+            format (str): Output format
+            **params: Encoder options passed to ``PIL.Image.save``
+
+        Returns:
+            bytes: Encoded image
+        """
+        if self._should_offload_image(image):
+            shm, descriptor = _to_shared(image)
+            data = self._submit(_worker_encode, descriptor, format, params, shared=(shm,))
+            if data is not None:
+                return data
+        return encode_image(image, format, **params)
+
+    def smart_crop_box(self, image, width, height, smart_crop=None):
+        """
+        Finds the best SmartCrop box for the target size.
+
+        Args:
+            image (PIL.Image): Input image
+            width (int): Target width
+            height (int): Target height
+            smart_crop: SmartCrop instance for in-thread runs
+
+        Returns:
+            tuple: (x0, y0, x1, y1) crop box
+        """
+        if self._should_offload_image(image):
+            shm, descriptor = _to_shared(image)
+            box = self._submit(_worker_smart_crop_box, descriptor, width, height, shared=(shm,))
+            if box is not None:
+                return box
+        return smart_crop_box(image, width, height, smart_crop)
+
+    def composite(self, background, foreground):
+        """
+        Pastes an RGBA foreground onto a background using its alpha channel.
+
+        Args:
+            background (PIL.Image): Background, resized to the foreground if needed
+            foreground (PIL.Image): RGBA foreground
+
+        Returns:
+            PIL.Image: RGB composite
+        """
+        if (self._should_offload_image(foreground)
+                and background.mode in SHAREABLE_MODES):
+            bg_shm, bg_descriptor = _to_shared(background)
+            fg_shm, fg_descriptor = _to_shared(foreground)
+            result = self._submit(
+                _worker_composite, bg_descriptor, fg_descriptor,
+                shared=(bg_shm, fg_shm), returns_shared=True
+            )
+            if result is not None:
+                return _from_shared(result, unlink=True)
+        return composite_image(background, foreground)
+
+    def get_status(self):
+        """Reports the pool configuration for /status."""
+        return {
+            'workers': self.workers,
+            'min_pixels': self.min_pixels,
+            'started': self._executor is not None
+        }
+
+    def shutdown(self):
+        """Stops the worker processes."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+# Global CPU pool instance
+cpu_pool = CPUPool()
@@ -0,0 +1,72 @@
+"""
+In-process metrics for AutoRender AI
+
+A small registry of counters and timing observations, reported by the
+/metrics endpoint. Values are per worker process.
+"""
+
+import threading
+
+
+class Metrics:
+    """Thread-safe counters and value observations"""
+
+    def __init__(self):
+        self.counters = {}
+        self.observations = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        """
+        Adds to a counter.
+
+        Args:
+            name (str): Counter name, dotted by area (e.g. 'detection.coalesced')
+            value (int): Amount to add
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """
+        Records one observation of a value such as a duration or a size.
+
+        Args:
+            name (str): Observation name
+            value (float): Observed value
+        """
+        with self._lock:
+            stats = self.observations.setdefault(
+                name, {'count': 0, 'sum': 0.0, 'min': value, 'max': value}
+            )
+            stats['count'] += 1
+            stats['sum'] += value
+            stats['min'] = min(stats['min'], value)
+            stats['max'] = max(stats['max'], value)
+
+    def snapshot(self):
+        """
+        Returns the current values.
+
+        Returns:
+            dict: Counters and observation summaries with their means
+        """
+        with self._lock:
+            observations = {
+                name: {**stats, 'mean': stats['sum'] / stats['count']}
+                for name, stats in self.observations.items()
+            }
+            return {
+                'counters': dict(self.counters),
+                'observations': observations
+            }
+
+    def reset(self):
+        """Clears all metrics."""
+        with self._lock:
+            self.counters.clear()
+            self.observations.clear()
+
+
+# Global metrics registry
+metrics = Metrics()
@@ -0,0 +1,205 @@
+"""
+Configurable output encoding for AutoRender AI
+
+PNG at PIL's default compression is a large share of the latency of
+endpoints that return cutouts. An OutputEncoder picks the output format and
+encoder settings per request, starting from a named preset (an endpoint's
+default or the request's 'encoding' parameter) and applying individual
+overrides. It records the encoded size and encode time of every image so the
+trade-off can be tuned from responses and /metrics.
+"""
+
+import base64
+import time
+
+from .cpu_pool import cpu_pool
+from .metrics import metrics
+
+MIME_TYPES = {'PNG': "image/png", 'WEBP': "image/webp", 'JPEG': "image/jpeg"}
+FORMAT_ALIASES = {'JPG': 'JPEG'}
+
+# Save options each format accepts, with the type requests are parsed into
+FORMAT_OPTIONS = {
+    'PNG': {'compress_level': int, 'optimize': bool},
+    'WEBP': {'quality': int, 'lossless': bool, 'method': int},
+    'JPEG': {'quality': int, 'subsampling': int, 'optimize': bool, 'progressive': bool},
+}
+OPTION_RANGES = {'compress_level': (0, 9), 'quality': (0, 100), 'method': (0, 6), 'subsampling': (0, 2)}
+SUBSAMPLING_NAMES = {'4:4:4': 0, '4:2:2': 1, '4:2:0': 2}
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+class OutputEncoder:
+    """Encodes response images with one format and set of save options"""
+
+    def __init__(self, format="PNG", **options):
+        """
+        Args:
+            format (str): Output format, PNG, WEBP or JPEG
+            **options: Save options, see FORMAT_OPTIONS
+
+        Raises:
+            ValueError: If the format or an option value is not supported
+        """
+        format = str(format).upper()
+        self.format = FORMAT_ALIASES.get(format, format)
+        if self.format not in FORMAT_OPTIONS:
+            raise ValueError(f"Unsupported output format '{format}'. Use PNG, WEBP or JPEG.")
+
+        self.options = {}
+        for name, value in options.items():
+            self.set_option(name, value)
+
+        self.images = 0
+        self.bytes = 0
+        self.encode_ms = 0.0
+
+    @classmethod
+    def from_preset(cls, name, config):
+        """
+        Creates an encoder from one of ``Config.OUTPUT_PRESETS``.
+
+        Args:
+            name (str): Preset name, e.g. 'png-fast' or 'webp-lossless'
+            config: Configuration object
+
+        Returns:
+            OutputEncoder: Encoder with the preset's format and options
+
+        Raises:
+            ValueError: If the preset does not exist
+        """
+        preset = config.OUTPUT_PRESETS.get(str(name).lower())
+        if preset is None:
+            raise ValueError(
+                f"Unknown encoding '{name}'. Use one of: {', '.join(config.OUTPUT_PRESETS)}."
+            )
+        return cls(**preset)
+
+    @classmethod
+    def from_request(cls, form, endpoint, config):
+        """
+        Creates an encoder for the current request.
+
+        The preset is the request's 'encoding' parameter, or the endpoint's
+        entry in ``Config.OUTPUT_ENDPOINT_PRESETS``, or ``Config.OUTPUT_PRESET``.
+        A 'format' parameter switches to that format's preset of the same
+        name, and 'quality', 'compress_level', 'lossless', 'method',
+        'subsampling', 'optimize' and 'progressive' override single options.
+        Options that do not apply to the chosen format are ignored.
+
+        Args:
+            form (dict): Request parameters
+            endpoint (str): Endpoint name, e.g. 'remove-bg'
+            config: Configuration object
+
+        Returns:
+            OutputEncoder: Encoder for the request's response images
+
+        Raises:
+            ValueError: If a preset, format or option is invalid
+        """
+        preset = form.get('encoding') or config.OUTPUT_ENDPOINT_PRESETS.get(endpoint, config.OUTPUT_PRESET)
+        encoder = cls.from_preset(preset, config)
+
+        format = form.get('format')
+        if format:
+            format = str(format).upper()
+            format = FORMAT_ALIASES.get(format, format)
+            if format not in FORMAT_OPTIONS:
+                raise ValueError(f"Unsupported output format '{format}'. Use PNG, WEBP or JPEG.")
+            if format != encoder.format:
+                encoder = cls.from_preset(format, config)
+
+        for name in FORMAT_OPTIONS[encoder.format]:
+            value = form.get(name)
+            if value is not None and value != '':
+                encoder.set_option(name, value)
+        return encoder
+
+    def set_option(self, name, value):
+        """
+        Sets one save option, parsing request strings.
+
+        Args:
+            name (str): Option name
+            value: Option value; subsampling also accepts '4:2:0' style names
+
+        Raises:
+            ValueError: If the option does not apply to the format or is out of range
+        """
+        kind = FORMAT_OPTIONS[self.format].get(name)
+        if kind is None:
+            raise ValueError(f"Option '{name}' does not apply to {self.format}.")
+
+        if kind is bool:
+            value = _parse_bool(value)
+        else:
+            value = SUBSAMPLING_NAMES.get(value, value) if name == 'subsampling' else value
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid value for '{name}': {value}")
+            low, high = OPTION_RANGES[name]
+            if not low <= value <= high:
+                raise ValueError(f"'{name}' must be between {low} and {high}.")
+        self.options[name] = value
+
+    @property
+    def mime_type(self):
+        """MIME type of the encoded images."""
+        return MIME_TYPES[self.format]
+
+    def encode(self, image):
+        """
+        Encodes an image and records its size and encode time.
+
+        Args:
+            image (PIL.Image): Image to encode
+
+        Returns:
+            bytes: Encoded image
+        """
+        start = time.perf_counter()
+        data = cpu_pool.encode(image, self.format, **self.options)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        self.images += 1
+        self.bytes += len(data)
+        self.encode_ms += elapsed_ms
+        metrics.observe(f"encode.{self.format.lower()}.ms", elapsed_ms)
+        metrics.observe(f"encode.{self.format.lower()}.bytes", len(data))
+        return data
+
+    def to_base64(self, image):
+        """
+        Encodes an image to a base64 string.
+
+        Args:
+            image (PIL.Image): Image to encode
+
+        Returns:
+            str: Base64 encoded image
+        """
+        return base64.b64encode(self.encode(image)).decode("utf-8")
+
+    def report(self):
+        """
+        Returns the settings used and totals over the images encoded so far.
+
+        Returns:
+            dict: Format, MIME type, options, image count, bytes and encode time
+        """
+        return {
+            'format': self.format,
+            'mime_type': self.mime_type,
+            'options': dict(self.options),
+            'images': self.images,
+            'bytes': self.bytes,
+            'encode_ms': round(self.encode_ms, 2)
+        }
@@ -0,0 +1,148 @@
+"""
+Near-duplicate result cache for AutoRender AI
+
+Sellers upload the same photo again after re-saving, resizing or
+recompressing it. The bytes differ, so exact caches miss, but the results
+(a segmentation mask, detection boxes) still apply after scaling to the new
+size. A PerceptualCache finds earlier images by a 64-bit difference hash
+(dHash) within a Hamming distance. A small color thumbnail then confirms the
+match, so images that only share their brightness gradients are not reused.
+Exact repeats and near-duplicate hits are counted separately in /metrics.
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from .metrics import metrics
+
+# Images whose aspect ratios differ by more than this are never matched
+MAX_ASPECT_CHANGE = 0.02
+
+
+def dhash(image, hash_size=8):
+    """
+    Computes the difference hash of an image.
+
+    Each bit tells whether a pixel of a (hash_size + 1) x hash_size
+    grayscale thumbnail is brighter than its right neighbour.
+
+    Args:
+        image (PIL.Image): Input image
+        hash_size (int): Rows and bits per row
+
+    Returns:
+        int: hash_size * hash_size bit hash
+    """
+    small = image.resize((hash_size + 1, hash_size), Image.Resampling.BOX).convert("L")
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def color_signature(image, size=16):
+    """Returns a small RGB thumbnail as floats between 0 and 1."""
+    small = image.resize((size, size), Image.Resampling.BOX).convert("RGB")
+    return np.asarray(small, dtype=np.float32) / 255
+
+
+class PerceptualCache:
+    """LRU cache of results keyed by parameters and a perceptual image hash"""
+
+    def __init__(self, name, max_entries=256):
+        """
+        Args:
+            name (str): Metrics prefix, e.g. 'masks'
+            max_entries (int): Results kept before the least recently used is dropped
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (key, fingerprint) -> entry dict
+        self._lock = threading.Lock()
+
+    def lookup(self, image, key, fingerprint, max_distance=4, max_difference=0.04):
+        """
+        Finds a cached result for the same or a near-identical image.
+
+        Args:
+            image (PIL.Image): Input image
+            key: Hashable parameters the result depends on
+            fingerprint (str): Exact digest of the image's pixels
+            max_distance (int): Highest Hamming distance between hashes
+            max_difference (float): Highest mean absolute difference of the
+                color thumbnails, between 0 and 1
+
+        Returns:
+            tuple: (result, size of the image it was computed for, whether the
+                hit is exact), or None on a miss
+        """
+        with self._lock:
+            entry = self.entries.get((key, fingerprint))
+            if entry is not None:
+                self.entries.move_to_end((key, fingerprint))
+                metrics.increment(f"{self.name}.exact_hits")
+                return entry['value'], entry['size'], True
+
+        image_hash = dhash(image)
+        aspect = image.width / image.height
+        signature = None
+        best, best_distance = None, max_distance + 1
+
+        with self._lock:
+            candidates = [
+                (entry_key, entry) for entry_key, entry in self.entries.items()
+                if entry_key[0] == key
+                and abs(entry['size'][0] / entry['size'][1] / aspect - 1) <= MAX_ASPECT_CHANGE
+            ]
+        for entry_key, entry in candidates:
+            distance = bin(entry['hash'] ^ image_hash).count('1')
+            if distance >= best_distance:
+                continue
+            if signature is None:
+                signature = color_signature(image)
+            if float(np.abs(entry['signature'] - signature).mean()) <= max_difference:
+                best, best_distance = (entry_key, entry), distance
+
+        if best is None:
+            metrics.increment(f"{self.name}.misses")
+            return None
+
+        with self._lock:
+            if best[0] in self.entries:
+                self.entries.move_to_end(best[0])
+        metrics.increment(f"{self.name}.near_hits")
+        metrics.observe(f"{self.name}.near_hit_distance", best_distance)
+        return best[1]['value'], best[1]['size'], False
+
+    def store(self, image, key, fingerprint, value):
+        """
+        Caches a result computed for an image.
+
+        Args:
+            image (PIL.Image): Image the result was computed for
+            key: Hashable parameters the result depends on
+            fingerprint (str): Exact digest of the image's pixels
+            value: Result to reuse
+        """
+        entry = {
+            'hash': dhash(image),
+            'signature': color_signature(image),
+            'size': image.size,
+            'value': value
+        }
+        with self._lock:
+            self.entries[(key, fingerprint)] = entry
+            self.entries.move_to_end((key, fingerprint))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drops all cached results."""
+        with self._lock:
+            self.entries.clear()
+
+    def get_status(self):
+        """Reports the cache size for /status."""
+        return {'entries': len(self.entries), 'max_entries': self.max_entries}
@@ -0,0 +1,99 @@
+"""
+Single-flight coalescing of identical in-flight work
+
+When several requests ask for the same result at the same time, only the
+first one computes it; the others wait for and share its result.
+"""
+
+import threading
+
+from .cancellation import OperationCancelled, current_token
+from .metrics import metrics
+
+
+class _Call:
+    """One in-flight computation and the callers waiting on it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key"""
+
+    def __init__(self, name):
+        """
+        Args:
+            name (str): Prefix for this group's metrics
+        """
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Runs fn, unless a call with the same key is already running.
+
+        Waiting callers give up when their own active cancel token expires.
+        If the computing call is cancelled, a waiting caller takes over the
+        computation instead of failing with it.
+
+        Args:
+            key (hashable): Operation fingerprint
+            fn (callable): Computes the result, called without arguments
+
+        Returns:
+            The result of fn, possibly computed by another thread
+
+        Raises:
+            OperationCancelled: If this caller's own token is cancelled
+            Exception: Whatever fn raised, re-raised in every waiting caller
+        """
+        token = current_token()
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+
+            if leader:
+                return self._compute(key, call, fn)
+
+            metrics.increment(f"{self.name}.coalesced")
+            self._wait(call, token)
+            if isinstance(call.error, OperationCancelled):
+                continue  # The leader's request was aborted, not ours
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+    @staticmethod
+    def _wait(call, token):
+        """Waits for a call to finish, within the caller's deadline."""
+        while not call.done.wait(0.1 if token is None or token.remaining is None
+                                 else min(0.1, token.remaining)):
+            if token is not None:
+                token.check()
+
+    def _compute(self, key, call, fn):
+        """Runs fn as the leader and publishes its outcome."""
+        metrics.increment(f"{self.name}.computed")
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    @property
+    def in_flight(self):
+        """Number of distinct computations currently running."""
+        with self._lock:
+            return len(self._calls)
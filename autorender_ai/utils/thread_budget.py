@@ -0,0 +1,196 @@
+"""
+CPU thread budgeting for AutoRender AI
+
+Torch, ONNX Runtime (inside rembg) and OpenCV each size their thread pools
+to every core of the machine, in every worker process. With several gunicorn
+workers on one host that oversubscribes the CPU many times over and
+inference gets slower, not faster. A ThreadBudget divides the host's cores
+among the worker processes and caps each library's pool to the worker's
+share. Optionally each worker is pinned to its own slice of cores.
+
+Within one worker the libraries run one after another for a request, so
+each gets the worker's full share for its intra-op pool; inter-op pools,
+which would multiply with it, are limited to one thread.
+"""
+
+import os
+import tempfile
+import threading
+
+from ..config import Config
+
+# Environment variables read by OpenMP/BLAS runtimes and by rembg, which
+# passes OMP_NUM_THREADS on to its ONNX Runtime session options
+THREAD_ENV_VARS = (
+    'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS'
+)
+
+
+def available_cores():
+    """Returns the cores this process may run on, respecting its affinity mask."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def limit_threads(threads):
+    """
+    Caps the thread pools of torch, ONNX Runtime and OpenCV in this process.
+
+    Args:
+        threads (int): Threads per library
+
+    Returns:
+        dict: The setting applied to each library
+    """
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+
+    applied = {'torch': None, 'torch_interop': None, 'onnxruntime': threads, 'opencv': None}
+
+    import torch
+    torch.set_num_threads(threads)
+    applied['torch'] = torch.get_num_threads()
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # Only allowed before the first parallel torch operation
+    applied['torch_interop'] = torch.get_num_interop_threads()
+
+    try:
+        import cv2
+    except ImportError:
+        pass
+    else:
+        cv2.setNumThreads(threads)
+        applied['opencv'] = cv2.getNumThreads()
+    return applied
+
+
+class ThreadBudget:
+    """Divides the host's cores among worker processes and their libraries"""
+
+    def __init__(self, config=None, workers=None):
+        """
+        Args:
+            config: Configuration object
+            workers (int): Processes sharing the host, defaults to
+                ``Config.THREAD_BUDGET_WORKERS``
+        """
+        self.config = config or Config()
+        self.mode = self.config.THREAD_BUDGET
+        self.workers = max(1, workers or self.config.THREAD_BUDGET_WORKERS)
+
+        self.threads = None
+        self.slot = None
+        self.affinity = None
+        self.applied = {}
+        self._cores = None
+        self._slot_file = None
+        self._pid = None  # Process the budget was applied in
+        self._lock = threading.Lock()
+
+    def cores(self):
+        """Returns the cores to divide, limited by ``Config.THREAD_BUDGET_CORES``."""
+        # Read once: pinning this worker narrows its own affinity mask
+        if self._cores is None:
+            self._cores = available_cores()
+            if self.config.THREAD_BUDGET_CORES:
+                self._cores = self._cores[:self.config.THREAD_BUDGET_CORES]
+        return self._cores
+
+    def threads_per_worker(self):
+        """Returns each worker's share of the cores, at least one."""
+        if self.config.THREAD_BUDGET_THREADS:
+            return self.config.THREAD_BUDGET_THREADS
+        return max(1, len(self.cores()) // self.workers)
+
+    def _claim_slot(self):
+        """
+        Claims the lowest free worker slot on this host.
+
+        Slots are held by a lock on a per-slot file for the life of the
+        process, so a restarted worker takes over the slot of the one it
+        replaces.
+
+        Returns:
+            int: Slot index, or None if all slots are taken
+        """
+        import fcntl
+
+        directory = os.path.join(tempfile.gettempdir(), "autorender-cpu-slots")
+        os.makedirs(directory, exist_ok=True)
+        for slot in range(self.workers):
+            handle = open(os.path.join(directory, f"slot-{slot}.lock"), 'w')
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                continue
+            self._slot_file = handle
+            return slot
+        return None
+
+    def apply(self):
+        """
+        Applies the budget to this process.
+
+        Call once at process start, before models are loaded: ONNX Runtime
+        sessions read their thread count when they are created.
+
+        Returns:
+            dict: Effective settings, see ``get_status``
+        """
+        if self.mode == 'off':
+            return self.get_status()
+
+        if self._slot_file is not None and self._pid != os.getpid():
+            # Inherited from the process this one was forked from
+            self._slot_file.close()
+            self._slot_file = None
+        self._pid = os.getpid()
+
+        self.threads = self.threads_per_worker()
+        if self.config.THREAD_BUDGET_AFFINITY and hasattr(os, 'sched_setaffinity'):
+            self.slot = self._claim_slot()
+            if self.slot is not None:
+                cores = self.cores()
+                first = self.slot * self.threads % len(cores)
+                self.affinity = cores[first:first + self.threads] or cores
+                os.sched_setaffinity(0, self.affinity)
+
+        self.applied = limit_threads(self.threads)
+        print(f"Thread budget: {self.threads} threads per library for 1 of {self.workers} workers"
+              + (f", pinned to cores {self.affinity}" if self.affinity else "") + ".")
+        return self.get_status()
+
+    def ensure_applied(self):
+        """
+        Applies the budget unless this process already did.
+
+        Called on a worker's first request rather than when the app is
+        created: with ``gunicorn --preload`` the app is created once in the
+        master, and workers forked from it would all inherit one slot.
+        """
+        if self._pid == os.getpid() or self.mode == 'off':
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self.apply()
+
+    def get_status(self):
+        """Reports the effective thread settings for /status."""
+        return {
+            'mode': self.mode,
+            'cores': len(self.cores()),
+            'workers': self.workers,
+            'threads_per_worker': self.threads,
+            'slot': self.slot,
+            'affinity': self.affinity,
+            'libraries': self.applied,
+            'pid': os.getpid()
+        }
+
+
+# Global thread budget of this process, applied on the app's first request
+thread_budget = ThreadBudget()
@@ -2,8 +2,13 @@
 Basic tests for AutoRender AI Flask application
 """
 
+from io import BytesIO
+
 import pytest
+from PIL import Image
+
 from autorender_ai import create_app
+from autorender_ai.services.pipeline_service import PipelineService
 
 
 @pytest.fixture
@@ -63,4 +68,59 @@ def test_missing_image_endpoints(client):
     
     # Test swap-background endpoint  
     response = client.post('/swap-background')
-    assert response.status_code == 400 
\ No newline at end of file
+    assert response.status_code == 400 
+
+
+def _png_upload(size=(64, 48)):
+    """Build an in-memory PNG upload"""
+    buffer = BytesIO()
+    Image.new("RGB", size, (200, 10, 10)).save(buffer, format="PNG")
+    buffer.seek(0)
+    return buffer
+
+
+def test_pipeline_endpoint(client):
+    """Test the pipeline endpoint with model-free steps"""
+    response = client.post('/pipeline', data={
+        'image': (_png_upload((64, 48)), 'test.png'),
+        'steps': '[{"op": "compress", "max_size": 32, "output": true}, {"op": "compress", "max_size": 16}]'
+    })
+    assert response.status_code == 200
+
+    data = response.get_json()
+    assert data['success'] is True
+    assert len(data['outputs']) == 1
+    assert data['outputs'][0]['op'] == 'compress'
+
+    response = client.post('/pipeline', data={
+        'image': (_png_upload(), 'test.png'),
+        'steps': '[{"op": "unknown"}]'
+    })
+    assert response.status_code == 400
+
+    # Flags parse like /remove-bg's, anything else is rejected before any work
+    response = client.post('/pipeline', data={
+        'image': (_png_upload(), 'test.png'),
+        'steps': '[{"op": "remove_bg", "full_resolution": "maybe"}]'
+    })
+    assert response.status_code == 400
+    assert PipelineService._flag({'op': 'remove_bg', 'full_resolution': "false"}, 'full_resolution') is False
+    assert PipelineService._flag({'op': 'remove_bg', 'full_resolution': True}, 'full_resolution') is True
+
+
+def test_metrics_endpoint(client):
+    """Test the metrics endpoint"""
+    response = client.get('/metrics')
+    assert response.status_code == 200
+
+    data = response.get_json()
+    assert 'counters' in data
+    assert 'observations' in data
+
+
+def test_invalid_request_timeout(client):
+    """Test that a malformed deadline header is rejected"""
+    response = client.post('/remove-bg', headers={'X-Request-Timeout': 'soon'}, data={
+        'image': (_png_upload(), 'test.png')
+    })
+    assert response.status_code == 400
@@ -0,0 +1,202 @@
+"""
+Tests for the background service
+"""
+
+import threading
+import time
+import zipfile
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+import torch
+from PIL import Image
+
+from autorender_ai.config import Config
+from autorender_ai.models.ai_models import model_manager
+from autorender_ai.services import image_utils
+from autorender_ai.services.background_service import BackgroundService, mask_cache
+from autorender_ai.services.image_utils import ImageUtils
+from autorender_ai.services.video_service import VideoService
+from autorender_ai.utils.cancellation import CancelToken, DeadlineExceeded
+from autorender_ai.utils.metrics import metrics
+
+
+class FakeDiffusionPipe:
+    """Runs a fixed number of steps, calling the step-end callback"""
+
+    def __init__(self, steps=10, delay=0.05):
+        self.num_timesteps = steps
+        self.delay = delay
+        self.steps_run = 0
+        self.finished = threading.Event()
+
+    def __call__(self, prompt, width, height, callback_on_step_end=None, **kwargs):
+        try:
+            for step in range(self.num_timesteps):
+                self.steps_run += 1
+                time.sleep(self.delay)
+                callback_on_step_end(self, step, step, {'latents': torch.zeros(1, 4, height // 8, width // 8)})
+            return SimpleNamespace(images=[Image.new("RGB", (width, height), "blue")])
+        finally:
+            self.finished.set()
+
+
+@pytest.fixture
+def fake_pipe(monkeypatch):
+    pipe = FakeDiffusionPipe()
+    monkeypatch.setattr(model_manager, 'load_stable_diffusion_model', lambda: pipe)
+    monkeypatch.setattr(model_manager, 'segment', lambda image, **kwargs: image.convert("RGBA"))
+    return pipe
+
+
+def test_swap_background_stream_events(fake_pipe):
+    service = BackgroundService()
+    events = list(service.swap_background_stream(
+        Image.new("RGB", (64, 64)), "beach", preview_every=4
+    ))
+    names = [name for name, _ in events]
+
+    assert names.count('progress') == 10
+    assert names.count('preview') == 2
+    assert names[-1] == 'result'
+    assert events[-1][1]['image'].size == (64, 64)
+    assert names.index('preview') == 4
+    assert events[4][1]['image'].size == (8, 8)
+
+
+def test_swap_background_stream_stops_when_closed(fake_pipe):
+    service = BackgroundService()
+    events = service.swap_background_stream(Image.new("RGB", (64, 64)), "beach", preview_every=0)
+
+    assert next(events)[0] == 'progress'
+    events.close()
+
+    assert fake_pipe.finished.wait(5)
+    assert fake_pipe.steps_run < fake_pipe.num_timesteps
+
+
+def test_swap_background_stops_at_deadline(fake_pipe):
+    service = BackgroundService()
+    with pytest.raises(DeadlineExceeded):
+        service.swap_background(
+            Image.new("RGB", (32, 32), "red"), "forest", cancel_token=CancelToken(timeout=0.12)
+        )
+    assert fake_pipe.steps_run < fake_pipe.num_timesteps
+
+
+def test_upsample_mask_follows_guide_edges(monkeypatch):
+    guide = Image.new("RGB", (200, 100), "black")
+    guide.paste((255, 255, 255), (0, 0, 90, 100))
+    # A blurry low-resolution mask of the same object
+    mask = Image.new("L", (50, 25), 0)
+    mask.paste(255, (0, 0, 22, 25))
+    mask = mask.resize((10, 5), Image.Resampling.BILINEAR).resize((50, 25), Image.Resampling.BILINEAR)
+
+    refined = ImageUtils.upsample_mask(mask, guide, radius=2, eps=1e-4)
+    assert refined.size == guide.size and refined.mode == "L"
+    # The soft edge snaps to the guide's edge, where a plain resize stays soft
+    assert refined.getpixel((88, 50)) - refined.getpixel((91, 50)) > 80
+    resized = mask.resize(guide.size, Image.Resampling.BILINEAR)
+    assert resized.getpixel((88, 50)) - resized.getpixel((91, 50)) < 30
+
+    # Applied in bands of rows, with the same result
+    monkeypatch.setattr(image_utils, 'UPSAMPLE_BAND_PIXELS', guide.width * 7)
+    assert ImageUtils.upsample_mask(mask, guide, radius=2, eps=1e-4).tobytes() == refined.tobytes()
+
+
+def test_remove_background_full_resolution(monkeypatch):
+    calls = []
+
+    def fake_remove(image, only_mask=False, **kwargs):
+        calls.append(image.size)
+        mask = Image.new("L", image.size, 0)
+        mask.paste(255, (0, 0, image.width // 2, image.height))
+        return mask
+
+    monkeypatch.setattr(model_manager, 'segment', fake_remove)
+    service = BackgroundService()
+    image = Image.new("RGB", (2048, 1024), "white")
+
+    result = service.remove_background(image, full_resolution=True)
+    assert calls == [(1024, 512)]
+    assert result.size == (2048, 1024) and result.mode == "RGBA"
+    assert result.getpixel((10, 10))[3] == 255
+    assert result.getpixel((2040, 10))[3] == 0
+
+
+def test_video_reuses_masks_of_unchanged_frames(monkeypatch, tmp_path):
+    segmented = []
+
+    def fake_segment(image, only_mask=False, **kwargs):
+        segmented.append(image.size)
+        mask = Image.new("L", image.size, 0)
+        mask.paste(255, (0, 0, image.width // 2, image.height))
+        return mask
+
+    monkeypatch.setattr(model_manager, 'segment', fake_segment)
+    frames_dir = tmp_path / "frames"
+    frames_dir.mkdir()
+    for index, color in enumerate(["red", "red", "red", "blue", "blue"]):
+        Image.new("RGB", (32, 24), color).save(frames_dir / f"{index:03d}.png")
+
+    service = VideoService()
+    stats = service.process_video(str(frames_dir), str(tmp_path / "out.webp"), 'webp')
+    assert (stats['frames'], stats['segmented'], stats['skipped']) == (5, 2, 3)
+    assert len(segmented) == 2
+    with Image.open(tmp_path / "out.webp") as animation:
+        assert animation.is_animated and animation.mode == "RGBA"
+        assert animation.getpixel((30, 0))[3] == 0
+
+    service.process_video(str(frames_dir), str(tmp_path / "out.png"), 'apng')
+    with Image.open(tmp_path / "out.png") as animation:
+        assert animation.n_frames == 2  # Pillow merges unchanged frames
+    monkeypatch.setattr(service.config, 'VIDEO_MAX_APNG_FRAMES', 4)
+    with pytest.raises(ValueError):
+        service.process_video(str(frames_dir), str(tmp_path / "out.png"), 'apng')
+
+    service.process_video(str(frames_dir), str(tmp_path / "out.zip"), 'png')
+    with zipfile.ZipFile(tmp_path / "out.zip") as archive:
+        assert len(archive.namelist()) == 5
+
+    with pytest.raises(ValueError):
+        service.process_video(str(frames_dir), str(tmp_path / "out.mp4"), 'mp4')
+
+
+def test_near_duplicate_upload_reuses_mask(monkeypatch):
+    class PerceptualConfig(Config):
+        PERCEPTUAL_CACHE = True
+
+    segmented = []
+
+    def fake_segment(image, only_mask=False, **kwargs):
+        segmented.append(image.size)
+        mask = Image.new("L", image.size, 0)
+        mask.paste(255, (0, 0, image.width // 2, image.height))
+        return mask
+
+    monkeypatch.setattr(model_manager, 'segment', fake_segment)
+    mask_cache.clear()
+    service = BackgroundService(PerceptualConfig())
+
+    photo = Image.linear_gradient("L").resize((320, 240)).convert("RGB")
+    photo.paste((200, 40, 40), (60, 50, 180, 200))
+    first = service.remove_background(photo)
+
+    # The same photo, downscaled and recompressed by the seller
+    buffer = BytesIO()
+    photo.resize((240, 180)).save(buffer, format="JPEG", quality=70)
+    resaved = Image.open(BytesIO(buffer.getvalue())).convert("RGB")
+    second = service.remove_background(resaved)
+
+    assert segmented == [(320, 240)]
+    assert first.size == (320, 240) and second.size == (240, 180)
+    assert second.getpixel((10, 90))[3] > 200 and second.getpixel((230, 90))[3] < 50
+    assert metrics.snapshot()['counters']['masks.near_hits'] >= 1
+
+    service.remove_background(photo, bg_color="#ffffff")
+    assert segmented == [(320, 240)]
+    assert metrics.snapshot()['counters']['masks.exact_hits'] >= 1
+
+    service.remove_background(Image.new("RGB", (320, 240), "navy"))
+    assert len(segmented) == 2
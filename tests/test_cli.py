@@ -0,0 +1,73 @@
+"""
+Tests for the batch command-line interface
+"""
+
+import json
+
+import pytest
+
+from autorender_ai.cli import (
+    JOURNAL_NAME, _open_journal, _output_path, build_parser, load_items, read_journal
+)
+
+
+def test_load_items_from_directory(tmp_path):
+    (tmp_path / "b.png").write_bytes(b"")
+    (tmp_path / "nested").mkdir()
+    (tmp_path / "nested" / "a.JPG").write_bytes(b"")
+    (tmp_path / "notes.txt").write_text("skip")
+
+    items = load_items(str(tmp_path))
+    assert [item['id'] for item in items] == ["b.png", "nested/a.JPG"]
+
+
+def test_load_items_from_manifest(tmp_path):
+    manifest = tmp_path / "manifest.jsonl"
+    manifest.write_text(
+        json.dumps({'path': "shoe.jpg", 'prompt': "beach"}) + "\n\n"
+        + json.dumps({'path': "/abs/bag.jpg", 'id': "bag"}) + "\n"
+    )
+
+    first, second = load_items(str(manifest))
+    assert first == {'path': str(tmp_path / "shoe.jpg"), 'prompt': "beach", 'id': "shoe.jpg"}
+    assert second['id'] == "bag" and second['path'] == "/abs/bag.jpg"
+
+
+def test_load_items_coerces_csv_flags(tmp_path):
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("path,crops,full_resolution\na.jpg,false,1\nb.jpg,,\n")
+
+    first, second = load_items(str(manifest))
+    assert first['crops'] is False and first['full_resolution'] is True
+    assert 'crops' not in second
+
+    manifest.write_text("path,crops\na.jpg,maybe\n")
+    with pytest.raises(ValueError):
+        load_items(str(manifest))
+
+
+def test_output_path_stays_in_output_directory(tmp_path):
+    path = _output_path(str(tmp_path), {'id': "/nested/shoe.jpg"}, ".png")
+    assert path == str(tmp_path / "nested" / "shoe.png")
+    with pytest.raises(ValueError):
+        _output_path(str(tmp_path / "out"), {'id': "../../etc/x"}, ".png")
+
+
+def test_read_journal_skips_failed_and_truncated_lines(tmp_path):
+    (tmp_path / JOURNAL_NAME).write_text(
+        json.dumps({'id': "a", 'status': 'ok'}) + "\n"
+        + json.dumps({'id': "b", 'status': 'error'}) + "\n"
+        + '{"id": "c", "sta'
+    )
+    assert read_journal(str(tmp_path)) == {"a"}
+    assert read_journal(str(tmp_path / "missing")) == set()
+
+    # A resumed run starts its records on a new line
+    with _open_journal(str(tmp_path)) as journal:
+        journal.write(json.dumps({'id': "d", 'status': 'ok'}) + "\n")
+    assert read_journal(str(tmp_path)) == {"a", "d"}
+
+
+def test_parser_rejects_unknown_operation():
+    with pytest.raises(SystemExit):
+        build_parser().parse_args(["batch", "resize", "--input", "x", "--output", "y"])
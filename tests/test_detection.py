@@ -0,0 +1,168 @@
+"""
+Tests for the detection service
+"""
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from werkzeug.datastructures import MultiDict
+
+from autorender_ai.benchmark import compare_detections
+from autorender_ai.config import Config
+from autorender_ai.models.ai_models import model_manager
+from autorender_ai.routes.detection_routes import get_prompts
+from autorender_ai.services.detection_service import DetectionService, detection_cache
+
+
+class FakeBoxes:
+    """Minimal stand-in for ultralytics Boxes"""
+
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = torch.tensor(xyxy, dtype=torch.float32).reshape(-1, 4)
+        self.conf = torch.tensor(conf, dtype=torch.float32)
+        self.cls = torch.tensor(cls, dtype=torch.float32)
+
+    def __len__(self):
+        return len(self.conf)
+
+
+class FakeResult:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class FakeYOLO:
+    """Returns fixed boxes and records the classes it was asked for"""
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+        self.classes = None
+        self.calls = 0
+        self.options = {}
+        self.batch_sizes = []
+
+    def set_classes(self, classes):
+        self.classes = classes
+
+    def predict(self, source, conf, verbose=False, **kwargs):
+        self.calls += 1
+        self.options = kwargs
+        images = source if isinstance(source, list) else [source]
+        self.batch_sizes.append(len(images))
+        return [FakeResult(self.boxes) for _ in images]
+
+
+@pytest.fixture
+def fake_yolo(monkeypatch):
+    yolo = FakeYOLO(FakeBoxes(
+        [[0, 0, 10, 10], [20, 20, 40, 40], [5, 5, 15, 15]],
+        [0.9, 0.4, 0.7],
+        [0, 1, 1],
+    ))
+    monkeypatch.setattr(model_manager, 'load_yolo_model', lambda: yolo)
+    return yolo
+
+
+def test_normalize_prompts():
+    assert DetectionService.normalize_prompts("shoe, bag,shoe") == ["shoe", "bag"]
+    assert DetectionService.normalize_prompts(["hat", " "]) == ["hat"]
+    with pytest.raises(ValueError):
+        DetectionService.normalize_prompts("")
+
+
+def test_single_prompt_is_one_class(fake_yolo):
+    assert get_prompts(MultiDict({'prompt': "black leather bag, small"})) == ["black leather bag, small"]
+    assert get_prompts(MultiDict([('prompts', "shoe"), ('prompts', "bag")])) == ["shoe", "bag"]
+    assert get_prompts(MultiDict({'prompts': "shoe,bag"})) == ["shoe", "bag"]
+    assert get_prompts(MultiDict()) == []
+    with pytest.raises(ValueError):
+        get_prompts(MultiDict({'prompts': " , "}))
+
+    fake_yolo.boxes = FakeBoxes([[0, 0, 10, 10]], [0.9], [0])
+    crop = DetectionService().detect_and_crop(Image.new("RGB", (64, 64)), "black leather bag, small")
+    assert crop.size == (10, 10) and fake_yolo.classes == ["black leather bag, small"]
+
+
+def test_multi_prompt_single_pass(fake_yolo):
+    service = DetectionService()
+    info = service.get_detection_info(
+        Image.new("RGB", (64, 64)), ["shoe", "bag", "hat"], {"bag": 0.5}
+    )
+
+    assert fake_yolo.calls == 1
+    assert fake_yolo.classes == ["shoe", "bag", "hat"]
+    assert info['count'] == 2
+    assert info['classes']['shoe']['count'] == 1
+    assert info['classes']['bag']['detections'][0]['bbox'] == [5, 5, 15, 15]
+    assert info['classes']['hat']['count'] == 0
+
+
+def test_detect_and_crop_classes(fake_yolo):
+    service = DetectionService()
+    crops = service.detect_and_crop_classes(Image.new("RGB", (64, 64)), "shoe,bag", 0.3)
+
+    assert [crop.size for crop in crops['shoe']] == [(10, 10)]
+    assert len(crops['bag']) == 2
+
+
+def test_static_export_predicts_at_its_export_size(fake_yolo, monkeypatch):
+    monkeypatch.setattr(model_manager.config, 'YOLO_BACKEND', 'onnx')
+    monkeypatch.setattr(model_manager.config, 'YOLO_EXPORT_DYNAMIC', False)
+    monkeypatch.setattr(model_manager.config, 'YOLO_EXPORT_IMGSZ', 320)
+    monkeypatch.setattr(model_manager, 'get_yolo_predictor', lambda classes: fake_yolo)
+
+    DetectionService().detect(Image.new("RGB", (64, 64)), ["shoe", "bag"])
+    assert fake_yolo.options == {'imgsz': 320}
+
+    # Its input shape also fixes the batch at one image
+    DetectionService().detect(Image.new("RGB", (3000, 1000)), ["shoe", "bag"], tiled='on')
+    assert max(fake_yolo.batch_sizes) == 1 and fake_yolo.calls > 2
+
+
+def test_tile_grid_covers_image():
+    tiles = DetectionService.tile_grid(3000, 1000, 1280, 0.2)
+
+    assert tiles[0] == (0, 0, 1280, 1000)
+    assert tiles[-1][2] == 3000
+    assert all(x1 - x0 <= 1280 for x0, _, x1, _ in tiles)
+
+
+def test_tiled_detection_merges_overlapping_boxes(fake_yolo):
+    service = DetectionService()
+    boxes = np.array([[10, 10, 50, 50], [12, 12, 52, 52], [10, 10, 50, 50]], dtype=float)
+    keep = service.non_max_suppression(boxes, np.array([0.6, 0.9, 0.8]), np.array([0, 0, 1]), 0.5)
+    assert list(keep) == [1, 2]
+
+    detections = service.detect(Image.new("RGB", (3000, 1000)), ["shoe", "bag"], tiled='on')
+    assert fake_yolo.calls == 1  # 3 tiles and the full-image pass in one batch
+    assert any(d['bbox'][0] >= 1024 for d in detections)
+    assert detections == sorted(detections, key=lambda d: -d['confidence'])
+
+
+def test_near_duplicate_detections_are_rescaled(fake_yolo):
+    class PerceptualConfig(Config):
+        PERCEPTUAL_CACHE = True
+
+    detection_cache.clear()
+    service = DetectionService(PerceptualConfig())
+    photo = Image.linear_gradient("L").resize((64, 64)).convert("RGB")
+
+    first = service.detect(photo, "shoe,bag", 0.3)
+    resized = service.detect(photo.resize((128, 128)), "shoe,bag", 0.3)
+
+    assert fake_yolo.calls == 1
+    assert [d['bbox'] for d in resized] == [[x0 * 2, y0 * 2, x1 * 2, y1 * 2] for x0, y0, x1, y1 in
+                                            (d['bbox'] for d in first)]
+
+    service.detect(photo, "shoe,hat", 0.3)
+    assert fake_yolo.calls == 2  # Other parameters never share results
+
+
+def test_benchmark_compare_detections():
+    reference = (np.array([[0, 0, 10, 10], [20, 20, 30, 30]], dtype=float), np.array([0.9, 0.8]), np.array([0, 1]))
+    candidate = (np.array([[1, 1, 10, 10], [20, 20, 30, 30]], dtype=float), np.array([0.9, 0.8]), np.array([0, 0]))
+
+    result = compare_detections(reference, candidate)
+    assert result['matched'] == 1
+    assert result['reference'] == 2 and result['candidate'] == 2
@@ -0,0 +1,98 @@
+"""
+Tests for the load test harness
+"""
+
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from autorender_ai.config import Config
+from autorender_ai.loadtest import (
+    TrafficMix, compare_reports, encode_variant, parse_mix, run_load_test, saturation_reason,
+    start_local_server, summarize, synthetic_image
+)
+from autorender_ai.models.ai_models import model_manager
+from autorender_ai.utils.perceptual_cache import PerceptualCache
+from autorender_ai.utils.thread_budget import thread_budget
+
+
+def test_parse_mix_normalizes_weights():
+    assert parse_mix("remove-bg=3,detect=1") == {'remove-bg': 0.75, 'detect': 0.25}
+    with pytest.raises(ValueError):
+        parse_mix("upscale=1")
+
+
+def test_summarize_and_saturation():
+    records = [
+        {'endpoint': 'detect', 'status': 200, 'latency_ms': 10.0, 'finished_s': 0.0, 'repeat': False},
+        {'endpoint': 'detect', 'status': 200, 'latency_ms': 30.0, 'finished_s': 1.0, 'repeat': True},
+        {'endpoint': 'detect', 'status': 503, 'latency_ms': 5.0, 'finished_s': 1.5, 'repeat': False},
+        {'endpoint': 'detect', 'status': 200, 'latency_ms': 900.0, 'finished_s': 3.0, 'repeat': False},
+    ]
+    summary = summarize(records, duration=2, elapsed=3)
+    assert summary['offered_rps'] == 2.0 and summary['throughput_rps'] == 1.0
+    assert summary['error_rate'] == 0.25 and summary['statuses'] == {'200': 3, '503': 1}
+    assert summary['repeats'] == 1 and summary['max_ms'] == 900.0 and summary['backlog'] == 1
+
+    step = {'target_rps': 2, **summary}
+    assert "served" in saturation_reason(step, max_error_rate=0.5)
+    assert "error rate" in saturation_reason(step)
+    assert saturation_reason(step, min_throughput=0.5, max_error_rate=0.5) is None
+
+
+def test_slow_requests_are_not_saturation():
+    def step(finished):
+        records = [
+            {'endpoint': 'remove-bg', 'status': 200, 'latency_ms': (end - start) * 1000,
+             'finished_s': end, 'repeat': False}
+            for start, end in zip(range(30), finished)
+        ]
+        return summarize(records, duration=30, elapsed=max(finished))
+
+    # Five seconds per request, one request per second, kept up with
+    assert saturation_reason(step([start + 5 for start in range(30)])) is None
+    # The same requests served at half the rate
+    assert "served" in saturation_reason(step([5 + 2 * index for index in range(30)]))
+
+
+def test_traffic_mix_repeats_earlier_payloads():
+    traffic = TrafficMix({'remove-bg': 1.0}, [synthetic_image((64, 48))], repeat=0.5, seed=1)
+    planned = traffic.prepare(40)
+    fresh = [payload for _, payload, repeat in planned if not repeat]
+    assert len(set(fresh)) == len(fresh) == traffic.count
+    assert all(payload in fresh for _, payload, repeat in planned if repeat)
+    assert 5 < len(planned) - len(fresh) < 35
+
+
+def test_variants_miss_the_perceptual_cache():
+    cache = PerceptualCache('test-variants')
+    base = synthetic_image((320, 240))
+    for index in range(64):
+        variant = Image.open(BytesIO(encode_variant(base, index))).convert("RGB")
+        assert cache.lookup(
+            variant, 'key', str(index), Config.PERCEPTUAL_HASH_DISTANCE, Config.PERCEPTUAL_MAX_DIFFERENCE
+        ) is None
+        cache.store(variant, 'key', str(index), index)
+
+
+def test_load_test_against_stub_server(monkeypatch):
+    # Keep the session's torch and OpenMP thread settings
+    monkeypatch.setattr(thread_budget, 'mode', 'off')
+    url, server = start_local_server(stub_models=True, stub_latency_ms=1)
+    try:
+        report = run_load_test(
+            url, {'remove-bg': 0.5, 'detect': 0.5}, [synthetic_image((160, 120))],
+            rates=[10], duration=1, repeat=0.3, max_error_rate=1.0
+        )
+    finally:
+        server.shutdown()
+    assert 'segment' not in vars(model_manager) and 'get_yolo_predictor' not in vars(model_manager)
+
+    step = report['steps'][0]
+    assert step['requests'] > 0 and step['statuses'] == {'200': step['requests']}
+    assert set(step['endpoints']) <= {'remove-bg', 'detect'}
+    assert step['p50_ms'] <= step['p99_ms']
+
+    comparison = compare_reports(report, report)
+    assert comparison['rates']['10']['p99_ms'] == 0.0
@@ -0,0 +1,250 @@
+"""
+Tests for model management
+"""
+
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import torch
+from PIL import Image
+
+from autorender_ai import config as config_module
+from autorender_ai.config import Config
+from autorender_ai.models import ai_models
+from autorender_ai.models.model_server import (
+    DetectionBatcher, ModelServer, ModelServerClient, RemoteDiffusionPipe, RemoteYOLO
+)
+from autorender_ai.models.residency import ModelResidency, estimate_model_size
+from autorender_ai.utils.cancellation import CancelToken, OperationCancelled, active_token
+
+
+def test_estimate_model_size():
+    module = torch.nn.Linear(10, 10)
+    assert estimate_model_size(module) == (10 * 10 + 10) * 4
+
+
+def test_residency_evicts_least_recently_used():
+    unloaded = []
+    residency = ModelResidency(budget_mb=3)
+    residency.register('a', 1024 ** 2, lambda: unloaded.append('a'))
+    residency.register('b', 1024 ** 2, lambda: unloaded.append('b'))
+    residency.touch('a')
+    residency.register('c', 2 * 1024 ** 2, lambda: unloaded.append('c'))
+
+    assert unloaded == ['b']
+    assert set(residency.get_status()['models']) == {'a', 'c'}
+
+
+def test_residency_unloads_outside_its_lock():
+    # Unload functions take other locks; another thread must still reach the residency
+    residency = ModelResidency(budget_mb=1)
+    touched = []
+
+    def unload():
+        worker = threading.Thread(target=lambda: touched.append(residency.touch('b')))
+        worker.start()
+        worker.join(timeout=2)
+
+    residency.register('a', 1024 ** 2, unload)
+    residency.register('b', 1024 ** 2, lambda: None)
+    assert touched == [None]
+
+
+def test_residency_evicts_idle_models():
+    unloaded = []
+    residency = ModelResidency(idle_ttl=60)
+    residency.register('sd', 10, lambda: unloaded.append('sd'))
+    residency.entries['sd']['last_used'] = time.time() - 120
+
+    residency.evict_idle()
+    assert unloaded == ['sd']
+    assert residency.get_status()['resident_mb'] == 0
+
+
+def test_model_server_batches_across_workers_and_stops_generation(tmp_path):
+    class FakePredictor:
+        def __init__(self):
+            self.batches = []
+
+        def predict(self, images, conf, verbose=False, **kwargs):
+            self.batches.append(len(images))
+            boxes = SimpleNamespace(
+                xyxy=torch.tensor([[0., 0., 4., 4.], [1., 1., 2., 2.]]),
+                conf=torch.tensor([0.9, 0.3]),
+                cls=torch.tensor([0., 0.])
+            )
+            return [SimpleNamespace(boxes=boxes) for _ in images]
+
+    class FakePipe:
+        num_timesteps = 20
+        steps_run = 0
+
+        def __call__(self, prompt, width, height, callback_on_step_end=None, **kwargs):
+            for step in range(self.num_timesteps):
+                time.sleep(0.01)
+                self.steps_run = step + 1
+                callback_on_step_end(self, step, step, {'latents': torch.zeros(1, 4, 2, 2)})
+            return SimpleNamespace(images=[Image.new("RGB", (width, height))])
+
+    predictor, pipe = FakePredictor(), FakePipe()
+    manager = SimpleNamespace(
+        config=Config(),
+        get_yolo_predictor=lambda classes: predictor,
+        get_yolo_batch_size=lambda: None,
+        load_stable_diffusion_model=lambda: pipe,
+        segment=lambda image, **options: time.sleep(options.pop('delay', 0)) or image.convert("RGBA")
+    )
+    config = Config()
+    config.MODEL_SERVER_SOCKET = str(tmp_path / "models.sock")
+    config.MODEL_SERVER_BATCH_WAIT_MS = 200
+    server = ModelServer(manager, config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for _ in range(50):
+        if (tmp_path / "models.sock").exists():
+            break
+        time.sleep(0.05)
+    client = ModelServerClient(config)
+
+    # The socket and the generated key are only accessible to this user
+    assert (tmp_path / "models.sock").stat().st_mode & 0o077 == 0
+    assert (tmp_path / "models.sock.key").stat().st_mode & 0o777 == 0o600
+
+    # Requests from three workers share one prediction
+    results = []
+    workers = [
+        threading.Thread(target=lambda: results.append(
+            RemoteYOLO(client, ["shoe"]).predict(Image.new("RGB", (8, 8)), conf=0.5)
+        ))
+        for _ in range(3)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert predictor.batches == [3]
+    assert [len(result[0].boxes.conf) for result in results] == [1, 1, 1]
+
+    assert client.segment(Image.new("RGB", (4, 4))).mode == "RGBA"
+
+    # A result the worker gave up on is unlinked by the server
+    def new_blocks():
+        return {name for name in os.listdir("/dev/shm") if name.startswith("psm_")} - blocks
+
+    blocks, connections = set(os.listdir("/dev/shm")), server.connections
+    with pytest.raises(OperationCancelled), active_token(CancelToken(timeout=0.05)):
+        client.segment(Image.new("RGB", (4, 4)), delay=0.2)
+    for _ in range(50):
+        if server.connections < connections:
+            break
+        time.sleep(0.05)
+    assert server.connections < connections and not new_blocks()
+
+    # A step callback failing in the worker stops generation in the server
+    token = CancelToken(timeout=0.05)
+    with pytest.raises(OperationCancelled), active_token(token):
+        RemoteDiffusionPipe(client)("beach", 8, 8, callback_on_step_end=lambda p, s, t, k: token.check())
+    time.sleep(0.2)
+    assert pipe.steps_run < pipe.num_timesteps
+
+
+def test_batcher_feeds_static_exports_one_image_at_a_time():
+    batches = []
+
+    class StaticPredictor:
+        def predict(self, images, conf, verbose=False, **kwargs):
+            batches.append(len(images))
+            boxes = SimpleNamespace(xyxy=torch.zeros(0, 4), conf=torch.zeros(0), cls=torch.zeros(0))
+            return [SimpleNamespace(boxes=boxes) for _ in images]
+
+    manager = SimpleNamespace(
+        get_yolo_predictor=lambda classes: StaticPredictor(), get_yolo_batch_size=lambda: 1
+    )
+    batcher = DetectionBatcher(manager, max_batch=8, wait_ms=50)
+    futures = [batcher.submit(("shoe",), [Image.new("RGB", (8, 8))] * 3, 0.5) for _ in range(2)]
+    assert [len(future.result(timeout=5)) for future in futures] == [3, 3]
+    assert batches and max(batches) == 1
+
+
+def test_models_resolve_from_local_store(tmp_path, monkeypatch):
+    class StoreConfig(Config):
+        MODEL_STORE_DIR = str(tmp_path)
+        MODEL_OFFLINE = True
+        MODEL_SERVER_SOCKET = ''
+        YOLO_MODEL_PATH = "missing-yolo.pt"
+        SD_TORCH_DTYPE = torch.float32
+
+    manager = ai_models.ModelManager(StoreConfig())
+    with pytest.raises(FileNotFoundError):
+        manager.resolve_yolo_path()
+    (tmp_path / "missing-yolo.pt").write_bytes(b"")
+    assert manager.resolve_yolo_path() == str(tmp_path / "missing-yolo.pt")
+    assert manager.get_yolo_export_path(["shoe"]).startswith(str(tmp_path / "exports"))
+
+    # A store next to the package only when that is writable
+    with monkeypatch.context() as patch:
+        patch.setenv('XDG_DATA_HOME', str(tmp_path / "data"))
+        patch.setattr(config_module.os, 'access', lambda path, mode: False)
+        assert config_module.default_model_store() == str(tmp_path / "data" / "autorender_ai" / "model_store")
+
+    # rembg would download missing weights, offline they must be in its home
+    monkeypatch.setenv('U2NET_HOME', str(tmp_path / "rembg"))
+    monkeypatch.setattr(ai_models, 'new_session', lambda name: name)
+    with pytest.raises(FileNotFoundError):
+        manager.load_rembg_session()
+    (tmp_path / "rembg").mkdir()
+    (tmp_path / "rembg" / f"{StoreConfig.REMBG_MODEL}.onnx").write_bytes(b"")
+    assert manager.load_rembg_session() == StoreConfig.REMBG_MODEL
+
+    loads = []
+
+    class FakePipeline:
+        @staticmethod
+        def from_pretrained(source, **options):
+            loads.append((source, options))
+            return FakePipeline()
+
+        def save_pretrained(self, path, safe_serialization=False):
+            assert safe_serialization
+            (tmp_path / path).mkdir(parents=True)
+
+    monkeypatch.setattr(ai_models, 'StableDiffusionPipeline', FakePipeline)
+    manager.config.SD_PRESERIALIZE = True
+    _, source = manager._load_sd_pipe()
+    assert source == StoreConfig.SD_MODEL_ID
+    assert loads[0][1]['local_files_only'] and loads[0][1]['low_cpu_mem_usage']
+
+    # The saved copy is used from then on
+    _, source = manager._load_sd_pipe()
+    assert source == manager.get_sd_pipeline_path() and source.endswith("-float32")
+    assert loads[1][1]['use_safetensors']
+
+
+def test_onnx_int8_export_is_quantized(tmp_path, monkeypatch):
+    class ExportConfig(Config):
+        MODEL_SERVER_SOCKET = ''
+        YOLO_BACKEND = 'onnx'
+        YOLO_EXPORT_INT8 = True
+        YOLO_EXPORT_DIR = str(tmp_path / "exports")
+
+    exports, quantized = [], []
+
+    class FakeYOLO:
+        def set_classes(self, classes):
+            pass
+
+        def export(self, **options):
+            exports.append(options)
+            (tmp_path / "model.onnx").write_bytes(b"fp32")
+            return str(tmp_path / "model.onnx")
+
+    manager = ai_models.ModelManager(ExportConfig())
+    monkeypatch.setattr(manager, 'load_yolo_model', FakeYOLO)
+    monkeypatch.setattr(manager, 'quantize_onnx_model', lambda source, path: quantized.append(path))
+
+    path = manager.export_yolo_model(["shoe"])
+    assert path.endswith("-int8.onnx") and quantized == [path]
+    assert exports[0]['int8'] is False and 'data' not in exports[0]
+    assert not (tmp_path / "model.onnx").exists()
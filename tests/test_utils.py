@@ -0,0 +1,202 @@
+"""
+Tests for utility helpers
+"""
+
+import os
+import threading
+import time
+from io import BytesIO
+
+import pytest
+import torch
+from flask import Flask
+from PIL import Image
+
+from autorender_ai.config import Config
+from autorender_ai.utils.cancellation import (
+    CancelToken, DeadlineExceeded, OperationCancelled, TIMEOUT_HEADER, active_token
+)
+from autorender_ai.utils.cpu_pool import CPUPool, encode_image
+from autorender_ai.utils.metrics import metrics
+from autorender_ai.utils.output_encoder import OutputEncoder
+from autorender_ai.utils.single_flight import SingleFlight
+from autorender_ai.utils.thread_budget import THREAD_ENV_VARS, ThreadBudget
+
+
+class PoolConfig(Config):
+    CPU_POOL_WORKERS = 1
+    CPU_POOL_MIN_PIXELS = 100
+
+
+def test_cpu_pool_round_trip():
+    """Offloaded stages give the same pixels as in-thread ones"""
+    pool = CPUPool(PoolConfig())
+    image = Image.effect_noise((64, 48), 50).convert("RGB")
+    try:
+        decoded = pool.decode(encode_image(image, "PNG"))
+        assert decoded.tobytes() == image.tobytes()
+
+        thumbnail = pool.thumbnail(decoded.copy(), 32)
+        assert thumbnail.size == (32, 24)
+
+        composite = pool.composite(Image.new("RGB", (8, 8)), image.convert("RGBA"))
+        assert composite.size == image.size and composite.mode == "RGB"
+        assert pool.get_status()['started'] is True
+    finally:
+        pool.shutdown()
+
+
+def test_cpu_pool_releases_blocks_of_abandoned_jobs():
+    def blocks():
+        return {name for name in os.listdir("/dev/shm") if name.startswith("psm_")}
+
+    pool = CPUPool(PoolConfig())
+    image = Image.effect_noise((4096, 4096), 50).convert("RGB")
+    try:
+        pool.thumbnail(image.resize((64, 64)), 32)  # Start the worker
+        before = blocks()
+        # The worker is still resizing when the deadline passes
+        with pytest.raises(DeadlineExceeded), active_token(CancelToken(timeout=0.05)):
+            pool.thumbnail(image, 1024)
+        # The single worker runs jobs in order, so this one finishes last
+        pool.thumbnail(image.resize((64, 64)), 32)
+        assert not blocks() - before
+    finally:
+        pool.shutdown()
+
+
+def test_cpu_pool_small_images_stay_in_thread():
+    pool = CPUPool(PoolConfig())
+    pool.encode(Image.new("RGB", (5, 5)))
+    assert pool.get_status()['started'] is False
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight('test-flight')
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(flight.do('key', compute)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while metrics.snapshot()['counters'].get('test-flight.coalesced', 0) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    assert metrics.snapshot()['counters'].get('test-flight.coalesced', 0) >= 3
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == [1]
+    assert results == ["result"] * 4
+    assert flight.in_flight == 0
+
+
+def test_cancel_token_deadline():
+    token = CancelToken(timeout=0.01)
+    time.sleep(0.02)
+    assert token.expired
+    with pytest.raises(DeadlineExceeded):
+        token.check()
+
+    token = CancelToken()
+    token.check()
+    token.cancel()
+    with pytest.raises(OperationCancelled):
+        token.check()
+
+
+def test_cancel_token_from_request_header():
+    class TimeoutConfig(Config):
+        REQUEST_TIMEOUT = 30
+
+    app = Flask(__name__)
+    for value in ("nan", "inf", "-1", "soon"):
+        with app.test_request_context(headers={TIMEOUT_HEADER: value}):
+            with pytest.raises(ValueError):
+                CancelToken.from_request(TimeoutConfig)
+
+    # A client can shorten the server's deadline but not extend it
+    with app.test_request_context(headers={TIMEOUT_HEADER: "3600"}):
+        assert CancelToken.from_request(TimeoutConfig).remaining <= 30
+    with app.test_request_context(headers={TIMEOUT_HEADER: "5"}):
+        assert CancelToken.from_request(TimeoutConfig).remaining <= 5
+
+
+def test_output_encoder_presets_and_overrides():
+    encoder = OutputEncoder.from_request({}, 'swap-background', Config)
+    assert encoder.format == "JPEG" and encoder.options['subsampling'] == 2
+
+    encoder = OutputEncoder.from_request(
+        {'format': 'webp', 'quality': '70', 'compress_level': '1'}, 'remove-bg', Config
+    )
+    assert encoder.format == "WEBP"
+    assert encoder.options == {'quality': 70, 'method': 4}
+
+    encoder = OutputEncoder.from_request({'encoding': 'jpeg', 'subsampling': '4:4:4'}, 'detect', Config)
+    assert encoder.options['subsampling'] == 0
+
+    with pytest.raises(ValueError):
+        OutputEncoder.from_request({'encoding': 'gif'}, 'detect', Config)
+    with pytest.raises(ValueError):
+        OutputEncoder.from_request({'format': 'png', 'compress_level': '12'}, 'detect', Config)
+
+
+def test_output_encoder_keeps_alpha_and_reports_sizes():
+    image = Image.new("RGBA", (16, 16), (255, 0, 0, 0))
+    encoder = OutputEncoder.from_preset('webp-lossless', Config)
+    decoded = Image.open(BytesIO(encoder.encode(image)))
+    assert decoded.mode == "RGBA" and decoded.getpixel((0, 0))[3] == 0
+
+    encoder.to_base64(image)
+    report = encoder.report()
+    assert report['images'] == 2 and report['bytes'] > 0
+    assert report['mime_type'] == "image/webp"
+
+    # JPEG flattens transparent pixels onto white, not black
+    decoded = Image.open(BytesIO(OutputEncoder.from_preset('jpeg', Config).encode(image)))
+    assert decoded.mode == "RGB" and min(decoded.getpixel((0, 0))) > 240
+
+
+def test_thread_budget_divides_cores_among_workers(monkeypatch):
+    class BudgetConfig(Config):
+        THREAD_BUDGET = 'auto'
+        THREAD_BUDGET_CORES = 4
+        THREAD_BUDGET_THREADS = 0
+        THREAD_BUDGET_AFFINITY = False
+
+    monkeypatch.setattr("autorender_ai.utils.thread_budget.available_cores", lambda: list(range(32)))
+    for name in THREAD_ENV_VARS:
+        monkeypatch.setenv(name, "")
+    # Inter-op threads can only be set once per process, keep the session's
+    monkeypatch.setattr(torch, 'set_num_interop_threads', lambda threads: None)
+    threads = torch.get_num_threads()
+    budget = ThreadBudget(BudgetConfig(), workers=2)
+    try:
+        status = budget.apply()
+        assert status['cores'] == 4 and status['threads_per_worker'] == 2
+        assert status['libraries']['torch'] == 2
+        assert torch.get_num_threads() == 2
+        assert all(os.environ[name] == "2" for name in THREAD_ENV_VARS)
+    finally:
+        torch.set_num_threads(threads)
+
+    # Applied once per process, again in a process forked after that
+    calls = []
+    monkeypatch.setattr(budget, 'apply', lambda: calls.append(1))
+    budget.ensure_applied()
+    assert calls == []
+    budget._pid = -1
+    budget.ensure_applied()
+    assert calls == [1]
+
+    assert ThreadBudget(BudgetConfig(), workers=8).threads_per_worker() == 1